@@ -0,0 +1,171 @@
+"""Times the post-processing stages of an export on a synthetic archive.
+
+This doesn't need the Evernote app: the notes are generated up front and
+"exported" by a fake script runner, so the timings only cover this
+package's own work. Each stage runs in a fresh process so that its peak
+memory use can be recorded. The stages are:
+
+    export_enhanced   renaming the exported notes and adding metadata
+    merge             merging a second export into the first
+    relink            relinking the merged folder from scratch
+    relink_unchanged  relinking it again, using the saved link index
+
+Run from the repository root, e.g.:
+
+    PYTHONPATH=src python benchmarks/run.py -n 10000 -o before.json
+    PYTHONPATH=src python benchmarks/run.py -n 10000 -c before.json
+"""
+
+import argparse
+import json
+import multiprocessing
+from pathlib import Path
+import platform
+import resource
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+import time
+from exporteer_evernote_osx import enapp
+from synthetic import ReplayRunner, SyntheticArchive
+
+
+STAGES = ['export_enhanced', 'merge', 'relink', 'relink_unchanged']
+
+
+def _max_rss_bytes():
+    # Includes any worker processes the stage started and waited for.
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Linux reports kilobytes, macOS bytes.
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _replay_export(workdir, name, dest):
+    lines = json.loads(workdir.joinpath(f'{name}.json').read_text())
+    enapp.set_runner(ReplayRunner(workdir.joinpath(name), lines))
+    return enapp.export_enhanced(str(dest))
+
+
+def _stage_process(queue, stage, workdir, jobs):
+    try:
+        queue.put(_run_stage(stage, workdir, jobs))
+    except BaseException as e:
+        queue.put(e)
+        raise
+
+
+def _run_stage(stage, workdir, jobs):
+    workdir = Path(workdir)
+    archive = workdir.joinpath('archive')
+    start = time.perf_counter()
+    if stage == 'export_enhanced':
+        _replay_export(workdir, 'first', archive)
+        stats = None
+    elif stage == 'merge':
+        stats = enapp.merge([workdir.joinpath('second-export')], archive,
+                            jobs=jobs)
+    elif stage == 'relink':
+        stats = enapp.relink(archive, jobs=jobs, rebuild=True)
+    elif stage == 'relink_unchanged':
+        stats = enapp.relink(archive, jobs=jobs)
+    result = {
+        'seconds': time.perf_counter() - start,
+        'max_rss_bytes': _max_rss_bytes(),
+    }
+    if stats:
+        result.update(stats._asdict())
+    return result
+
+
+def _commit():
+    try:
+        out = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return str(out, 'utf-8').strip()
+
+
+def run(archive, jobs=None):
+    """Generates the archive, runs the stages in order, and returns the
+    results as a JSON-compatible dict."""
+    ctx = multiprocessing.get_context('spawn')
+    results = {
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': archive.params(),
+        'jobs': jobs,
+        'stages': {},
+    }
+    with TemporaryDirectory() as rawpath:
+        workdir = Path(rawpath)
+        start = time.perf_counter()
+        for name, first_index in [('first', 1), ('second', archive.notes + 1)]:
+            lines = archive.write_export(workdir.joinpath(name), first_index)
+            workdir.joinpath(f'{name}.json').write_text(json.dumps(lines))
+        _replay_export(workdir, 'second', workdir.joinpath('second-export'))
+        results['setup_seconds'] = time.perf_counter() - start
+        for stage in STAGES:
+            queue = ctx.Queue()
+            proc = ctx.Process(target=_stage_process,
+                               args=(queue, stage, str(workdir), jobs))
+            proc.start()
+            result = queue.get()
+            proc.join()
+            if isinstance(result, BaseException):
+                raise result
+            results['stages'][stage] = result
+            print(f'{stage:18} {result["seconds"]:9.2f}s '
+                  f'{result["max_rss_bytes"] / 2**20:9.1f} MiB',
+                  file=sys.stderr)
+    return results
+
+
+def compare(old, new):
+    """Prints a table comparing the stage timings of two results."""
+    print(f'{"stage":18} {"old":>9} {"new":>9} {"ratio":>7}')
+    for stage, result in new['stages'].items():
+        if stage not in old['stages']:
+            continue
+        before = old['stages'][stage]['seconds']
+        after = result['seconds']
+        ratio = after / before if before else float('inf')
+        print(f'{stage:18} {before:8.2f}s {after:8.2f}s {ratio:7.2f}')
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='benchmark post-processing on a synthetic archive')
+    parser.add_argument('-n', '--notes', type=int, default=1000,
+                        help='number of notes in each export (default 1000)')
+    parser.add_argument('-l', '--link-density', type=float, default=2.0,
+                        help='average evernote:// links per note (default 2)')
+    parser.add_argument('-r', '--resource-ratio', type=float, default=0.3,
+                        help='fraction of notes with attachments (default 0.3)')
+    parser.add_argument('-w', '--body-words', type=int, default=200,
+                        help='words per note body (default 200)')
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='jobs for merge and relink (default: their own)')
+    parser.add_argument('-o', '--output',
+                        help='file to write JSON results to')
+    parser.add_argument('-c', '--compare',
+                        help='JSON results of an earlier run to compare with')
+    args = parser.parse_args(args)
+
+    archive = SyntheticArchive(
+        args.notes, link_density=args.link_density,
+        resource_ratio=args.resource_ratio, body_words=args.body_words,
+        seed=args.seed)
+    results = run(archive, jobs=args.jobs)
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+    if args.compare:
+        compare(json.loads(Path(args.compare).read_text()), results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,133 @@
+"""Generates synthetic Evernote-style HTML exports for benchmarking.
+
+The notes imitate what the Mac app produces when exporting one note at a
+time (as export_enhanced does): a numbered folder per note containing the
+HTML file and, for some notes, a resources folder. Titles include many
+duplicates and some that are long enough to be truncated, and note bodies
+contain evernote:// links to other notes.
+"""
+
+import os
+from pathlib import Path
+import random
+import re
+import shutil
+from exporteer_evernote_osx import enapp, transport
+
+
+# Where _EXPORT_BY_NOTE_SCRIPT puts the notes and their metadata.
+_DEST_RE = re.compile(r'POSIX file \("(.+?)/" &')
+_META_RE = re.compile(r'open for access \(POSIX file "(.+?)"\)')
+
+_COMMON_TITLES = ['Untitled', 'Meeting notes', 'Todo', 'Receipt']
+
+_WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+          'eiusmod tempor incididunt ut labore et dolore magna aliqua').split()
+
+_NOTE_HTML = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+<html><head><meta http-equiv="Content-Type" content="text/html; charset=UTF-8"/><meta name="exporter-version" content="Evernote Mac 7.14 (458244)"/><meta name="created" content="{created}"/><meta name="updated" content="{updated}"/><title>{title}</title></head><body><div>{body}</div></body></html>
+"""
+
+
+def note_link(index):
+    guid = f'{index:08x}-0000-4000-8000-{index:012x}'
+    return f'evernote:///view/1234567/s1/{guid}/{guid}/'
+
+
+class SyntheticArchive:
+    """Parameters of a synthetic archive, and the notes derived from them.
+
+    link_density is the average number of evernote:// links per note,
+    resource_ratio the fraction of notes with attachments, and
+    duplicate_ratio and long_title_ratio the fractions of notes with a
+    commonly used title or an overly long one. body_words controls the
+    size of each note. The same seed always produces the same archive.
+    """
+
+    def __init__(self, notes, link_density=2.0, resource_ratio=0.3,
+                 duplicate_ratio=0.2, long_title_ratio=0.05, body_words=200,
+                 seed=0):
+        self.notes = notes
+        self.link_density = link_density
+        self.resource_ratio = resource_ratio
+        self.duplicate_ratio = duplicate_ratio
+        self.long_title_ratio = long_title_ratio
+        self.body_words = body_words
+        self.seed = seed
+
+    def params(self):
+        return dict(vars(self))
+
+    def title(self, rng, index):
+        roll = rng.random()
+        if roll < self.duplicate_ratio:
+            return rng.choice(_COMMON_TITLES)
+        if roll < self.duplicate_ratio + self.long_title_ratio:
+            return ' '.join(rng.choice(_WORDS) for _ in range(30))
+        return f'Note {index} {rng.choice(_WORDS)}'
+
+    def body(self, rng, resources):
+        words = [rng.choice(_WORDS) for _ in range(self.body_words)]
+        links = int(self.link_density)
+        if rng.random() < self.link_density - links:
+            links += 1
+        for _ in range(links):
+            target = rng.randrange(self.notes * 2)  # some won't be exported
+            pos = rng.randrange(len(words) + 1)
+            words.insert(pos, f'<a href="{note_link(target)}">link</a>')
+        if resources:
+            words.append(f'<img src="{resources}/image.png"/>')
+        return ' '.join(words)
+
+    def write_export(self, folder, first_index=1):
+        """Writes the numbered per-note folders that the app would produce
+        during export_enhanced into folder, and returns the metadata lines
+        that _EXPORT_BY_NOTE_SCRIPT would write, in order."""
+        rng = random.Random(f'{self.seed}-{first_index}')
+        folder = Path(folder)
+        lines = []
+        for offset in range(self.notes):
+            index = first_index + offset
+            title = self.title(rng, index)
+            notefolder = folder.joinpath(str(offset + 1))
+            notefolder.mkdir(parents=True)
+            # Evernote truncates long names, and truncates resource
+            # folder names more than HTML file names.
+            stem = title[:200]
+            resources = None
+            if rng.random() < self.resource_ratio:
+                resources = f'{stem[:150]}.resources'
+                resfolder = notefolder.joinpath(resources)
+                resfolder.mkdir()
+                resfolder.joinpath('image.png').write_bytes(
+                    os.urandom(rng.randrange(1000, 20000)))
+            created = f'2020-01-{1 + index % 28:02d}T12:00:00'
+            notefolder.joinpath(f'{stem}.html').write_text(_NOTE_HTML.format(
+                created=created, updated=created, title=title,
+                body=self.body(rng, resources and resources.replace(' ', '%20'))))
+            lines.append(enapp._META_SIDECAR_SEP.join([
+                str(offset + 1), f'Notebook {index % 10}', note_link(index),
+                title, created, created]))
+        return lines
+
+
+class ReplayRunner(transport.ScriptRunner):
+    """A fake script runner that "exports" notes prepared earlier by
+    SyntheticArchive.write_export, by moving them into the folder named
+    in the enhanced export script and writing the metadata sidecar."""
+
+    def __init__(self, prepared, lines):
+        self.prepared = Path(prepared)
+        self.lines = lines
+
+    def run(self, script):
+        dest = _DEST_RE.search(script).group(1)
+        meta = _META_RE.search(script).group(1)
+        with open(meta, 'a', encoding='utf-8') as meta_file:
+            for line in self.lines:
+                index = line.split(enapp._META_SIDECAR_SEP, 1)[0]
+                meta_file.write(line + '\n')
+                meta_file.flush()
+                shutil.move(str(self.prepared.joinpath(index)), dest)
+        return ''
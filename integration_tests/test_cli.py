@@ -1,9 +1,12 @@
+import asyncio
+import json
 from pathlib import Path
 import re
 from tempfile import TemporaryDirectory
 import pytest
 import shutil
-from exporteer_evernote_osx import cli
+import zipfile
+from exporteer_evernote_osx import aio, cli, enapp, watch
 
 
 def test_help(capsys):
@@ -38,6 +41,13 @@ def test_sync_time_options():
     assert cli.main(['sync', '-d', '5', '-t', '10']) in [0, 2]
 
 
+def test_export_sync_first():
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath).joinpath('test.enex').resolve()
+        assert cli.main(['export', str(path), '-E', '-s', '-q', 'created:month']) == 0
+        assert path.exists()
+
+
 def test_list_notebooks(capsys):
     assert cli.main(['notebooks']) == 0
     cap = capsys.readouterr()
@@ -123,3 +133,184 @@ def test_merge():
         target = path.joinpath('target')
         assert cli.main(['merge', str(target), str(dir1), str(dir2)]) == 0
         assert len(list(target.iterdir())) == count * 2
+
+
+def _original_relink(folder):
+    # The relink algorithm from before the link index and process pool
+    # were added, whose output the current one should match.
+    link_paths = {}
+    for path in folder.glob('**/*.html'):
+        match = re.search(enapp.URL_META_RE, path.read_text())
+        if match:
+            link_paths[match.group(1)] = path.relative_to(folder)
+    for path in folder.glob('**/*.html'):
+        text = path.read_text()
+        endhead = text.index('</head>')
+        body = text[endhead:]
+        for link, target in link_paths.items():
+            body = body.replace(link, str(target))
+        path.write_text(text[:endhead] + body)
+
+
+def test_relink_jobs():
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath)
+        dir1 = path.joinpath('dir1')
+        dir2 = path.joinpath('dir2')
+        dir3 = path.joinpath('dir3')
+        assert cli.main(['export', str(dir1), '-eq', 'created:month']) == 0
+        shutil.copytree(dir1, dir2)
+        shutil.copytree(dir1, dir3)
+        assert cli.main(['relink', '-j', '1', str(dir1)]) == 0
+        assert cli.main(['relink', '-j', '4', str(dir2)]) == 0
+        _original_relink(dir3)
+        for file in dir3.glob('*.html'):
+            assert file.read_text() == dir1.joinpath(file.name).read_text()
+            assert file.read_text() == dir2.joinpath(file.name).read_text()
+
+
+def test_relink_backlinks():
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath)
+        assert cli.main(['export', str(path), '-eq', 'created:month']) == 0
+        assert cli.main(['relink', '-b', str(path)]) == 0
+        graph = json.loads(path.joinpath('.link-graph.json').read_text())
+        assert len(graph['notes']) == len(list(path.glob('*.html')))
+        for url, targets in graph['links'].items():
+            for target in targets:
+                text = path.joinpath(graph['notes'][target]).read_text()
+                assert text.count('<!--evernote-backlinks-->') == 1
+        before = {file: file.read_text() for file in path.glob('*.html')}
+        assert cli.main(['relink', '-b', str(path)]) == 0
+        for file, text in before.items():
+            assert file.read_text() == text
+
+
+def test_export_sharded():
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath)
+        whole = path.joinpath('whole.enex')
+        sharded = path.joinpath('sharded.enex')
+        assert cli.main(['export', str(whole), '-Eq', 'created:year']) == 0
+        assert cli.main(['export', str(sharded), '-Eq', 'created:year',
+                         '--shard-by', 'created', '-b', '2']) == 0
+        assert (sharded.read_text().count('<note>')
+                == whole.read_text().count('<note>'))
+        assert not path.joinpath('.sharded.enex.shards').exists()
+
+
+def test_export_enhanced_batched():
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath).joinpath('test').resolve()
+        assert cli.main(['export', str(path), '-eq', 'created:month', '-b', '2']) == 0
+        assert path.is_dir()
+        files = list(path.glob('*.html'))
+        assert len(files) > 2
+        for file in files:
+            text = file.read_text()
+            assert '<meta name="evernote-notebook" content="' in text
+            assert '<meta name="evernote-url" content="evernote:///' in text
+        assert not path.joinpath('.export-journal.json').exists()
+
+
+def test_export_enhanced_via_enex():
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath).joinpath('test').resolve()
+        assert cli.main(['export', str(path), '-e', '--via-enex', '-q', 'created:month']) == 0
+        files = list(path.glob('*.html'))
+        assert len(files) > 0
+        for file in files:
+            text = file.read_text()
+            assert '<meta name="evernote-notebook" content="' in text
+            assert '<meta name="evernote-url" content="evernote:///' in text
+        assert not list(path.glob('.via-enex-*'))
+
+
+def test_export_enhanced_dedup():
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath).joinpath('test').resolve()
+        assert cli.main(['export', str(path), '-e', '-D', '-q', 'created:month']) == 0
+        assert path.joinpath('.blobs').is_dir()
+        for resource in path.glob('*.resources/*'):
+            assert resource.stat().st_nlink > 1
+        assert cli.main(['dedup', str(path)]) == 0
+
+
+def test_export_enhanced_archive():
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath).joinpath('test.zip').resolve()
+        assert cli.main(['export', str(path), '-e', '-a', '-q', 'created:month']) == 0
+        with zipfile.ZipFile(path) as archive:
+            names = [name for name in archive.namelist() if name.endswith('.html')]
+            assert len(names) > 0
+            text = str(archive.read(names[0]), 'utf-8')
+            assert '<meta name="evernote-url" content="evernote:///' in text
+        assert [p.name for p in Path(rawpath).iterdir()] == ['test.zip']
+
+
+def test_export_incremental():
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath).joinpath('test').resolve()
+        state = Path(rawpath).joinpath('state.json')
+        assert cli.main(['export', str(path), '-q', 'created:month', '-I', str(state)]) == 0
+        assert state.exists()
+        count = len(list(path.glob('*.html')))
+        assert count > 0
+        assert cli.main(['export', str(path), '-q', 'created:month', '-I', str(state)]) == 0
+        assert len(list(path.glob('*.html'))) == count
+
+
+def test_export_mirror():
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath).joinpath('test').resolve()
+        assert cli.main(['export', str(path), '-m', '-q', 'created:month']) == 0
+        files = {p: p.stat().st_mtime for p in path.glob('*.html')}
+        assert len(files) > 0
+        assert path.joinpath('.mirror-manifest.json').exists()
+        assert cli.main(['export', str(path), '-m', '-q', 'created:month']) == 0
+        assert {p: p.stat().st_mtime for p in path.glob('*.html')} == files
+
+
+def test_watch():
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath).joinpath('test').resolve()
+        watch.watch(path, query='created:month', sync=False, cycles=1)
+        assert len(list(path.glob('*.html'))) > 0
+        status = json.loads(path.joinpath('.watch-status.json').read_text())
+        assert status['cycles'] == 1
+        assert status['last_error'] is None
+
+
+def test_catalog(capsys):
+    with TemporaryDirectory() as rawpath:
+        cache = Path(rawpath).joinpath('catalog.sqlite')
+        assert cli.main(['catalog', '-q', 'created:month', '-c', str(cache)]) == 0
+        cap = capsys.readouterr()
+        lines = cap.out.splitlines()
+        assert len(lines) > 1
+        assert lines[0].startswith('evernote://')
+        assert cache.exists()
+        assert cli.main(['catalog', '-q', 'created:month', '-c', str(cache)]) == 0
+        cap = capsys.readouterr()
+        assert cap.out.splitlines() == lines
+
+
+def test_split_enex():
+    with TemporaryDirectory() as rawpath:
+        enexpath = Path(rawpath).joinpath('test.enex').resolve()
+        assert cli.main(['export', str(enexpath), '-E', '-q', 'created:month']) == 0
+        path = Path(rawpath).joinpath('split').resolve()
+        assert cli.main(['split-enex', str(path), str(enexpath), '-r']) == 0
+        files = list(path.joinpath('test').glob('*.enex'))
+        assert len(files) > 0
+        index = path.joinpath('index.jsonl').read_text().splitlines()
+        assert len(index) == len(files)
+
+
+def test_aio_export_enhanced():
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath).joinpath('test').resolve()
+        assert asyncio.run(aio.export_enhanced(path, query='created:month'))
+        files = list(path.glob('*.html'))
+        assert len(files) > 0
+        assert '<meta name="evernote-url" content="evernote:///' in files[0].read_text()
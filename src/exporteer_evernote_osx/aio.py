@@ -0,0 +1,248 @@
+"""Asyncio versions of the main functions of the enapp module.
+
+These don't block the event loop: AppleScript runs in osascript
+processes started with asyncio, and file processing runs in the loop's
+default executor. At most a fixed number of osascript processes run at
+once (see AsyncRunner), so many exports and syncs can be scheduled
+together. Cancelling a call, or its timeout expiring, kills the
+osascript process it was waiting for.
+
+For example:
+
+    from exporteer_evernote_osx import aio
+
+    async def backup():
+        await aio.start_sync()
+        await aio.await_sync()
+        await aio.export_enhanced('/path/to/backup')
+"""
+
+import asyncio
+from pathlib import Path
+import subprocess
+from tempfile import TemporaryDirectory
+import time
+from exporteer_evernote_osx import enapp, profiling, transport
+
+
+# Extra time allowed for osascript beyond the timeout given to the app,
+# after which the process is killed.
+_TIMEOUT_GRACE_SECONDS = 60
+
+
+class _BoundedRunner:
+    """Base class for async script runners that run at most concurrency
+    scripts at once."""
+
+    def __init__(self, concurrency=4):
+        self.concurrency = concurrency
+        self._semaphore = None
+        self._loop = None
+
+    def _slot(self):
+        # Before Python 3.10, a semaphore belongs to the loop that was
+        # current when it was created, so make one per loop.
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._loop = loop
+        return self._semaphore
+
+
+class AsyncRunner(_BoundedRunner):
+    """Runs each script in a new osascript process."""
+
+    async def run(self, script):
+        """Runs the AppleScript source and returns its result as text (see
+        the transport module)."""
+        async with self._slot():
+            proc = await asyncio.create_subprocess_exec(
+                'osascript', '-e', script, '-ss',
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            try:
+                out, err = await proc.communicate()
+            except BaseException:
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+                raise
+        if proc.returncode:
+            raise transport.ScriptError(str(err, 'utf-8').strip())
+        return str(out, 'utf-8').strip()
+
+
+class ThreadedRunner(_BoundedRunner):
+    """Runs scripts with a synchronous transport.ScriptRunner (e.g. a fake
+    for testing) in the loop's default executor.
+
+    Cancelling a call doesn't stop a script that has already started.
+    """
+
+    def __init__(self, runner, concurrency=4):
+        super().__init__(concurrency)
+        self.runner = runner
+
+    async def run(self, script):
+        async with self._slot():
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self.runner.run, script)
+
+
+_runner = None
+
+
+def get_runner():
+    """Returns the runner used by the functions in this module, which is
+    an AsyncRunner unless set_runner has been called."""
+    global _runner
+    if _runner is None:
+        _runner = AsyncRunner()
+    return _runner
+
+
+def set_runner(runner):
+    """Sets the runner used by the functions in this module: an object
+    with an async run(script) method, such as an AsyncRunner with a
+    different concurrency, or a ThreadedRunner."""
+    global _runner
+    _runner = runner
+
+
+async def _run_script(script, timeout_seconds=None):
+    if timeout_seconds is not None:
+        timeout_seconds += _TIMEOUT_GRACE_SECONDS
+    with profiling.span('osascript', script_bytes=len(script)):
+        return await asyncio.wait_for(get_runner().run(script),
+                                      timeout_seconds)
+
+
+async def _in_executor(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+async def start_sync():
+    """Tells the Evernote app to start synchronizing."""
+    await _run_script(enapp._START_SYNC_SCRIPT)
+
+
+async def check_sync():
+    """Returns True if the Evernote app is currently synchronizing."""
+    out = await _run_script(enapp._CHECK_SYNC_SCRIPT)
+    return out.strip() == 'true'
+
+
+async def await_sync(timeout_seconds=60*30, delay_seconds=10,
+                     initial_delay_seconds=0.5):
+    """Like enapp.await_sync, but sleeps without blocking the loop."""
+    waits = enapp._sync_waits(time.monotonic(), timeout_seconds,
+                              delay_seconds, initial_delay_seconds)
+    while await check_sync():
+        await asyncio.sleep(next(waits))
+
+
+async def list_notebooks():
+    """Returns a list of notebook names."""
+    out = await _run_script(enapp._LIST_NOTEBOOKS_SCRIPT)
+    return enapp._NOTEBOOK_NAMES_RE.findall(out)
+
+
+async def export(dest, fmt='HTML', query='', timeout_seconds=30*60):
+    """Like enapp.export. Returns False if no notes match the query."""
+    script = enapp._export_script(dest, fmt, query, timeout_seconds)
+    return await _run_script(script, timeout_seconds) == 'true'
+
+
+async def export_enhanced(dest, fmt='HTML', query='', timeout_seconds=30*60,
+                          start=1, limit=0, on_note=None):
+    """Like enapp.export_enhanced. Each note is renamed and tagged in the
+    loop's default executor, and on_note (if given) is then called in
+    the loop.
+
+    Returns False if no notes match the query.
+    """
+    dest = Path(dest).resolve()
+    tmp, meta_path, script = enapp._prepare_enhanced_export(
+        dest, fmt, query, timeout_seconds, start, limit)
+    allocator = enapp._NameAllocator(dest)
+
+    async def finish(folder, meta):
+        path = await _in_executor(enapp._finish_exported_note, folder, meta,
+                                  allocator)
+        if path and on_note:
+            on_note(path, meta)
+
+    with open(meta_path, 'rb') as meta_file:
+        tail = enapp._SidecarTail(tmp, meta_file)
+        task = asyncio.ensure_future(_run_script(script, timeout_seconds))
+        try:
+            while True:
+                exited = task.done()
+                for note in tail.poll():
+                    await finish(*note)
+                if exited:
+                    break
+                await asyncio.wait([task],
+                                   timeout=enapp._EXPORT_POLL_SECONDS)
+        except BaseException:
+            task.cancel()
+            raise
+        await task
+        last = tail.last()
+        if last:
+            await finish(*last)
+    meta_path.unlink()
+    tmp.rmdir()
+    return tail.found
+
+
+async def count_notes_by_notebook(query='', timeout_seconds=30*60):
+    """Like enapp.count_notes_by_notebook."""
+    with TemporaryDirectory() as tmp:
+        out_path = Path(tmp).joinpath('counts')
+        await _run_script(enapp._count_by_notebook_script(
+            out_path, query, timeout_seconds), timeout_seconds)
+        return enapp._read_counts(out_path)
+
+
+async def export_by_notebook(dest, fmt='HTML', query='',
+                             timeout_seconds=30*60, jobs=1,
+                             small_notebook_notes=20,
+                             small_batch_notes=200):
+    """Like enapp.export_by_notebook: up to jobs of this export's calls
+    run at once (also subject to the runner's own limit).
+
+    Returns a list of enapp.NotebookTiming, one per call.
+    """
+    enapp._check_notebook_query(query)
+    dest = Path(dest).resolve()
+    dest.mkdir(parents=True, exist_ok=True)
+    counts = await count_notes_by_notebook(query, timeout_seconds)
+    batches = enapp._notebook_batches(counts, small_notebook_notes,
+                                      small_batch_notes)
+    semaphore = asyncio.Semaphore(jobs)
+
+    async def run(batch):
+        script = enapp._export_notebooks_script(dest, batch, fmt, query,
+                                                timeout_seconds)
+        async with semaphore:
+            start = time.time()
+            await _run_script(script, timeout_seconds)
+        return enapp.NotebookTiming(batch, sum(counts[n] for n in batch),
+                                    time.time() - start)
+
+    if jobs == 1:
+        return [await run(batch) for batch in batches]
+    results = await asyncio.gather(*(run(batch) for batch in batches),
+                                   return_exceptions=True)
+    timings = []
+    failed = []
+    for batch, result in zip(batches, results):
+        if isinstance(result, transport.ScriptError):
+            failed.append(batch)
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            timings.append(result)
+    for batch in failed:
+        timings.append(await run(batch))
+    return timings
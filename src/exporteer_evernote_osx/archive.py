@@ -0,0 +1,99 @@
+"""Writing exported notes into tar or zip archives.
+
+Compressed tar formats supported by the tarfile module are always
+available; .tar.zst needs the optional zstandard package.
+"""
+
+from pathlib import Path
+import shutil
+import tarfile
+import zipfile
+
+
+_TAR_MODES = {
+    '.tar': 'w|',
+    '.tar.gz': 'w|gz',
+    '.tgz': 'w|gz',
+    '.tar.bz2': 'w|bz2',
+    '.tar.xz': 'w|xz',
+}
+
+SUFFIXES = sorted(list(_TAR_MODES) + ['.tar.zst', '.zip'])
+
+
+def _suffix(path):
+    name = Path(path).name.lower()
+    for suffix in SUFFIXES:
+        if name.endswith(suffix):
+            return suffix
+    raise ValueError(f'unsupported archive type: {path} '
+                     f'(supported: {", ".join(SUFFIXES)})')
+
+
+class ArchiveWriter:
+    """Adds files to a new archive, whose format is chosen by the suffix of
+    path (one of SUFFIXES).
+
+    Tar archives are written as a stream, so nothing is read back from the
+    archive file, and only the file being added is held open.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        suffix = _suffix(self.path)
+        self.zip = self.tar = self.raw = self.compressor = None
+        if suffix == '.zip':
+            self.zip = zipfile.ZipFile(
+                self.path, 'w', compression=zipfile.ZIP_DEFLATED)
+        elif suffix == '.tar.zst':
+            try:
+                import zstandard
+            except ImportError:
+                raise ValueError('writing .tar.zst archives requires the '
+                                 'zstandard package') from None
+            self.raw = open(self.path, 'wb')
+            self.compressor = zstandard.ZstdCompressor().stream_writer(
+                self.raw)
+            self.tar = tarfile.open(fileobj=self.compressor, mode='w|')
+        else:
+            self.tar = tarfile.open(str(self.path), mode=_TAR_MODES[suffix])
+
+    def add(self, path, arcname):
+        """Adds the file or directory (recursively) at path to the archive
+        as arcname."""
+        path = Path(path)
+        if self.tar:
+            self.tar.add(str(path), arcname=arcname)
+        elif path.is_dir():
+            self.zip.write(path, arcname)
+            for child in sorted(path.iterdir()):
+                self.add(child, f'{arcname}/{child.name}')
+        else:
+            self.zip.write(path, arcname)
+
+    def add_note(self, path):
+        """Adds an HTML file and its resources folder (if any) to the root
+        of the archive, and then deletes them."""
+        path = Path(path)
+        respath = path.with_name(f'{path.name}.resources')
+        self.add(path, path.name)
+        path.unlink()
+        if respath.exists():
+            self.add(respath, respath.name)
+            shutil.rmtree(respath)
+
+    def close(self):
+        if self.zip:
+            self.zip.close()
+        if self.tar:
+            self.tar.close()
+        if self.compressor:
+            self.compressor.close()
+        if self.raw and not self.raw.closed:
+            self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
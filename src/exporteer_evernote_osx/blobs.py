@@ -0,0 +1,117 @@
+"""Keeping a single copy of attachments that appear in many notes."""
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+from pathlib import Path
+import re
+from urllib.parse import quote
+from exporteer_evernote_osx import profiling, rewrite
+
+
+BLOBS_DIR_NAME = '.blobs'
+
+
+def hash_file(path):
+    """Returns the SHA-256 hash of the file at path, in hex."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(rewrite.CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BlobStore:
+    """Keeps one copy of each distinct attachment in a folder of exported
+    notes, in a subfolder (see BLOBS_DIR_NAME) named by content hash.
+
+    Attachments in the notes' resources folders are replaced by hard
+    links to the stored copies, so the notes themselves don't change. If
+    hard links can't be made (e.g. on some network filesystems), the
+    attachment is deleted and the note's links to it are rewritten to
+    point to the stored copy instead; such notes can't be moved to other
+    folders with merge.
+
+    add_note may be called from several threads at once.
+    """
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        self.blobs = self.folder.joinpath(BLOBS_DIR_NAME)
+        self.blobs.mkdir(parents=True, exist_ok=True)
+
+    def _link(self, path, blob):
+        """Makes path a hard link to blob, storing path as blob if it's the
+        first copy. Returns True if path was a duplicate of a stored copy,
+        False if it was stored (or was already a link to blob), or None if
+        hard links aren't supported."""
+        try:
+            os.link(path, blob)
+            return False
+        except FileExistsError:
+            pass
+        except OSError:
+            return None
+        if os.path.samefile(path, blob):
+            return False
+        tmp = path.with_name(f'.{path.name}.link')
+        try:
+            os.link(blob, tmp)
+        except OSError:
+            return None
+        os.replace(tmp, path)
+        return True
+
+    def add_note(self, path):
+        """Stores the attachments of the HTML file at path, and returns the
+        number of bytes freed by replacing duplicates."""
+        path = Path(path)
+        respath = path.with_name(f'{path.name}.resources')
+        if not respath.is_dir():
+            return 0
+        freed = 0
+        relinked = {}
+        with profiling.span('dedup_note', path=str(path)) as span:
+            for resource in respath.iterdir():
+                if not resource.is_file() or resource.is_symlink():
+                    continue
+                blob = self.blobs.joinpath(
+                    hash_file(resource) + resource.suffix.lower())
+                existed = blob.exists()
+                if existed and os.path.samefile(resource, blob):
+                    continue
+                size = resource.stat().st_size
+                # Another thread may store the same blob in the meantime,
+                # so whether this copy was a duplicate is decided by _link.
+                duplicate = self._link(resource, blob)
+                if duplicate is not None:
+                    freed += size if duplicate else 0
+                    continue
+                if existed:
+                    resource.unlink()
+                    freed += size
+                else:
+                    os.replace(resource, blob)
+                relinked[f'{quote(respath.name)}/{quote(resource.name)}'] = (
+                    f'{quote(BLOBS_DIR_NAME)}/{quote(blob.name)}')
+            if relinked:
+                pattern = re.compile(
+                    '|'.join(re.escape(old) for old in relinked))
+                stats = rewrite.rewrite(
+                    path, path, pattern,
+                    lambda match: relinked[match.group(0)],
+                    max(len(old) for old in relinked))
+                span.set(**profiling.stats_args(stats))
+                if not any(respath.iterdir()):
+                    respath.rmdir()
+            span.set(bytes_freed=freed)
+        return freed
+
+
+def dedup_resources(folder, jobs=None):
+    """Stores the attachments of every HTML file in folder in a BlobStore,
+    using a pool of jobs threads, and returns the number of bytes freed.
+    """
+    store = BlobStore(folder)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        return sum(pool.map(store.add_note, Path(folder).glob('*.html')))
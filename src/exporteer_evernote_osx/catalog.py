@@ -0,0 +1,72 @@
+"""Local cache of note metadata fetched from the Evernote app."""
+
+from pathlib import Path
+import sqlite3
+import time
+
+
+DEFAULT_PATH = Path.home().joinpath(
+    '.cache', 'exporteer_evernote_osx', 'catalog.sqlite')
+
+_SCHEMA = """
+create table if not exists queries (
+    query text primary key,
+    fetched real not null
+);
+create table if not exists notes (
+    query text not null,
+    position integer not null,
+    notebook text,
+    link text,
+    title text,
+    created text,
+    updated text,
+    attachments integer,
+    primary key (query, position)
+);
+"""
+
+
+class Catalog:
+    """A SQLite file caching the results of enapp.list_notes per query.
+
+    Results older than ttl_seconds are treated as missing.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, ttl_seconds=60*60):
+        self.path = Path(path)
+        self.ttl_seconds = ttl_seconds
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.path))
+        self.conn.executescript(_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get(self, query):
+        """Returns the cached rows (tuples of NoteMeta fields) for the query,
+        or None if there are none or they have expired."""
+        row = self.conn.execute(
+            'select fetched from queries where query = ?', (query,)).fetchone()
+        if not row or row[0] + self.ttl_seconds < time.time():
+            return None
+        return self.conn.execute(
+            'select notebook, link, title, created, updated, attachments '
+            'from notes where query = ? order by position', (query,)).fetchall()
+
+    def put(self, query, notes):
+        """Replaces the cached results for the query."""
+        with self.conn:
+            self.conn.execute('delete from notes where query = ?', (query,))
+            self.conn.executemany(
+                'insert into notes values (?, ?, ?, ?, ?, ?, ?, ?)',
+                ((query, i, *note) for i, note in enumerate(notes)))
+            self.conn.execute(
+                'insert or replace into queries values (?, ?)',
+                (query, time.time()))
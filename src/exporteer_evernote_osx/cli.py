@@ -2,8 +2,17 @@
 
 
 import argparse
+from pathlib import Path
 import sys
-from exporteer_evernote_osx import enapp
+from exporteer_evernote_osx import (
+    archive, blobs, catalog, enapp, enex, profiling, watch)
+
+
+def _prepare_export_target(args):
+    path = Path(args.path[0])
+    if args.archive or (args.enex and not args.by_notebook):
+        path = path.parent
+    path.mkdir(parents=True, exist_ok=True)
 
 
 def _export(args):
@@ -12,12 +21,111 @@ def _export(args):
     else:
         fmt = 'HTML'
 
-    if args.enhanced:
-        if not enapp.export_enhanced(args.path[0], fmt, args.query, args.timeout):
+    if args.batch_size and not (args.enhanced or args.shard_by):
+        print('--batch-size can only be used with --enhanced or --shard-by',
+              file=sys.stderr)
+        return 1
+
+    if args.via_enex and not args.enhanced:
+        print('--via-enex can only be used with --enhanced', file=sys.stderr)
+        return 1
+
+    if args.dedup and not args.enhanced:
+        print('--dedup can only be used with --enhanced', file=sys.stderr)
+        return 1
+
+    if args.archive and (not args.enhanced or args.batch_size
+                         or args.via_enex or args.dedup):
+        print('--archive can only be used with --enhanced, and not with '
+              '--batch-size, --via-enex or --dedup', file=sys.stderr)
+        return 1
+
+    # The mirror and incremental exports load their state while the sync
+    # runs, so they're told to sync themselves.
+    if args.sync_first and not (args.mirror or args.incremental):
+        try:
+            enapp.while_syncing(lambda: _prepare_export_target(args),
+                                timeout_seconds=args.timeout)
+        except enapp.SyncTimeoutException:
+            print('timed out waiting for Evernote app to sync',
+                  file=sys.stderr)
+            return 2
+
+    if args.mirror:
+        if fmt != 'HTML':
+            print('--mirror only supports HTML', file=sys.stderr)
+            return 1
+        try:
+            stats = enapp.export_mirror(args.path[0], args.query,
+                                        args.timeout,
+                                        sync_first=args.sync_first)
+        except enapp.SyncTimeoutException:
+            print('timed out waiting for Evernote app to sync',
+                  file=sys.stderr)
+            return 2
+        print(f'{stats.notes} notes: {stats.written_files} files written, '
+              f'{stats.unchanged_files} unchanged, {stats.deleted_notes} '
+              'notes removed', file=sys.stderr)
+    elif args.incremental:
+        if fmt != 'HTML':
+            print('--incremental only supports HTML', file=sys.stderr)
+            return 1
+        try:
+            enapp.export_incremental(args.path[0], args.incremental,
+                                     args.query, args.timeout,
+                                     sync_first=args.sync_first)
+        except enapp.SyncTimeoutException:
+            print('timed out waiting for Evernote app to sync',
+                  file=sys.stderr)
+            return 2
+    elif args.enhanced and args.archive:
+        if not enapp.export_enhanced_archive(args.path[0], args.query,
+                                             args.timeout):
+            print('no notes matched query', file=sys.stderr)
+            return 3
+    elif args.enhanced and args.via_enex:
+        if fmt != 'HTML':
+            print('--via-enex only supports HTML', file=sys.stderr)
+            return 1
+        result = enapp.export_enhanced_via_enex(
+            args.path[0], args.query, args.timeout, jobs=args.jobs,
+            dedup=args.dedup)
+        for notebook, title in result.unmatched:
+            print(f'no link found for note "{title}" in {notebook}; its '
+                  'evernote-url will be empty', file=sys.stderr)
+        for notebook, title, error in result.skipped:
+            print(f'skipped note "{title}" in {notebook}, which could not '
+                  f'be converted: {error}', file=sys.stderr)
+        if not result.notes:
+            print('no notes matched query', file=sys.stderr)
+            return 3
+    elif args.enhanced and args.batch_size:
+        if not enapp.export_enhanced_batched(args.path[0], fmt, args.query,
+                                             args.timeout, args.batch_size,
+                                             dedup=args.dedup):
             print('no notes matched query', file=sys.stderr)
             return 3
+    elif args.enhanced:
+        if not enapp.export_enhanced(args.path[0], fmt, args.query, args.timeout,
+                                     dedup=args.dedup):
+            print('no notes matched query', file=sys.stderr)
+            return 3
+    elif args.shard_by:
+        timings = enapp.export_sharded(
+            args.path[0], fmt, args.query, args.timeout, args.shard_by,
+            shard_notes=args.batch_size or 2000, jobs=args.jobs)
+        if timings is None:
+            print('no notes matched query', file=sys.stderr)
+            return 3
+        for timing in timings:
+            print(f'{timing.seconds:8.1f}s {timing.notes:6d} notes  '
+                  f'{" / ".join(timing.queries)}', file=sys.stderr)
     elif args.by_notebook:
-        enapp.export_by_notebook(args.path[0], fmt, args.query, args.timeout)
+        timings = enapp.export_by_notebook(args.path[0], fmt, args.query,
+                                           args.timeout, jobs=args.jobs)
+        for timing in timings:
+            print(f'{timing.seconds:8.1f}s {timing.notes:6d} notes  '
+                  f'{", ".join(timing.notebooks)}', file=sys.stderr)
     elif not enapp.export(args.path[0], fmt, args.query, args.timeout):
         print('no notes matched query', file=sys.stderr)
         return 3
@@ -25,6 +133,18 @@ def _export(args):
     return 0
 
 
+def _catalog(args):
+    if args.no_cache:
+        notes = enapp.list_notes(args.query, args.timeout)
+    else:
+        with catalog.Catalog(args.cache, ttl_seconds=args.ttl) as cat:
+            notes = enapp.list_notes(args.query, args.timeout, catalog=cat)
+    for note in notes:
+        print('\t'.join([note.link, note.notebook, note.created,
+                         note.updated, str(note.attachments), note.title]))
+    return 0
+
+
 def _notebooks(args):
     for name in enapp.list_notebooks():
         print(name)
@@ -32,12 +152,34 @@ def _notebooks(args):
 
 
 def _merge(args):
-    enapp.merge(args.srcdirs, args.destdir[0])
+    if args.dry_run:
+        for src, target in enapp.plan_merge(args.srcdirs, args.destdir[0]):
+            print(f'{src} -> {target}')
+        return 0
+    enapp.merge(args.srcdirs, args.destdir[0], jobs=args.jobs,
+                dedup=args.dedup)
+    return 0
+
+
+def _dedup(args):
+    freed = blobs.dedup_resources(args.path[0], jobs=args.jobs)
+    print(f'freed {freed / 2**20:.1f} MiB', file=sys.stderr)
     return 0
 
 
 def _relink(args):
-    enapp.relink(args.path[0])
+    enapp.relink(args.path[0], jobs=args.jobs, rebuild=args.rebuild,
+                 backlinks=args.backlinks)
+    return 0
+
+
+def _split_enex(args):
+    dest = Path(args.destdir[0])
+    dest.mkdir(parents=True, exist_ok=True)
+    with open(dest.joinpath('index.jsonl'), 'w') as index_file:
+        for src in args.files:
+            enex.split_enex(src, dest.joinpath(Path(src).stem), index_file,
+                            resources=args.resources)
     return 0
 
 
@@ -55,6 +197,16 @@ def _sync(args):
     return 0
 
 
+def _watch(args):
+    try:
+        watch.watch(args.path[0], args.query, args.interval, args.timeout,
+                    sync=not args.no_sync, jobs=args.jobs,
+                    status_file=args.status)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
 def main(args=None):
     """Runs the tool and returns its exit code.
 
@@ -63,6 +215,11 @@ def main(args=None):
     """
     parser = argparse.ArgumentParser()
     parser.set_defaults(func=None)
+    parser.add_argument(
+        '--profile', metavar='FILE',
+        help='write a trace of the time spent in AppleScript calls and '
+             'file processing to FILE (in Chrome trace event format), and '
+             'print a summary to stderr')
 
     subs = parser.add_subparsers(title='Commands')
 
@@ -93,18 +250,119 @@ def main(args=None):
         '-n', '--by-notebook', action='store_true',
         help='export each notebook to a separate file/directory within '
              'target directory')
+    p_export_strategies.add_argument(
+        '-I', '--incremental', metavar='STATE_FILE',
+        help='like --enhanced, but only export notes modified since the '
+             'date recorded in STATE_FILE by the previous run, replacing '
+             'their existing files in the target directory')
+    p_export_strategies.add_argument(
+        '-m', '--mirror', action='store_true',
+        help='like --enhanced, but only write the files that changed since '
+             'the previous mirror export to the target directory, remove '
+             'notes that no longer match the query, and swap the changes '
+             'into place at once')
+    p_export_strategies.add_argument(
+        '--shard-by', choices=enapp.SHARD_FIELDS,
+        help='split the query into shards by date or notebook, export each '
+             'with a separate call (the timeout applies to each), and '
+             'combine them into the target file or directory; an '
+             'interrupted export can be resumed by running the same '
+             'command again')
     p_export.add_argument(
         '-t', '--timeout', nargs='?', type=int,
         help='timeout for export operations (default 1800 = 30 min)')
-    p_export.set_defaults(func=_export, query='', timeout=30*60)
+    p_export.add_argument(
+        '-s', '--sync-first', action='store_true',
+        help='tell the app to synchronize, and wait for it to finish '
+             '(within the timeout) before exporting, preparing the target '
+             'directory (and loading the state of a mirror or incremental '
+             'export) in the meantime')
+    p_export.add_argument(
+        '-b', '--batch-size', type=int,
+        help='with --enhanced, export this many notes per AppleScript call '
+             'and merge each batch into the target directory as it '
+             'finishes; an interrupted export can be resumed by running the '
+             'same command again. With --shard-by, the number of notes to '
+             'aim for in each shard (default 2000)')
+    p_export.add_argument(
+        '--via-enex', action='store_true',
+        help='with --enhanced, export each notebook as enex and convert '
+             'the notes to html locally, which is much faster for large '
+             'exports (the query must not contain "notebook")')
+    p_export.add_argument(
+        '-a', '--archive', action='store_true',
+        help='with --enhanced, write the notes into a new archive at the '
+             'target path instead of a directory, adding each note as soon '
+             'as it is exported; the format is chosen by the file '
+             'extension: ' + ', '.join(archive.SUFFIXES) + ' (.tar.zst '
+             'requires the zstandard package)')
+    p_export.add_argument(
+        '-D', '--dedup', action='store_true',
+        help='with --enhanced, store one copy of each distinct attachment '
+             'in the .blobs folder of the target directory, and hard link '
+             'the notes\' attachments to it')
+    p_export.add_argument(
+        '-j', '--jobs', type=int,
+        help='with --by-notebook, --via-enex or --shard-by, number of '
+             'notebooks or shards to export concurrently (default 1)')
+    p_export.set_defaults(func=_export, query='', timeout=30*60, jobs=1)
+
+    p_catalog = subs.add_parser(
+        'catalog',
+        help='list metadata of notes (link, notebook, created, updated, '
+             'attachment count and title, separated by tabs)')
+    p_catalog.add_argument(
+        '-q', '--query', nargs='?',
+        help='Evernote query for notes to list (defaults to all notes)')
+    p_catalog.add_argument(
+        '-c', '--cache',
+        help='path to cache file '
+             '(default ~/.cache/exporteer_evernote_osx/catalog.sqlite)')
+    p_catalog.add_argument(
+        '-n', '--no-cache', action='store_true',
+        help='always ask the app, and do not update the cache')
+    p_catalog.add_argument(
+        '--ttl', type=int,
+        help='seconds for which cached results are used (default 3600)')
+    p_catalog.add_argument(
+        '-t', '--timeout', nargs='?', type=int,
+        help='timeout for the app to respond (default 1800 = 30 min)')
+    p_catalog.set_defaults(func=_catalog, query='', cache=catalog.DEFAULT_PATH,
+                           ttl=60*60, timeout=30*60)
 
     p_merge = subs.add_parser(
         'merge',
         help='merge HTML export folders')
     p_merge.add_argument('destdir', nargs=1, help='target directory to move files into')
     p_merge.add_argument('srcdirs', nargs='+', help='export directories to combine')
+    p_merge.add_argument(
+        '-d', '--dry-run', action='store_true',
+        help='print the files that would be moved, and their new paths, '
+             'without moving anything')
+    p_merge.add_argument(
+        '-j', '--jobs', type=int,
+        help='number of files to move in parallel')
+    p_merge.add_argument(
+        '-D', '--dedup', action='store_true',
+        help='store one copy of each distinct attachment in the .blobs '
+             'folder of the target directory, and hard link the notes\' '
+             'attachments to it')
     p_merge.set_defaults(func=_merge)
 
+    p_dedup = subs.add_parser(
+        'dedup',
+        help='store one copy of each distinct attachment of the html files '
+             'in a directory, in its .blobs folder, and hard link the notes\' '
+             'attachments to it')
+    p_dedup.add_argument(
+        'path', nargs=1,
+        help='path to directory, which should have been produced by '
+             'running `exporteer_evernote_osx export -e` previously')
+    p_dedup.add_argument(
+        '-j', '--jobs', type=int,
+        help='number of files to process in parallel')
+    p_dedup.set_defaults(func=_dedup)
+
     p_notebooks = subs.add_parser(
         'notebooks',
         help='list notebooks')
@@ -119,24 +377,90 @@ def main(args=None):
         'path', nargs=1,
         help='path to directory, which should have been produced by '
              'running `exporteer_evernote_osx export -e` previously')
+    p_relink.add_argument(
+        '-j', '--jobs', type=int,
+        help='number of processes to use (defaults to the number of CPUs)')
+    p_relink.add_argument(
+        '-r', '--rebuild', action='store_true',
+        help='ignore the link index saved by previous runs and rescan '
+             'every file')
+    p_relink.add_argument(
+        '-b', '--backlinks', action='store_true',
+        help='add a list of the notes linking to each note to the end of '
+             'its file')
     p_relink.set_defaults(func=_relink)
 
+    p_split_enex = subs.add_parser(
+        'split-enex',
+        help='split enex files into one enex file per note')
+    p_split_enex.add_argument(
+        'destdir', nargs=1,
+        help='target directory; the notes from each enex file are written '
+             'to a subdirectory named after it, and an index of all the '
+             'notes to index.jsonl')
+    p_split_enex.add_argument(
+        'files', nargs='+',
+        help='enex files to split (e.g. the files produced by '
+             '`exporteer_evernote_osx export -En`, one per notebook)')
+    p_split_enex.add_argument(
+        '-r', '--resources', action='store_true',
+        help='also decode attachments into a folder beside each note')
+    p_split_enex.set_defaults(func=_split_enex)
+
     p_sync = subs.add_parser(
         'sync',
         help='tell app to synchronize and wait for it to finish')
     p_sync.add_argument(
-        '-d', '--delay', nargs=1, type=int,
-        help='seconds to wait between each poll (default 10)')
+        '-d', '--delay', type=float,
+        help='maximum seconds to wait between each poll; polling starts '
+             'after half a second and backs off to this (default 10)')
     p_sync.add_argument(
         '-i', '--immediate', action='store_true',
         help='return immediately without waiting for sync to finish')
     p_sync.add_argument(
-        '-t', '--timeout', nargs=1, type=int,
+        '-t', '--timeout', type=int,
         help='seconds to wait before failing (default 1800 = 30 min)')
-    p_sync.set_defaults(func=_sync)
+    p_sync.set_defaults(func=_sync, delay=10, timeout=30*60)
+
+    p_watch = subs.add_parser(
+        'watch',
+        help='keep an enhanced export up to date, by periodically syncing '
+             'and exporting the notes modified since the previous cycle')
+    p_watch.add_argument(
+        'path', nargs=1,
+        help='path to target directory')
+    p_watch.add_argument(
+        '-q', '--query', nargs='?',
+        help='Evernote query for notes to export (defaults to all notes)')
+    p_watch.add_argument(
+        '-i', '--interval', type=float,
+        help='seconds between the starts of cycles (default 300)')
+    p_watch.add_argument(
+        '-n', '--no-sync', action='store_true',
+        help='do not tell the app to sync before each cycle')
+    p_watch.add_argument(
+        '-s', '--status', metavar='FILE',
+        help='file to write the status to, as JSON '
+             '(default TARGET/.watch-status.json)')
+    p_watch.add_argument(
+        '-j', '--jobs', type=int,
+        help='number of processes to use for relinking (defaults to the '
+             'number of CPUs)')
+    p_watch.add_argument(
+        '-t', '--timeout', type=int,
+        help='timeout for each sync and export (default 1800 = 30 min)')
+    p_watch.set_defaults(func=_watch, query='', interval=5*60,
+                         timeout=30*60)
 
     args = parser.parse_args(args)
     if not args.func:
         parser.print_help()
         return 1
-    return args.func(args)
+    if not args.profile:
+        return args.func(args)
+    profiling.start(args.profile)
+    try:
+        with profiling.span(args.func.__name__.lstrip('_')):
+            return args.func(args)
+    finally:
+        profiling.stop()
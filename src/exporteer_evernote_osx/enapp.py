@@ -1,11 +1,28 @@
 """Allows interacting with the Evernote OSX app."""
 
+import atexit
+from collections import namedtuple
+from concurrent.futures import (
+    ProcessPoolExecutor, ThreadPoolExecutor, as_completed)
+import ctypes
+from datetime import date, datetime, timedelta
+import errno
+from html import escape, unescape
+import json
+import os
 from pathlib import Path
+import random
 import re
+import shutil
 from string import Template
-import subprocess
+import sys
+from tempfile import TemporaryDirectory
 import time
-from urllib.parse import quote
+import unicodedata
+from urllib.parse import quote, unquote
+from xml.etree import ElementTree
+from exporteer_evernote_osx import (
+    archive, blobs, enex, profiling, rewrite, transport)
 
 
 _START_SYNC_SCRIPT = """
@@ -44,73 +61,325 @@ _EXPORT_BY_NOTE_SCRIPT = Template("""
 tell application "Evernote"
     with timeout of $timeout seconds
         set results to (find notes "$query")
-        set metaList to {}
-        set theNoteIndex to 1
-        repeat with theNote in results
-            set metaText to (name of notebook of theNote) & "~" & (note link of theNote)
-            set metaList to metaList & {metaText}
-            export {theNote} to (POSIX file ("$dest/" & theNoteIndex)) format $fmt
-            set theNoteIndex to theNoteIndex + 1
-        end repeat
-        metaList
+        set lastIndex to count of results
+        if $limit > 0 and lastIndex > $start + $limit - 1 then
+            set lastIndex to $start + $limit - 1
+        end if
+        set sep to character id 31
+        set metaFile to open for access (POSIX file "$meta") with write permission
+        set eof of metaFile to 0
+        try
+            repeat with theNoteIndex from $start to lastIndex
+                set theNote to item theNoteIndex of results
+                set folderIndex to theNoteIndex - $start + 1
+                set metaText to (folderIndex as text) & sep & (name of notebook of theNote) & sep & (note link of theNote) & sep & (title of theNote) & sep & ((creation date of theNote) as «class isot» as string) & sep & ((modification date of theNote) as «class isot» as string) & linefeed
+                write metaText to metaFile as «class utf8»
+                export {theNote} to (POSIX file ("$dest/" & folderIndex)) format $fmt
+            end repeat
+        on error errMsg number errNum
+            close access metaFile
+            error errMsg number errNum
+        end try
+        close access metaFile
+    end timeout
+end tell
+""")
+
+# Name of the file within export_enhanced's tmp directory to which the
+# script writes one line of metadata per note. Fields are separated by
+# the ASCII unit separator, which shouldn't appear in names or titles.
+_META_SIDECAR_NAME = 'notes.meta'
+
+_META_SIDECAR_SEP = '\x1f'
+
+# How often export_enhanced checks the sidecar for newly exported notes.
+_EXPORT_POLL_SECONDS = 0.5
+
+_LIST_NOTES_SCRIPT = Template("""
+tell application "Evernote"
+    with timeout of $timeout seconds
+        set results to (find notes "$query")
+        set sep to character id 31
+        set metaFile to open for access (POSIX file "$meta") with write permission
+        try
+            set theNoteIndex to 1
+            repeat with theNote in results
+                set metaText to (theNoteIndex as text) & sep & (name of notebook of theNote) & sep & (note link of theNote) & sep & (title of theNote) & sep & ((creation date of theNote) as «class isot» as string) & sep & ((modification date of theNote) as «class isot» as string) & sep & ((count of attachments of theNote) as text) & linefeed
+                write metaText to metaFile as «class utf8»
+                set theNoteIndex to theNoteIndex + 1
+            end repeat
+        on error errMsg number errNum
+            close access metaFile
+            error errMsg number errNum
+        end try
+        close access metaFile
+    end timeout
+end tell
+""")
+
+_COUNT_BY_NOTEBOOK_SCRIPT = Template("""
+tell application "Evernote"
+    with timeout of $timeout seconds
+        set sep to character id 31
+        set countFile to open for access (POSIX file "$out") with write permission
+        try
+            repeat with theNotebook in notebooks
+                set theName to name of theNotebook
+                set theCount to count of (find notes ("notebook:\\"" & theName & "\\" $query"))
+                write (theName & sep & (theCount as text) & linefeed) to countFile as «class utf8»
+            end repeat
+        on error errMsg number errNum
+            close access countFile
+            error errMsg number errNum
+        end try
+        close access countFile
+    end timeout
+end tell
+""")
+
+_EXPORT_NOTEBOOKS_SCRIPT = Template("""
+tell application "Evernote"
+    with timeout of $timeout seconds
+$exports
     end timeout
 end tell
 """)
 
+_EXPORT_NOTEBOOK_LINE = Template(
+    '        export (find notes "$query") to (POSIX file "$dest") format $fmt')
+
+_COUNT_QUERIES_SCRIPT = Template("""
+tell application "Evernote"
+    with timeout of $timeout seconds
+        set countFile to open for access (POSIX file "$out") with write permission
+        try
+$counts
+        on error errMsg number errNum
+            close access countFile
+            error errMsg number errNum
+        end try
+        close access countFile
+    end timeout
+end tell
+""")
+
+_COUNT_QUERY_LINE = Template(
+    '            write (((count of (find notes "$query")) as text) & linefeed) '
+    'to countFile as «class utf8»')
+
 # This is a very hacky/incomplete way of parsing AppleScript results,
 # and would give wrong results for notebook names containing quotation
 # marks.
 _NOTEBOOK_NAMES_RE = re.compile('"(.+?)"')
 
-# And this would give wrong results if you have quotes or tildes...
-_EXTRA_META_RE = re.compile('"(.+?)~(.+?)"')
+
+NoteMeta = namedtuple(
+    'NoteMeta',
+    ['notebook', 'link', 'title', 'created', 'updated', 'attachments'],
+    defaults=(None,))
+NoteMeta.__doc__ = """Metadata about a note, as reported by the app.
+
+created and updated are ISO 8601 strings in the app's local time.
+attachments is the number of attachments, which is only filled in by
+list_notes.
+"""
 
 
 URL_META_RE = re.compile('<meta name="evernote-url" content="([^"]+)')
 
+RELINK_INDEX_NAME = '.relink-index.json'
+
+LINK_GRAPH_NAME = '.link-graph.json'
+
+EXPORT_JOURNAL_NAME = '.export-journal.json'
+
+SHARD_FIELDS = ['created', 'updated', 'notebook']
+
+# export_sharded first counts notes by calendar year from this year up
+# to the next one; anything earlier falls into one open-ended range.
+_SHARD_FIRST_YEAR = 2000
+
+MIRROR_MANIFEST_NAME = '.mirror-manifest.json'
+
+_MIRROR_MANIFEST_VERSION = 1
+
+_RELINK_INDEX_VERSION = 1
+
+LINK_RE = re.compile('evernote://[^\\s"\'<>]+')
+
+_BACKLINKS_START = '<!--evernote-backlinks-->'
+
+_BACKLINKS_END = '<!--/evernote-backlinks-->'
+
+_RELINK_SCAN_RE = re.compile(
+    f'{URL_META_RE.pattern}|<title>([^<]*)|</head>|{LINK_RE.pattern}'
+    f'|href="(?!evernote:)([^"]*)|{_BACKLINKS_START}|{_BACKLINKS_END}')
+
+_HEAD_URL_RE = re.compile(f'{URL_META_RE.pattern}|</head>')
+
+_RELINK_REWRITE_RE = re.compile(f'</head>|{LINK_RE.pattern}')
+
+_LINK_GRAPH_VERSION = 1
+
+_RELINK_BACKLINKS_RE = re.compile(
+    f'</head>|{_BACKLINKS_START}|{_BACKLINKS_END}|</body>|{LINK_RE.pattern}')
+
+_RELINK_SCAN_OVERLAP = 64
+
 
 class SyncTimeoutException(Exception):
     pass
 
 
+_runner = None
+
+
+def get_runner():
+    """Returns the transport.ScriptRunner used to send scripts to the app.
+
+    Unless set_runner has been called, this is a transport.PersistentRunner
+    that is created on first use and closed when the interpreter exits.
+    """
+    global _runner
+    if _runner is None:
+        _runner = transport.PersistentRunner()
+        atexit.register(_runner.close)
+    return _runner
+
+
+def set_runner(runner):
+    """Sets the transport.ScriptRunner used by all the functions in this
+    module (for example, transport.OsascriptRunner to start a separate
+    osascript process for each script, or a fake for testing)."""
+    global _runner
+    _runner = runner
+
+
+def _run_script(script):
+    with profiling.span('osascript', script_bytes=len(script)):
+        return get_runner().run(script)
+
+
 def start_sync():
     """Tells the Evernote app to start synchronizing."""
-    subprocess.check_call(['osascript', '-e', _START_SYNC_SCRIPT])
+    _run_script(_START_SYNC_SCRIPT)
 
 
 def check_sync():
     """Returns True if the Evernote app is currently synchronizing."""
-    out = subprocess.check_output(['osascript', '-e', _CHECK_SYNC_SCRIPT])
+    out = _run_script(_CHECK_SYNC_SCRIPT)
     return out.strip() == 'true'
 
 
-def await_sync(timeout_seconds=60*30, delay_seconds=10):
+def _poll_delays(initial_seconds, max_seconds, jitter=0.25):
+    """Yields delays between polls, doubling from initial_seconds up to
+    max_seconds, each randomly shortened by up to the fraction jitter."""
+    delay = min(initial_seconds, max_seconds)
+    while True:
+        yield delay * (1 - jitter * random.random())
+        delay = min(delay * 2, max_seconds)
+
+
+def _sync_waits(start, timeout_seconds, delay_seconds,
+                initial_delay_seconds):
+    """Yields how long await_sync should sleep after each check finding
+    the app still synchronizing, and raises SyncTimeoutException once
+    timeout_seconds have passed since start (a time.monotonic() value)."""
+    for delay in _poll_delays(initial_delay_seconds, delay_seconds):
+        remaining = None
+        if timeout_seconds is not None:
+            remaining = start + timeout_seconds - time.monotonic()
+            if remaining <= 0:
+                raise SyncTimeoutException(
+                    f'waited {timeout_seconds} seconds but sync did not '
+                    'finish')
+        yield delay if remaining is None else min(delay, remaining)
+
+
+def await_sync(timeout_seconds=60*30, delay_seconds=10,
+               initial_delay_seconds=0.5):
     """If the Evernote app is synchronizing, waits for it to finish.
 
-    This method will repeatedly poll app at an interval of delay_seconds.
-    If synchronization has not finished before timeout_seconds elapses,
-    SyncTimeoutException is raised.
+    This method will repeatedly poll the app, first after
+    initial_delay_seconds and then at intervals doubling up to
+    delay_seconds (each shortened by a random amount, so that several
+    waiting processes don't poll in step). If synchronization has not
+    finished before timeout_seconds elapses, SyncTimeoutException is
+    raised; timeout_seconds may be None to wait indefinitely.
     """
-    start = time.time()
+    waits = _sync_waits(time.monotonic(), timeout_seconds, delay_seconds,
+                        initial_delay_seconds)
     while check_sync():
-        if start + timeout_seconds < time.time():
-            raise SyncTimeoutException(
-                f'waited {timeout_seconds} seconds but sync did not finish')
-        time.sleep(delay_seconds)
+        time.sleep(next(waits))
+
+
+def while_syncing(func, timeout_seconds=60*30, delay_seconds=10):
+    """Tells the app to start synchronizing, and calls func while waiting
+    for it to finish (see await_sync) in another thread.
+
+    This lets work that doesn't depend on the synchronized notes overlap
+    with the sync. Returns func's result once both are done.
+    """
+    start_sync()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        waiting = pool.submit(await_sync, timeout_seconds, delay_seconds)
+        try:
+            result = func()
+        finally:
+            waiting.result()
+    return result
 
 
 def list_notebooks():
     """Returns a list of notebook names.
     """
-    out = subprocess.check_output(
-        ['osascript', '-e', _LIST_NOTEBOOKS_SCRIPT, '-ss'])
-    return _NOTEBOOK_NAMES_RE.findall(str(out, 'utf-8'))
+    out = _run_script(_LIST_NOTEBOOKS_SCRIPT)
+    return _NOTEBOOK_NAMES_RE.findall(out)
+
+
+def list_notes(query='', timeout_seconds=30*60, catalog=None):
+    """Returns a list of NoteMeta for the notes matching the query.
+
+    The metadata for all the notes is fetched with a single AppleScript
+    call. If catalog (a catalog.Catalog) is given, unexpired results
+    for the same query are returned from it instead, and new results
+    are stored in it.
+    """
+    if catalog:
+        rows = catalog.get(query)
+        if rows is not None:
+            return [NoteMeta(*row) for row in rows]
+    with TemporaryDirectory() as tmp:
+        meta_path = Path(tmp).joinpath(_META_SIDECAR_NAME)
+        meta_path.touch()
+        script = _LIST_NOTES_SCRIPT.substitute({
+            'meta': _script_escape(str(meta_path)),
+            'query': _script_escape(query),
+            'timeout': timeout_seconds,
+        })
+        _run_script(script)
+        notes = []
+        with open(meta_path, encoding='utf-8', newline='\n') as meta_file:
+            for line in meta_file:
+                _, meta = _parse_meta_line(line.rstrip('\n'))
+                notes.append(meta._replace(attachments=int(meta.attachments)))
+    if catalog:
+        catalog.put(query, notes)
+    return notes
 
 
 def _script_escape(string):
     return string.replace('\\', '\\\\').replace('"', '\\"')
 
 
+def write_json_atomic(path, data):
+    """Writes data as JSON to the file at path (a Path), replacing it in
+    one step, so that readers never see it partly written."""
+    tmp = path.with_name(f'{path.name}.tmp')
+    tmp.write_text(json.dumps(data))
+    os.replace(tmp, path)
+
+
 def export(dest, fmt='HTML', query='', timeout_seconds=30*60):
     """Exports notes. Returns False if no notes match the query.
 
@@ -125,20 +394,221 @@ def export(dest, fmt='HTML', query='', timeout_seconds=30*60):
     If there are no matches, the method returns False and there may be
     no output files.
     """
+    return _run_script(_export_script(dest, fmt, query, timeout_seconds)) \
+        == 'true'
+
+
+def _export_script(dest, fmt, query, timeout_seconds):
     dest = Path(dest).resolve()
     dest_esc = _script_escape(str(dest))
     query_esc = _script_escape(query)
-    script = _EXPORT_SCRIPT.substitute({
+    return _EXPORT_SCRIPT.substitute({
         'dest': dest_esc,
         'fmt': fmt,
         'query': query_esc,
         'timeout': timeout_seconds,
     })
-    result = subprocess.check_output(['osascript', '-e', script, '-ss'])
-    return str(result, 'utf-8').strip() == 'true'
 
 
-def export_enhanced(dest, fmt='HTML', query='', timeout_seconds=30*60):
+def _parse_meta_line(line):
+    """Parses a line written by _EXPORT_BY_NOTE_SCRIPT to the metadata
+    sidecar, returning the note's export folder index and a NoteMeta."""
+    index, *fields = line.split(_META_SIDECAR_SEP)
+    return int(index), NoteMeta(*fields)
+
+
+def _name_key(name):
+    # The default Mac filesystem is case- and normalization-insensitive.
+    return unicodedata.normalize('NFD', name).casefold()
+
+
+class _NameAllocator:
+    """Chooses names for HTML files in a directory that don't collide with
+    existing files or with names chosen earlier.
+
+    The directory is listed only once, so this assumes nothing else adds
+    files to it in the meantime.
+    """
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        if self.folder.is_dir():
+            self.taken = {_name_key(n) for n in os.listdir(self.folder)}
+        else:
+            self.taken = set()
+        self.next_prefix = {}
+
+    def allocate(self, name):
+        """Reserves a name based on the given one and returns its path."""
+        # Evernote's export will go right up to the max filename limit, but
+        # then we have problems when we try to append the '.resources' suffix.
+        # To keep things simple, truncate the name to a more manageable length.
+        name = f'{Path(name).stem[0:70]}.html'
+        key = _name_key(name)
+        candidate = name
+        prefix = self.next_prefix.get(key, 2)
+        while _name_key(candidate) in self.taken:
+            candidate = f'{prefix}-{name}'
+            prefix += 1
+        self.next_prefix[key] = prefix
+        self.taken.add(_name_key(candidate))
+        return self.folder.joinpath(candidate)
+
+
+def _copy_synced(src, dest):
+    shutil.copy2(src, dest)
+    with open(dest, 'rb') as file:
+        os.fsync(file.fileno())
+    return dest
+
+
+def _move(src, dest):
+    """Renames src (a file or directory) to dest, falling back to copying
+    it if they are on different filesystems."""
+    try:
+        os.rename(src, dest)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        if Path(src).is_dir():
+            shutil.copytree(src, dest, copy_function=_copy_synced)
+            shutil.rmtree(src)
+        else:
+            _copy_synced(src, dest)
+            os.unlink(src)
+
+
+def _meta_tags(meta):
+    notebook = escape(meta.notebook)
+    return (f'<meta name="evernote-notebook" content="{notebook}"/>'
+            f'<meta name="evernote-url" content="{meta.link}"/>')
+
+
+def _resource_and_head_rewriter(old_resources, new_resources, head=''):
+    """Returns the arguments for rewrite.rewrite that will replace the
+    quoted name of a resources folder, and append head to the <head> tag.
+    """
+    alternatives = ['<head>']
+    if old_resources != new_resources:
+        alternatives.append(re.escape(quote(old_resources)))
+    pattern = re.compile('|'.join(alternatives))
+    seen_head = False
+
+    def replace(match):
+        nonlocal seen_head
+        if match.group(0) == '<head>':
+            if seen_head:
+                return match.group(0)
+            seen_head = True
+            return f'<head>{head}'
+        return quote(new_resources)
+
+    overlap = max(len('<head>'), len(quote(old_resources)))
+    return pattern, replace, overlap
+
+
+def _finish_exported_note(folder, meta, allocator):
+    """Moves a note from one of export_enhanced's numbered tmp folders
+    into the allocator's folder, adding the metadata tags, and removes
+    the folder.
+
+    The HTML file is streamed through a single rewrite. Returns its new
+    path, or None if the folder contained no HTML file.
+    """
+    newpath = None
+    with profiling.span('finish_note', note=meta.link) as span:
+        for path in folder.glob('*.html'):
+            newpath = allocator.allocate(path.name)
+            respath = None
+            # Previously this code simply appended `.resources` to path.name
+            # and checked if that file exists. However, that causes an error
+            # when the filename exceeds the maximum filename length. And in
+            # such cases, Evernote appears to truncate the stem of the
+            # resource folder name more than it truncates the name of the
+            # HTML file, so that the two do not necessarily match.
+            for p in folder.glob('*.resources'):
+                respath = p
+            oldresname = newresname = ''
+            if respath:
+                newrespath = newpath.with_name(f'{newpath.name}.resources')
+                respath.rename(newrespath)
+                oldresname, newresname = respath.name, newrespath.name
+            stats = rewrite.rewrite(path, newpath, *_resource_and_head_rewriter(
+                oldresname, newresname, _meta_tags(meta)))
+            span.set(path=str(newpath), **profiling.stats_args(stats))
+            path.unlink()
+        folder.rmdir()
+    return newpath
+
+
+def _prepare_enhanced_export(dest, fmt, query, timeout_seconds, start, limit):
+    """Creates export_enhanced's tmp folder and metadata sidecar within
+    dest, and returns their paths and the script to run."""
+    if not fmt == 'HTML':
+        raise ValueError('Enhanced export currently only supports HTML mode.')
+    tmp = dest.joinpath('tmp')
+    # A failed export leaves its sidecar and unfinished notes behind,
+    # which would otherwise be taken for this export's.
+    if tmp.exists():
+        shutil.rmtree(tmp)
+    tmp.mkdir(parents=True)
+    tmp_esc = _script_escape(str(tmp))
+    query_esc = _script_escape(query)
+    meta_path = tmp.joinpath(_META_SIDECAR_NAME)
+    meta_path.write_bytes(b'')
+    script = _EXPORT_BY_NOTE_SCRIPT.substitute({
+        'dest': tmp_esc,
+        'fmt': fmt,
+        'limit': int(limit),
+        'meta': _script_escape(str(meta_path)),
+        'query': query_esc,
+        'start': int(start),
+        'timeout': timeout_seconds,
+    })
+    return tmp, meta_path, script
+
+
+class _SidecarTail:
+    """Follows the metadata sidecar written by export_enhanced's script,
+    to find out which notes have finished exporting.
+
+    The script writes a note's metadata line just before exporting it,
+    so once the next line appears, the previous note's folder is done.
+    meta_file is the sidecar, opened in binary mode.
+    """
+
+    def __init__(self, tmp, meta_file):
+        self.tmp = tmp
+        self.meta_file = meta_file
+        self.buffered = b''
+        self.pending = None
+        self.found = False
+
+    def poll(self):
+        """Returns a list of (folder, NoteMeta) for the notes that have
+        finished exporting since the previous call."""
+        done = []
+        # The file is read as bytes, since the last line may end partway
+        # through a character.
+        self.buffered += self.meta_file.read()
+        *lines, self.buffered = self.buffered.split(b'\n')
+        for line in lines:
+            if self.pending:
+                done.append(self.pending)
+            index, meta = _parse_meta_line(line.decode('utf-8'))
+            self.pending = (self.tmp.joinpath(str(index)), meta)
+            self.found = True
+        return done
+
+    def last(self):
+        """Returns the (folder, NoteMeta) of the last note, once the
+        script has finished, or None."""
+        last, self.pending = self.pending, None
+        return last
+
+
+def export_enhanced(dest, fmt='HTML', query='', timeout_seconds=30*60,
+                    start=1, limit=0, on_note=None, dedup=False):
     """Exports notes with extra metadata.
     Only HTML format is supported.
 
@@ -148,147 +618,1333 @@ def export_enhanced(dest, fmt='HTML', query='', timeout_seconds=30*60):
     query is the Evernote search query for choosing which notes to export.
     It defaults to an empty string, which should match all notes.
 
+    start and limit may be used to export only a window of the results:
+    the notes from the (1-based) start index onward, at most limit of
+    them (0 means no limit).
+
     This method adds two nonstandard meta tags to each of the HTML files:
     "evernote-notebook" containing the notebook name, and "evernote-url"
     containing the note link (i.e. an evernote:// url).
 
+    Each note is renamed and tagged as soon as the app starts exporting
+    the next one, so that this work overlaps with the export itself.
+    If on_note is given, it is then called with the note's new path and
+    its NoteMeta. If dedup is True, the note's attachments are also added
+    to a blobs.BlobStore for dest, in a background thread.
+
     Returns False if no notes match the query.
     """
-    if not fmt == 'HTML':
-        raise ValueError('Enhanced export currently only supports HTML mode.')
     dest = Path(dest).resolve()
-    tmp = dest.joinpath('tmp')
-    tmp.mkdir(parents=True, exist_ok=True)
-    tmp_esc = _script_escape(str(tmp))
-    query_esc = _script_escape(query)
-    script = _EXPORT_BY_NOTE_SCRIPT.substitute({
-        'dest': tmp_esc,
-        'fmt': fmt,
-        'query': query_esc,
-        'timeout': timeout_seconds,
+    tmp, meta_path, script = _prepare_enhanced_export(
+        dest, fmt, query, timeout_seconds, start, limit)
+    allocator = _NameAllocator(dest)
+    store = blobs.BlobStore(dest) if dedup else None
+    dedup_pool = ThreadPoolExecutor() if dedup else None
+    deduped = []
+
+    def finish(folder, meta):
+        path = _finish_exported_note(folder, meta, allocator)
+        if path and store:
+            deduped.append(dedup_pool.submit(store.add_note, path))
+        if path and on_note:
+            on_note(path, meta)
+
+    with open(meta_path, 'rb') as meta_file:
+        tail = _SidecarTail(tmp, meta_file)
+        future = get_runner().submit(script)
+        while True:
+            exited = future.done()
+            for note in tail.poll():
+                finish(*note)
+            if exited:
+                break
+            time.sleep(_EXPORT_POLL_SECONDS)
+    try:
+        future.result()
+        last = tail.last()
+        if last:
+            finish(*last)
+    finally:
+        if dedup_pool:
+            dedup_pool.shutdown()
+    for dedup_future in deduped:
+        dedup_future.result()
+    meta_path.unlink()
+    tmp.rmdir()
+    return tail.found
+
+
+def export_enhanced_archive(archive_path, query='', timeout_seconds=30*60):
+    """Exports notes with extra metadata (see export_enhanced) into a new
+    tar or zip archive, whose format is chosen by the suffix of
+    archive_path (see archive.SUFFIXES).
+
+    Each note is added to the archive, and deleted, as soon as it has been
+    renamed and tagged, so the disk space needed for the export itself is
+    only about one note's worth. The temporary directory used is created
+    beside archive_path.
+
+    The archive is written to a hidden file beside archive_path, which
+    is renamed to archive_path only once the export has succeeded, so an
+    archive at archive_path is always complete. If the export fails, or
+    no notes match the query, the hidden file is deleted.
+
+    Returns False if no notes match the query.
+    """
+    archive_path = Path(archive_path).resolve()
+    archive_path.parent.mkdir(parents=True, exist_ok=True)
+    # Keeping the name as a suffix keeps the archive format.
+    partial = archive_path.with_name(f'.partial-{archive_path.name}')
+    try:
+        with archive.ArchiveWriter(partial) as writer, \
+                TemporaryDirectory(dir=archive_path.parent,
+                                   prefix='.archive-') as tmp:
+
+            def add_note(path, meta):
+                with profiling.span('archive_note', path=str(path)):
+                    writer.add_note(path)
+
+            found = export_enhanced(tmp, 'HTML', query, timeout_seconds,
+                                    on_note=add_note)
+        if found:
+            os.replace(partial, archive_path)
+        return found
+    finally:
+        if partial.exists():
+            partial.unlink()
+
+
+def export_enhanced_batched(dest, fmt='HTML', query='',
+                            timeout_seconds=30*60, batch_size=200,
+                            dedup=False):
+    """Exports notes with extra metadata, batch_size notes at a time.
+
+    This is like export_enhanced, except the matching notes are exported
+    in windows of batch_size notes, each with a separate AppleScript
+    invocation (and the timeout applies to each window). As each window
+    finishes it is merged into dest, and recorded in a journal file (see
+    EXPORT_JOURNAL_NAME) within dest. If the export is interrupted,
+    calling this again with the same dest, query and batch_size resumes
+    after the last completed window. The journal is removed once every
+    window has been exported. dedup is passed on to merge.
+
+    This assumes the app returns the notes matching the query in the same
+    order each time, so notes should not be added or edited in between.
+
+    Returns False if no notes match the query.
+    """
+    if batch_size < 1:
+        raise ValueError('batch_size must be positive')
+    dest = Path(dest).resolve()
+    dest.mkdir(parents=True, exist_ok=True)
+    journal_path = dest.joinpath(EXPORT_JOURNAL_NAME)
+    journal = {'query': query, 'batch_size': batch_size, 'completed': []}
+    if journal_path.exists():
+        saved = json.loads(journal_path.read_text())
+        if (saved['query'], saved['batch_size']) != (query, batch_size):
+            raise ValueError(
+                f'{journal_path} belongs to an export with a different '
+                'query or batch size')
+        journal = saved
+
+    start = 1
+    while True:
+        if start in journal['completed']:
+            start += batch_size
+            continue
+        window = dest.joinpath(f'.batch-{start}')
+        if window.exists():
+            # Left over from an interrupted run; the notes in it were
+            # never merged, so just export them again.
+            shutil.rmtree(window)
+        if not export_enhanced(str(window), fmt, query, timeout_seconds,
+                               start=start, limit=batch_size):
+            shutil.rmtree(window)
+            break
+        merge([window], dest, dedup=dedup)
+        journal['completed'].append(start)
+        write_json_atomic(journal_path, journal)
+        shutil.rmtree(window)
+        start += batch_size
+
+    if journal_path.exists():
+        journal_path.unlink()
+    return bool(journal['completed'])
+
+
+def _read_note_url(path):
+    """Returns the evernote-url meta tag of an HTML file, or None, reading
+    no further than the end of its head."""
+    with open(path) as file:
+        for _, match in rewrite.iter_matches(
+                file, _HEAD_URL_RE, _RELINK_SCAN_OVERLAP):
+            if match:
+                return match.group(1)
+    return None
+
+
+def _search_date(iso):
+    """Converts an ISO 8601 date from a NoteMeta into the format used in
+    Evernote's search grammar."""
+    return iso.replace('-', '').replace(':', '')
+
+
+def incremental_query(query, state_file):
+    """Returns the state saved in state_file by export_incremental (or an
+    empty dict), and query restricted to notes modified since then."""
+    state_file = Path(state_file)
+    state = {}
+    if state_file.exists():
+        state = json.loads(state_file.read_text())
+    updated = state.get('updated')
+    if updated:
+        # Searches for a time include notes modified at that time, which
+        # were exported last time.
+        after = datetime.fromisoformat(updated) + timedelta(seconds=1)
+        query = f'{query} updated:{_search_date(after.isoformat())}'.strip()
+    return state, query
+
+
+def _note_urls(folder):
+    """Returns a dict mapping the evernote-url of each HTML file in folder
+    to its path.
+
+    The URLs of files that haven't changed since relink last indexed them
+    are taken from its index, so only the heads of other files are read.
+    """
+    indexed = _load_relink_index(folder.joinpath(RELINK_INDEX_NAME))
+    urls = {}
+    for path in folder.glob('*.html'):
+        entry = indexed.get(path.name)
+        stat = path.stat()
+        if entry and entry['mtime_ns'] == stat.st_mtime_ns \
+                and entry['size'] == stat.st_size:
+            url = entry['url']
+        else:
+            url = _read_note_url(path)
+        if url:
+            urls[url] = path
+    return urls
+
+
+def export_incremental(dest, state_file, query='', timeout_seconds=30*60,
+                       on_note=None, sync_first=False):
+    """Exports notes changed since the previous call, with extra metadata.
+
+    This is like export_enhanced, except that state_file (a string path
+    name) records the latest modification date of the exported notes,
+    and later calls only export notes modified since then. An exported
+    note that already has a file in dest (found by its evernote-url meta
+    tag) replaces that file, keeping its name; other notes are merged
+    into dest. On the first call, or if state_file is missing, every
+    note matching the query is exported.
+
+    Notes deleted since the previous call are not removed from dest.
+
+    on_note is passed to export_enhanced, and so is called with the path
+    of each note in a staging folder as soon as it has been exported.
+
+    If sync_first is True, the app is told to synchronize first, and the
+    export starts once it finishes (see while_syncing); meanwhile, the
+    state file is read and the existing files in dest are indexed.
+
+    Returns the number of notes exported.
+    """
+    dest = Path(dest).resolve()
+    state_file = Path(state_file)
+    staging = dest.joinpath('.incremental')
+
+    def prepare():
+        dest.mkdir(parents=True, exist_ok=True)
+        if staging.exists():
+            shutil.rmtree(staging)
+        # Without a sync to wait for, dest is only indexed if any notes
+        # were exported.
+        existing = _note_urls(dest) if sync_first else None
+        return incremental_query(query, state_file) + (existing,)
+
+    if sync_first:
+        state, query, existing = while_syncing(
+            prepare, timeout_seconds=timeout_seconds)
+    else:
+        state, query, existing = prepare()
+    updated = state.get('updated')
+    metas = {}
+
+    def record(path, meta):
+        metas[path] = meta
+        if on_note:
+            on_note(path, meta)
+
+    export_enhanced(str(staging), query=query,
+                    timeout_seconds=timeout_seconds, on_note=record)
+
+    if metas:
+        if existing is None:
+            existing = _note_urls(dest)
+        for path, meta in metas.items():
+            target = existing.get(meta.link)
+            if not target:
+                continue
+            oldres = target.with_name(f'{target.name}.resources')
+            if oldres.exists():
+                shutil.rmtree(oldres)
+            _merge_note(path, target)
+        merge([staging], dest)
+        updated = max([updated or ''] + [m.updated for m in metas.values()])
+        state['updated'] = updated
+        write_json_atomic(state_file, state)
+    shutil.rmtree(staging)
+    return len(metas)
+
+
+MirrorStats = namedtuple(
+    'MirrorStats', ['notes', 'unchanged_files', 'written_files',
+                    'deleted_notes'])
+MirrorStats.__doc__ = """What export_mirror changed: the number of notes
+in the mirror, the number of their files that were kept and written, and
+the number of notes removed."""
+
+
+def _link_or_copy(src, dest):
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+
+def _swap_dirs(a, b):
+    """Exchanges the directories at paths a and b.
+
+    This is atomic on macOS (with APFS) and Linux; elsewhere, a is briefly
+    missing, but is never seen with a mixture of the two contents.
+    """
+    a_bytes, b_bytes = os.fsencode(str(a)), os.fsencode(str(b))
+    libc = ctypes.CDLL(None, use_errno=True)
+    result = -1
+    if sys.platform == 'darwin' and hasattr(libc, 'renamex_np'):
+        RENAME_SWAP = 0x2
+        result = libc.renamex_np(a_bytes, b_bytes, RENAME_SWAP)
+    elif hasattr(libc, 'renameat2'):
+        AT_FDCWD, RENAME_EXCHANGE = -100, 0x2
+        result = libc.renameat2(AT_FDCWD, a_bytes, AT_FDCWD, b_bytes,
+                                RENAME_EXCHANGE)
+    if result == 0:
+        return
+    old = a.with_name(f'{a.name}.swap')
+    os.rename(a, old)
+    os.rename(b, a)
+    os.rename(old, b)
+
+
+def _load_mirror_manifest(mirror):
+    manifest_path = mirror.joinpath(MIRROR_MANIFEST_NAME)
+    if not manifest_path.exists():
+        if mirror.is_dir() and any(mirror.iterdir()):
+            raise ValueError(f'{mirror} is not empty, and was not created by '
+                             'export_mirror')
+        return {}
+    data = json.loads(manifest_path.read_text())
+    if data.get('version') != _MIRROR_MANIFEST_VERSION:
+        raise ValueError(f'{manifest_path} has an unsupported version')
+    return data['notes']
+
+
+def _note_files(folder, path):
+    """Returns the paths, relative to folder, of the HTML file at path and
+    the files in its resources folder."""
+    files = [path.relative_to(folder)]
+    respath = path.with_name(f'{path.name}.resources')
+    if respath.is_dir():
+        files.extend(p.relative_to(folder) for p in sorted(respath.rglob('*'))
+                     if p.is_file())
+    return files
+
+
+def export_mirror(mirror, query='', timeout_seconds=30*60, sync_first=False):
+    """Exports notes with extra metadata (see export_enhanced) into the
+    directory mirror, changing only what differs from the previous call.
+
+    A manifest in the mirror (see MIRROR_MANIFEST_NAME) records the
+    SHA-256 hash of each file exported for each note, keyed by the
+    note's link. A note keeps the name it had in the mirror, and its
+    files whose hashes haven't changed are kept as they are (so their
+    modification times don't change, and any changes relink made to them
+    are kept); other files are written, and notes no longer matching the
+    query are removed.
+
+    The new version of the mirror is assembled beside it, using hard
+    links to the unchanged files, and then swapped into place (see
+    _swap_dirs), so the mirror is never seen partly updated.
+
+    If sync_first is True, the app is told to synchronize first, and the
+    export starts once it finishes (see while_syncing); meanwhile, the
+    manifest is loaded and anything left by an interrupted call is
+    removed.
+
+    Returns a MirrorStats.
+    """
+    mirror = Path(os.path.abspath(mirror))
+    staging = mirror.with_name(f'.{mirror.name}.mirror-export')
+    new = mirror.with_name(f'.{mirror.name}.mirror-new')
+
+    def prepare():
+        old_notes = _load_mirror_manifest(mirror)
+        for leftover in (staging, new):
+            if leftover.exists():
+                shutil.rmtree(leftover)
+        return old_notes
+
+    if sync_first:
+        old_notes = while_syncing(prepare, timeout_seconds=timeout_seconds)
+    else:
+        old_notes = prepare()
+    links = {}
+
+    def on_note(path, meta):
+        links[path] = meta.link
+
+    export_enhanced(str(staging), query=query,
+                    timeout_seconds=timeout_seconds, on_note=on_note)
+
+    new.mkdir()
+    allocator = _NameAllocator(new)
+    for link, entry in old_notes.items():
+        allocator.taken.add(_name_key(entry['html']))
+    # Notes being given a different name are moved here first, since
+    # their new name may be taken by another note in staging.
+    renamed = staging.joinpath('.renamed')
+    renamed.mkdir()
+    new_notes = {}
+    unchanged = written = 0
+    for path, link in links.items():
+        old = old_notes.get(link)
+        if old:
+            target = new.joinpath(old['html'])
+        else:
+            target = allocator.allocate(path.name)
+        folder = staging
+        if target.name != path.name:
+            folder = renamed
+            _merge_note(path, renamed.joinpath(target.name))
+            path = renamed.joinpath(target.name)
+        files = {}
+        for rel in _note_files(folder, path):
+            digest = blobs.hash_file(folder.joinpath(rel))
+            files[rel.as_posix()] = digest
+            dest = new.joinpath(rel)
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            if old and old['files'].get(rel.as_posix()) == digest \
+                    and mirror.joinpath(rel).exists():
+                _link_or_copy(mirror.joinpath(rel), dest)
+                unchanged += 1
+            else:
+                os.rename(folder.joinpath(rel), dest)
+                written += 1
+        new_notes[link] = {'html': target.name, 'files': files}
+    shutil.rmtree(staging)
+
+    relink_index = mirror.joinpath(RELINK_INDEX_NAME)
+    if relink_index.exists():
+        _link_or_copy(relink_index, new.joinpath(RELINK_INDEX_NAME))
+    write_json_atomic(new.joinpath(MIRROR_MANIFEST_NAME), {
+        'version': _MIRROR_MANIFEST_VERSION,
+        'notes': new_notes,
     })
-    out = subprocess.check_output(['osascript', '-e', script, '-ss'])
-    metas = _EXTRA_META_RE.findall(str(out, 'utf-8'))
-    if not metas:
-        return False
+    if mirror.exists():
+        _swap_dirs(mirror, new)
+        shutil.rmtree(new)
+    else:
+        os.rename(new, mirror)
+    deleted = len(set(old_notes) - set(new_notes))
+    return MirrorStats(len(new_notes), unchanged, written, deleted)
 
-    def available_path(name):
-        # Evernote's export will go right up to the max filename limit, but
-        # then we have problems when we try to append the '.resources' suffix.
-        # To keep things simple, truncate the name to a more manageable length.
-        name = f'{Path(name).stem[0:70]}.html'
-        prefix = 2
-        candidate = dest.joinpath(name)
-        while candidate.exists():
-            candidate = dest.joinpath(f'{prefix}-{name}')
-            prefix += 1
-        return candidate
-
-    path_metas = {}
-    for path in tmp.glob('*/*.html'):
-        newpath = available_path(path.name)
-        respath = None
-        # Previously this code simply appended `.resources` to path.name and
-        # checked if that file exists. However, that causes an error when the
-        # filename exceeds the maximum filename length. And in such cases,
-        # Evernote appears to truncate the stem of the resource folder name
-        # more than it truncates the name of the HTML file, so that the two
-        # do not necessarily match.
-        for p in path.parent.glob('*.resources'):
-            respath = p
-        path.rename(newpath)
-        if respath:
+
+def plan_merge(srcdirs, destdir):
+    """Returns a list of (source, target) paths for the HTML files that
+    merge would move, without changing anything."""
+    allocator = _NameAllocator(destdir)
+    plan = []
+    for srcdir in srcdirs:
+        for src in Path(srcdir).glob('*.html'):
+            plan.append((src, allocator.allocate(src.name)))
+    return plan
+
+
+def _merge_note(src, newpath):
+    stats = rewrite.RewriteStats()
+    with profiling.span('merge_note', path=str(newpath)) as span:
+        _move(src, newpath)
+        respath = src.with_name(f'{src.name}.resources')
+        if respath.exists():
             newrespath = newpath.with_name(f'{newpath.name}.resources')
-            respath.rename(newrespath)
+            _move(respath, newrespath)
             if not newrespath.name == respath.name:
-                text = newpath.read_text()
-                text = text.replace(quote(respath.name), quote(newrespath.name))
-                newpath.write_text(text)
-        path.parent.rmdir()
-
-        index = int(path.parent.name)
-        path_metas[newpath] = metas[index-1]
-        _, link = metas[index-1]
-    tmp.rmdir()
+                stats = rewrite.rewrite(
+                    newpath, newpath, *_resource_and_head_rewriter(
+                        respath.name, newrespath.name))
+                span.set(**profiling.stats_args(stats))
+    return stats
 
-    for path in dest.glob('*.html'):
-        text = path.read_text()
-        notebook, link = path_metas[path]
-        text = text.replace('<head>', f'<head><meta name="evernote-notebook" content="{notebook}"/><meta name="evernote-url" content="{link}"/>', 1)
-        path.write_text(text)
 
-    return True
+def merge(srcdirs, destdir, jobs=None, dedup=False):
+    """Moves the HTML files (and their resources folders) from each of
+    srcdirs into destdir, renaming them where necessary to avoid
+    overwriting existing files.
 
+    Names are chosen up front (see plan_merge), and then the files are
+    moved using a pool of jobs threads. Files on a different filesystem
+    from destdir are copied instead. If dedup is True, each note's
+    attachments are then added to a blobs.BlobStore for destdir by the same
+    thread.
 
-def merge(srcdirs, destdir):
-    def available_path(name):
-        name = f'{Path(name).stem[0:70]}.html'
-        prefix = 2
-        candidate = destdir.joinpath(name)
-        while candidate.exists():
-            candidate = destdir.joinpath(f'{prefix}-{name}')
-            prefix += 1
-        return candidate
-
+    Returns a rewrite.RewriteStats for the files that had to be rewritten
+    to refer to a renamed resources folder.
+    """
     destdir = Path(destdir)
     destdir.mkdir(exist_ok=True, parents=True)
-    for srcdir in srcdirs:
-        srcdir = Path(srcdir)
-        for src in srcdir.glob('*.html'):
-            newpath = available_path(src.name)
-            src.rename(newpath)
-            respath = src.with_name(f'{src.name}.resources')
-            if respath.exists():
-                newrespath = newpath.with_name(f'{newpath.name}.resources')
-                respath.rename(newrespath)
-                if not newrespath.name == respath.name:
-                    text = newpath.read_text()
-                    text = text.replace(quote(respath.name), quote(newrespath.name))
-                    newpath.write_text(text)
+    plan = plan_merge(srcdirs, destdir)
+    store = blobs.BlobStore(destdir) if dedup else None
+
+    def merge_note(src, newpath):
+        stats = _merge_note(src, newpath)
+        if store:
+            store.add_note(newpath)
+        return stats
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        stats = list(pool.map(lambda move: merge_note(*move), plan))
+    return rewrite.total(stats)
+
+
+def _map_files(func, args_list, jobs=None):
+    """Applies func to each tuple of arguments, using a process pool.
+
+    Results are returned in the same order as args_list. If jobs is 1
+    (or there is at most one item), no pool is started.
+    """
+    if profiling.enabled():
+        # Worker processes can't write to the trace, so they return their
+        # timings for this process to record.
+        args_list = [(func, *args) for args in args_list]
+        func = profiling.traced
+    if jobs == 1 or len(args_list) < 2:
+        results = [func(*args) for args in args_list]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(func, *zip(*args_list), chunksize=64))
+    if func is profiling.traced:
+        results = [profiling.record_traced(result) for result in results]
+    return results
+
+
+def _scan_for_relink(path):
+    """Returns the evernote-url meta tag of the file (or None), the set
+    of evernote:// links appearing after its head, its title (or None),
+    the set of links to other HTML files appearing after its head (which
+    may be links that relink already replaced), and whether it has a
+    backlinks section."""
+    url = None
+    title = None
+    links = set()
+    hrefs = set()
+    in_body = False
+    in_section = False
+    has_section = False
+    with open(path) as file:
+        for _, match in rewrite.iter_matches(
+                file, _RELINK_SCAN_RE, _RELINK_SCAN_OVERLAP):
+            if not match:
+                continue
+            text = match.group(0)
+            if match.group(1):
+                url = url or match.group(1)
+            elif match.group(2) is not None:
+                if not in_body and title is None:
+                    title = match.group(2)
+            elif text == '</head>':
+                in_body = True
+            elif text == _BACKLINKS_START:
+                in_section = has_section = True
+            elif text == _BACKLINKS_END:
+                in_section = False
+            elif not in_body or in_section:
+                continue
+            elif text.startswith('evernote:'):
+                links.add(text)
+            elif match.group(3) and match.group(3).lower().endswith('.html'):
+                hrefs.add(match.group(3))
+    return url, links, title, hrefs, has_section
+
+
+def _backlinks_html(backlinks):
+    """Returns the section listing backlinks (a list of [path, title]
+    pairs) that relink adds to the end of a note's body."""
+    items = ''.join(f'<li><a href="{quote(rel)}">{title}</a></li>'
+                    for rel, title in backlinks)
+    return (f'{_BACKLINKS_START}<div class="evernote-backlinks">'
+            f'<h2>Backlinks</h2><ul>{items}</ul></div>{_BACKLINKS_END}')
+
+
+def _relink_file(path, link_paths, backlinks=None):
+    """Replaces the evernote:// links in the file's body according to
+    link_paths, and returns a rewrite.RewriteStats.
+
+    If backlinks (a list of [path, title] pairs) is given, any previous
+    backlinks section is replaced by a new one, if there are any.
+    """
+    if backlinks is None:
+        return rewrite.rewrite(path, path, _RELINK_REWRITE_RE,
+                               _link_replacer(link_paths),
+                               _RELINK_SCAN_OVERLAP)
+    replace_link = _link_replacer(link_paths)
+    in_section = False
+
+    def replace(match):
+        nonlocal in_section
+        text = match.group(0)
+        if text == _BACKLINKS_START:
+            in_section = True
+            return ''
+        if text == _BACKLINKS_END:
+            in_section = False
+            return ''
+        if text == '</body>':
+            return (_backlinks_html(backlinks) if backlinks else '') + text
+        return replace_link(match)
+
+    return rewrite.rewrite(path, path, _RELINK_BACKLINKS_RE, replace,
+                           _RELINK_SCAN_OVERLAP,
+                           keep_text=lambda text: not in_section)
+
+
+def _resolve_link(link, link_paths):
+    """Returns the text to replace a match of LINK_RE with, and the list
+    of note URLs (keys of link_paths) it refers to.
+
+    LINK_RE also matches characters that can follow a link, such as
+    "evernote:///view/.../).", and the original relink replaced URLs
+    wherever they appeared. So a link that isn't a known URL is resolved
+    by its longest prefix that is one (note URLs end in "/"), and the
+    rest is resolved in turn; if no prefix is known, the link is resolved
+    from the next "evernote://" within it.
+    """
+    if link in link_paths:
+        return link_paths[link], [link]
+    end = len(link) - 1
+    while end > 0:
+        end = link.rfind('/', 0, end)
+        if end < 0:
+            break
+        url = link[:end + 1]
+        if url in link_paths:
+            rest = link[end + 1:]
+            pieces = [link_paths[url]]
+            urls = [url]
+            pos = 0
+            for match in LINK_RE.finditer(rest):
+                text, found = _resolve_link(match.group(0), link_paths)
+                pieces += [rest[pos:match.start()], text]
+                urls += found
+                pos = match.end()
+            pieces.append(rest[pos:])
+            return ''.join(pieces), urls
+    # LINK_RE matches can also contain several URLs separated by
+    # characters such as ",", in which case a later one may be known.
+    start = link.find('evernote://', 1)
+    if start > 0:
+        text, urls = _resolve_link(link[start:], link_paths)
+        return link[:start] + text, urls
+    return link, []
+
+
+def _link_replacer(link_paths):
+    in_body = False
 
+    def replace(match):
+        nonlocal in_body
+        if match.group(0) == '</head>':
+            in_body = True
+        elif in_body:
+            return link_paths.get(match.group(0), match.group(0))
+        return match.group(0)
 
-def relink(folder):
+    return replace
+
+
+def _load_relink_index(index_path):
+    try:
+        data = json.loads(index_path.read_text())
+    except (FileNotFoundError, ValueError):
+        return {}
+    if data.get('version') != _RELINK_INDEX_VERSION:
+        return {}
+    return data['files']
+
+
+def relink(folder, jobs=None, rebuild=False, backlinks=False):
+    """Replaces evernote:// links in the HTML files within folder with
+    the paths (relative to folder) of the files they refer to.
+
+    The target of each link is found using the evernote-url meta tags
+    written by export_enhanced. Files are scanned and rewritten across
+    a pool of jobs processes (defaulting to the number of CPUs); files
+    that contain no resolvable links are left untouched.
+
+    An index of each file's size, mtime, evernote-url and unresolved
+    links is kept in folder (see RELINK_INDEX_NAME), so that later runs
+    only need to scan new or changed files, and only rewrite files
+    containing links to newly added notes. If rebuild is True the
+    existing index is ignored and every file is scanned.
+
+    The graph of links between notes is written to folder as JSON (see
+    LINK_GRAPH_NAME): the path of each note by evernote-url, the notes
+    each note links to, the number of notes linking to each note, and
+    the links that don't resolve to any note in folder. Links that were
+    already replaced are found by their paths, so the graph can be
+    rebuilt for a folder that was relinked before.
+
+    If backlinks is True, a section listing the notes that link to it is
+    added to the end of each linked-to note (and kept up to date, or
+    removed when there are no longer any). Links within these sections
+    are not counted as links between notes.
+
+    Returns a rewrite.RewriteStats counting the files rewritten and the
+    bytes read and written.
+    """
     folder = Path(folder)
-    link_paths = {}
-    for path in folder.glob('**/*.html'):
-        text = path.read_text()
-        match = re.search(URL_META_RE, text)
-        if match:
-            link_paths[match.group(1)] = path.relative_to(folder)
-    # This is extraordinarily inefficient, it would be much faster to
-    # use a regex to find all links and then replace just the ones we found
+    index_path = folder.joinpath(RELINK_INDEX_NAME)
+    indexed = {} if rebuild else _load_relink_index(index_path)
+
+    entries = {}
+    stale = []
     for path in folder.glob('**/*.html'):
-        text = path.read_text()
-        endhead = text.index('</head>')
-        body = text[endhead:]
-        for link, target in link_paths.items():
-            body = body.replace(link, str(target))
-        text = text[:endhead] + body
-        path.write_text(text)
+        rel = str(path.relative_to(folder))
+        stat = path.stat()
+        entry = indexed.get(rel)
+        if not (entry and entry['mtime_ns'] == stat.st_mtime_ns
+                and entry['size'] == stat.st_size):
+            entry = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+            stale.append(rel)
+        entries[rel] = entry
 
+    scans = _map_files(
+        _scan_for_relink, [(folder.joinpath(rel),) for rel in stale], jobs)
+    for rel, (url, links, title, hrefs, has_section) in zip(stale, scans):
+        entries[rel]['url'] = url
+        entries[rel]['title'] = title
+        entries[rel]['links'] = entries[rel]['outbound'] = sorted(links)
+        entries[rel]['hrefs'] = sorted(hrefs)
+        if has_section:
+            # What the section lists isn't known, so it's always
+            # rewritten (or removed) when backlinks are next updated.
+            entries[rel]['backlinks'] = None
+    scanned = rewrite.RewriteStats(
+        bytes_read=sum(entries[rel]['size'] for rel in stale))
 
-def export_by_notebook(dest, fmt='HTML', query='', timeout_seconds=30*60):
-    """Exports notes into separate files/folders per notebook.
+    link_paths = {}
+    for rel, entry in entries.items():
+        if entry['url']:
+            link_paths[entry['url']] = rel
 
-    This is like the export method, except dest should be a directory,
-    which will be populated with a separate file or folder for each
-    notebook for which there are notes matching the query.
+    graph = _link_graph(entries, link_paths)
+    sources = {}
+    if backlinks:
+        for url, targets in graph['links'].items():
+            rel = link_paths[url]
+            title = entries[rel].get('title') or escape(Path(rel).stem)
+            for target in targets:
+                sources.setdefault(target, []).append([rel, title])
 
-    The query must not contain the string "notebook".
+    work = []
+    for rel, entry in entries.items():
+        targets = {}
+        for link in entry['links']:
+            text, urls = _resolve_link(link, link_paths)
+            if urls:
+                targets[link] = text
+        if backlinks:
+            wanted = sorted(sources.get(entry['url'], []))
+            if targets or wanted != entry.get('backlinks', []):
+                work.append((folder.joinpath(rel), targets, wanted))
+        elif targets:
+            work.append((folder.joinpath(rel), targets))
+    stats = _map_files(_relink_file, work, jobs)
+
+    for path, targets, *wanted in work:
+        entry = entries[str(path.relative_to(folder))]
+        stat = path.stat()
+        entry['mtime_ns'] = stat.st_mtime_ns
+        entry['size'] = stat.st_size
+        # Text after a resolved URL may contain links that weren't.
+        entry['links'] = sorted(
+            {link for link in entry['links'] if link not in targets}
+            | {link for text in targets.values()
+               for link in LINK_RE.findall(text)})
+        if wanted:
+            entry['backlinks'] = wanted[0]
+    write_json_atomic(folder.joinpath(LINK_GRAPH_NAME), graph)
+    write_json_atomic(index_path, {
+        'version': _RELINK_INDEX_VERSION,
+        'files': entries,
+    })
+    return rewrite.total([scanned] + stats)
+
+
+def _href_target(href, rel_urls):
+    """Returns the URL of the note whose file (a key of rel_urls) the
+    href attribute value refers to, or None."""
+    for rel in (href, unescape(href), unquote(unescape(href))):
+        if rel in rel_urls:
+            return rel_urls[rel]
+    return None
 
-    The timeout is applied to each notebook, rather than the entire export.
+
+def _link_graph(entries, link_paths):
+    """Returns the contents of the LINK_GRAPH_NAME file for the relink
+    index entries.
+
+    A note's outbound links are the evernote:// links found when it was
+    scanned, and the links to other notes' files (such as those relink
+    replaced them with) found in the same scan.
     """
+    rel_urls = {rel: url for url, rel in link_paths.items()}
+    links = {}
+    in_degree = {url: 0 for url in link_paths}
+    unresolved = {}
+    for rel, entry in sorted(entries.items()):
+        url = entry['url']
+        outbound = entry.get('outbound', entry['links'])
+        if not url or link_paths[url] != rel:
+            continue
+        targets = set()
+        for link in outbound:
+            found = _resolve_link(link, link_paths)[1]
+            targets.update(found)
+            if not found:
+                unresolved.setdefault(link, []).append(url)
+        for href in entry.get('hrefs', []):
+            target = _href_target(href, rel_urls)
+            if target:
+                targets.add(target)
+        links[url] = sorted(targets)
+        for target in targets:
+            in_degree[target] += 1
+    return {
+        'version': _LINK_GRAPH_VERSION,
+        'notes': link_paths,
+        'links': links,
+        'in_degree': in_degree,
+        'unresolved': unresolved,
+    }
+
+
+def count_notes(query='', timeout_seconds=30*60):
+    """Returns the number of notes matching the query."""
+    return _count_queries([query], timeout_seconds)[0]
+
+
+def count_notes_by_notebook(query='', timeout_seconds=30*60):
+    """Returns a dict mapping each notebook name to the number of notes in
+    it that match the query, using a single AppleScript call."""
+    with TemporaryDirectory() as tmp:
+        out_path = Path(tmp).joinpath('counts')
+        _run_script(_count_by_notebook_script(out_path, query,
+                                              timeout_seconds))
+        return _read_counts(out_path)
+
+
+def _count_by_notebook_script(out_path, query, timeout_seconds):
+    out_path.touch()
+    return _COUNT_BY_NOTEBOOK_SCRIPT.substitute({
+        'out': _script_escape(str(out_path)),
+        'query': _script_escape(query),
+        'timeout': timeout_seconds,
+    })
+
+
+def _read_counts(out_path):
+    counts = {}
+    with open(out_path, encoding='utf-8', newline='\n') as out_file:
+        for line in out_file:
+            name, count = line.rstrip('\n').split(_META_SIDECAR_SEP)
+            counts[name] = int(count)
+    return counts
+
+
+NotebookTiming = namedtuple('NotebookTiming', ['notebooks', 'notes', 'seconds'])
+NotebookTiming.__doc__ = """How long one AppleScript call made by
+export_by_notebook took, and which notebooks (and how many notes) it
+exported."""
+
+
+def _notebook_export_path(dest, name, fmt):
+    nbdest = dest.joinpath(name)
+    if fmt == 'ENEX':
+        nbdest = nbdest.with_suffix('.enex')
+    return nbdest
+
+
+def _export_notebooks_script(dest, names, fmt, query, timeout_seconds):
+    exports = []
+    for name in names:
+        nbdest = _notebook_export_path(dest, name, fmt)
+        nbquery = f'notebook:"{name}" {query}'
+        exports.append(_EXPORT_NOTEBOOK_LINE.substitute({
+            'dest': _script_escape(str(nbdest)),
+            'fmt': fmt,
+            'query': _script_escape(nbquery),
+        }))
+    return _EXPORT_NOTEBOOKS_SCRIPT.substitute({
+        'exports': '\n'.join(exports),
+        'timeout': timeout_seconds,
+    })
+
+
+def _export_notebooks(dest, names, counts, fmt, query, timeout_seconds):
+    script = _export_notebooks_script(dest, names, fmt, query,
+                                      timeout_seconds)
+    start = time.time()
+    _run_script(script)
+    return NotebookTiming(names, sum(counts[name] for name in names),
+                          time.time() - start)
+
+
+def _check_notebook_query(query):
     if 'notebook' in query:
         # If two notebooks are specified in the search query, the results
         # will include notes from both. Raising an error is easier than
         # trying to parse/modify the query to make it work.
         raise Exception('query must not contain notebook')
+
+
+def _notebook_batches(counts, small_notebook_notes, small_batch_notes):
+    """Returns lists of notebook names to export with each call, largest
+    first, with the small notebooks grouped together at the end, so that
+    each group has at most small_batch_notes notes (or one notebook)."""
+    names = sorted((name for name, count in counts.items() if count),
+                   key=lambda name: -counts[name])
+    batches = [[name] for name in names
+               if counts[name] >= small_notebook_notes]
+    group = []
+    group_notes = 0
+    for name in names:
+        if counts[name] >= small_notebook_notes:
+            continue
+        if group and group_notes + counts[name] > small_batch_notes:
+            batches.append(group)
+            group = []
+            group_notes = 0
+        group.append(name)
+        group_notes += counts[name]
+    if group:
+        batches.append(group)
+    return batches
+
+
+def export_by_notebook(dest, fmt='HTML', query='', timeout_seconds=30*60,
+                       jobs=1, small_notebook_notes=20,
+                       small_batch_notes=200):
+    """Exports notes into separate files/folders per notebook.
+
+    This is like the export method, except dest should be a directory,
+    which will be populated with a separate file or folder for each
+    notebook for which there are notes matching the query.
+
+    The query must not contain the string "notebook".
+
+    The notes matching the query in each notebook are counted first, and
+    notebooks are exported largest first, using up to jobs concurrent
+    AppleScript calls. Notebooks with fewer than small_notebook_notes
+    matching notes are exported together, by as few calls as possible
+    that each export at most small_batch_notes notes. If any call fails
+    while others are running, the failed ones are retried one at a time
+    afterward, since the app may reject concurrent commands.
+
+    The timeout is applied to each call, rather than the entire export.
+
+    Returns a list of NotebookTiming, one per call.
+    """
+    _check_notebook_query(query)
     dest = Path(dest).resolve()
     dest.mkdir(parents=True, exist_ok=True)
-    for name in list_notebooks():
-        nbdest = dest.joinpath(name)
+    counts = count_notes_by_notebook(query, timeout_seconds)
+    batches = _notebook_batches(counts, small_notebook_notes,
+                                small_batch_notes)
+
+    def run(batch):
+        return _export_notebooks(dest, batch, counts, fmt, query,
+                                 timeout_seconds)
+
+    if jobs == 1:
+        return [run(batch) for batch in batches]
+    timings = []
+    failed = []
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [(batch, pool.submit(run, batch)) for batch in batches]
+        for batch, future in futures:
+            try:
+                timings.append(future.result())
+            except transport.ScriptError:
+                failed.append(batch)
+    for batch in failed:
+        timings.append(run(batch))
+    return timings
+
+
+ShardTiming = namedtuple('ShardTiming', ['queries', 'notes', 'seconds'])
+ShardTiming.__doc__ = """How long one AppleScript call made by export_sharded
+took, and the queries it exported (and how many notes they matched when
+the shards were planned)."""
+
+
+def _count_queries(queries, timeout_seconds):
+    """Returns the number of notes matching each of queries, counted by a
+    single AppleScript call."""
+    if not queries:
+        return []
+    with TemporaryDirectory() as tmp:
+        out_path = Path(tmp).joinpath('counts')
+        out_path.touch()
+        counts = '\n'.join(
+            _COUNT_QUERY_LINE.substitute({'query': _script_escape(query)})
+            for query in queries)
+        _run_script(_COUNT_QUERIES_SCRIPT.substitute({
+            'out': _script_escape(str(out_path)),
+            'counts': counts,
+            'timeout': timeout_seconds,
+        }))
+        return [int(line) for line in out_path.read_text().split()]
+
+
+def _range_query(field, start, end, query):
+    """Returns query restricted to notes whose field (created or updated)
+    is on or after the date start and before the date end, either of
+    which may be None for an open-ended range."""
+    terms = []
+    if start:
+        terms.append(f'{field}:{start:%Y%m%d}')
+    if end:
+        terms.append(f'-{field}:{end:%Y%m%d}')
+    return ' '.join(terms + [query]).strip()
+
+
+def _date_ranges(field, query, shard_notes, timeout_seconds):
+    """Returns consecutive [start, end, count] ranges of dates covering
+    every note matching query, and how many notes fall in each.
+
+    Notes are counted by year, and then ranges with more than shard_notes
+    notes are halved (with one count call per round) until they're small
+    enough or only a day long.
+    """
+    bounds = [date(year, 1, 1) for year
+              in range(_SHARD_FIRST_YEAR, date.today().year + 2)]
+    ranges = [[start, end] for start, end
+              in zip([None] + bounds, bounds + [None])]
+    counts = _count_queries(
+        [_range_query(field, start, end, query) for start, end in ranges],
+        timeout_seconds)
+    ranges = [r + [count] for r, count in zip(ranges, counts)]
+    while True:
+        split = [r for r in ranges if r[2] > shard_notes and r[0] and r[1]
+                 and r[1] - r[0] > timedelta(days=1)]
+        if not split:
+            return ranges
+        firsts = [[start, start + (end - start) // 2]
+                  for start, end, _ in split]
+        counts = _count_queries(
+            [_range_query(field, start, end, query) for start, end in firsts],
+            timeout_seconds)
+        halves = {}
+        for r, first, count in zip(split, firsts, counts):
+            # The second half is counted by subtraction; it's only used
+            # to size the shards, so it doesn't matter if notes change in
+            # the meantime.
+            halves[id(r)] = [first + [count],
+                             [first[1], r[1], max(r[2] - count, 0)]]
+        ranges = [half for r in ranges for half in halves.get(id(r), [r])]
+
+
+def _shard_plan(shard_by, query, shard_notes, timeout_seconds):
+    """Returns a list of shards for export_sharded, each a dict of the
+    queries to export with one call and the number of notes they match.
+    """
+    shards = []
+
+    def add(queries, notes):
+        if not notes:
+            return
+        if shards and shards[-1]['notes'] + notes <= shard_notes:
+            shards[-1]['queries'] += queries
+            shards[-1]['notes'] += notes
+        else:
+            shards.append({'queries': queries, 'notes': notes})
+
+    if shard_by == 'notebook':
+        _check_notebook_query(query)
+        counts = count_notes_by_notebook(query, timeout_seconds)
+        for name in sorted(counts, key=lambda name: -counts[name]):
+            add([f'notebook:"{name}" {query}'.strip()], counts[name])
+    elif shard_by in ('created', 'updated'):
+        if 'any:' in query:
+            raise ValueError('query must not contain any:')
+        packed = []
+        for start, end, count in _date_ranges(shard_by, query, shard_notes,
+                                              timeout_seconds):
+            # Adjacent ranges are combined into one query, and empty ones
+            # are absorbed into their neighbours so that no dates are
+            # missed.
+            if packed and packed[-1][2] + count <= shard_notes:
+                packed[-1][1] = end
+                packed[-1][2] += count
+            else:
+                packed.append([start, end, count])
+        for start, end, count in packed:
+            add([_range_query(shard_by, start, end, query)], count)
+    else:
+        raise ValueError(f'cannot shard by {shard_by} (expected one of '
+                         f'{", ".join(SHARD_FIELDS)})')
+    return shards
+
+
+def _remove(path):
+    if path.is_dir():
+        shutil.rmtree(path)
+    elif path.exists():
+        path.unlink()
+
+
+def export_sharded(dest, fmt='HTML', query='', timeout_seconds=30*60,
+                   shard_by='created', shard_notes=2000, jobs=1, retries=2):
+    """Exports notes like the export method, but in shards of about
+    shard_notes notes, each exported by a separate AppleScript call (to
+    which the timeout applies), so that no call has to export everything.
+
+    The query is split into disjoint parts by the notes' created or
+    updated date, or by notebook (see SHARD_FIELDS), sized using counts
+    from the app. Dates are split by year, and then halved down to single
+    days where there are too many notes; large notebooks get a shard of
+    their own, and smaller ones share one. When sharding by notebook, the
+    query must not contain "notebook"; when sharding by date, it must not
+    contain "any:".
+
+    Shards are exported by up to jobs concurrent calls. For HTML, each
+    shard is merged into the dest directory as it finishes (see merge);
+    for ENEX, the shards' files are concatenated into the dest file once
+    they have all finished. Shards that fail are retried one at a time,
+    up to retries more times each, and if any still fail the last error
+    is raised.
+
+    The plan and the finished shards are recorded in a journal within a
+    hidden work directory beside dest, so calling this again with the same
+    arguments only exports the unfinished shards. The work directory is
+    removed once the export is complete.
+
+    Returns a list of ShardTiming for the calls that succeeded, or None
+    if no notes match the query.
+    """
+    if shard_notes < 1:
+        raise ValueError('shard_notes must be positive')
+    dest = Path(dest).resolve()
+    work = dest.with_name(f'.{dest.name}.shards')
+    work.mkdir(parents=True, exist_ok=True)
+    journal_path = work.joinpath(EXPORT_JOURNAL_NAME)
+    settings = {'fmt': fmt, 'query': query, 'shard_by': shard_by,
+                'shard_notes': shard_notes}
+    if journal_path.exists():
+        journal = json.loads(journal_path.read_text())
+        if journal['settings'] != settings:
+            raise ValueError(
+                f'{journal_path} belongs to an export with different '
+                'settings; remove it to start over')
+    else:
+        journal = {
+            'settings': settings,
+            'shards': _shard_plan(shard_by, query, shard_notes,
+                                  timeout_seconds),
+            'completed': [],
+        }
+        write_json_atomic(journal_path, journal)
+    if not journal['shards']:
+        shutil.rmtree(work)
+        return None
+    if fmt == 'HTML':
+        dest.mkdir(parents=True, exist_ok=True)
+
+    def part_paths(index):
+        paths = [work.joinpath(f'{index}-{part}') for part
+                 in range(len(journal['shards'][index]['queries']))]
         if fmt == 'ENEX':
-            nbdest = nbdest.with_suffix('.enex')
-        nbquery = f'notebook:"{name}" {query}'
-        export(str(nbdest), fmt=fmt, query=nbquery,
-               timeout_seconds=timeout_seconds)
+            paths = [path.with_name(f'{path.name}.enex') for path in paths]
+        return paths
+
+    def run(index):
+        shard = journal['shards'][index]
+        paths = part_paths(index)
+        exports = []
+        for shard_query, path in zip(shard['queries'], paths):
+            # Left over from an interrupted attempt.
+            _remove(path)
+            exports.append(_EXPORT_NOTEBOOK_LINE.substitute({
+                'dest': _script_escape(str(path)),
+                'fmt': fmt,
+                'query': _script_escape(shard_query),
+            }))
+        start = time.time()
+        _run_script(_EXPORT_NOTEBOOKS_SCRIPT.substitute({
+            'exports': '\n'.join(exports),
+            'timeout': timeout_seconds,
+        }))
+        return ShardTiming(shard['queries'], shard['notes'],
+                           time.time() - start)
+
+    def finish(index):
+        if fmt == 'HTML':
+            paths = [path for path in part_paths(index) if path.exists()]
+            merge(paths, dest)
+            for path in paths:
+                shutil.rmtree(path)
+        journal['completed'].append(index)
+        write_json_atomic(journal_path, journal)
+
+    timings = []
+    pending = [index for index in range(len(journal['shards']))
+               if index not in journal['completed']]
+    for attempt in range(retries + 1):
+        failed = []
+        # Retries run one at a time, since the app may reject concurrent
+        # commands.
+        with ThreadPoolExecutor(max_workers=jobs if attempt == 0 else 1) \
+                as pool:
+            futures = {pool.submit(run, index): index for index in pending}
+            for future in as_completed(futures):
+                try:
+                    timings.append(future.result())
+                except transport.ScriptError as e:
+                    error = e
+                    failed.append(futures[future])
+                    continue
+                finish(futures[future])
+        pending = sorted(failed)
+        if not pending:
+            break
+    if pending:
+        raise error
+
+    if fmt == 'ENEX':
+        enex.concat_enex([path for index in range(len(journal['shards']))
+                          for path in part_paths(index) if path.exists()],
+                         dest)
+    shutil.rmtree(work)
+    return timings
+
+
+def _split_notebook(src, dest):
+    """Splits a notebook's ENEX export (see enex.split_enex) and returns
+    the index entries."""
+    dest = Path(dest)
+    dest.mkdir(parents=True, exist_ok=True)
+    index_path = dest.with_name(f'{dest.name}.jsonl')
+    with open(index_path, 'w') as index_file:
+        enex.split_enex(src, dest, index_file, resources=True)
+    with open(index_path) as index_file:
+        return [json.loads(line) for line in index_file]
+
+
+def _convert_note(src, dest, media, head):
+    """Converts a note split from an ENEX export to HTML, and moves its
+    resources folder (if any) beside the new file.
+
+    Returns a rewrite.RewriteStats, or the error message if the note
+    couldn't be converted.
+    """
+    respath = Path(f'{src}.resources')
+    resources_name = f'{dest.name}.resources'
+    try:
+        written = enex.note_to_html(src, dest, resources_name, media, head)
+    except (ElementTree.ParseError, ValueError) as e:
+        return str(e)
+    if respath.exists():
+        _move(respath, dest.with_name(resources_name))
+    return rewrite.RewriteStats(1, Path(src).stat().st_size, written)
+
+
+ViaEnexResult = namedtuple('ViaEnexResult', ['notes', 'unmatched', 'skipped'])
+ViaEnexResult.__doc__ = """What export_enhanced_via_enex exported: the number
+of notes, the (notebook, title) of each exported note whose link could
+not be found, and the (notebook, title, error message) of each note
+that could not be converted."""
+
+
+def export_enhanced_via_enex(dest, query='', timeout_seconds=30*60, jobs=1,
+                             convert_jobs=None, dedup=False):
+    """Exports notes with the same metadata and layout as export_enhanced,
+    but much faster for large exports.
+
+    Instead of asking the app to export each note separately, this
+    exports each notebook to ENEX (see export_by_notebook, to which jobs
+    is passed, and whose restriction on the query applies), and then
+    converts the notes to HTML itself using a pool of convert_jobs
+    processes (defaulting to the number of CPUs).
+
+    ENEX files don't contain note links, so they are fetched with
+    list_notes and matched to the notes by notebook, title and creation
+    date; notes that can't be matched get an empty evernote-url. The
+    HTML differs in small ways from the app's own export. Notes whose
+    content can't be parsed are skipped.
+
+    If dedup is True, the notes' attachments are then added to a
+    blobs.BlobStore for dest.
+
+    Returns a ViaEnexResult.
+    """
+    dest = Path(dest).resolve()
+    dest.mkdir(parents=True, exist_ok=True)
+    converted = []
+    unmatched = []
+    skipped = []
+    links = {}
+    for meta in list_notes(query, timeout_seconds):
+        key = (meta.notebook, meta.title, meta.created)
+        links.setdefault(key, []).append(meta.link)
+    # Working within dest means the resources folders can be renamed
+    # into place.
+    with TemporaryDirectory(dir=dest, prefix='.via-enex-') as rawtmp:
+        tmp = Path(rawtmp)
+        timings = export_by_notebook(tmp, 'ENEX', query, timeout_seconds,
+                                     jobs=jobs)
+        notebooks = [name for timing in timings for name in timing.notebooks]
+        indexes = _map_files(_split_notebook, [
+            (_notebook_export_path(tmp, name, 'ENEX'),
+             tmp.joinpath('notes', str(i)))
+            for i, name in enumerate(notebooks)], convert_jobs)
+        allocator = _NameAllocator(dest)
+        conversions = []
+        notes = []
+        for notebook, index in zip(notebooks, indexes):
+            for note in index:
+                created = enex.local_iso(note['created'])
+                candidates = links.get((notebook, note['title'], created))
+                meta = NoteMeta(notebook,
+                                candidates.pop(0) if candidates else '',
+                                note['title'], created,
+                                enex.local_iso(note['updated']))
+                path = allocator.allocate(
+                    f'{enex.safe_name(note["title"])}.html')
+                conversions.append(
+                    (note['file'], path, note['media'], _meta_tags(meta)))
+                notes.append((notebook, note['title'], bool(meta.link)))
+        results = _map_files(_convert_note, conversions, convert_jobs)
+        for (_, path, *_), (notebook, title, matched), result in zip(
+                conversions, notes, results):
+            if not isinstance(result, rewrite.RewriteStats):
+                skipped.append((notebook, title, result))
+                continue
+            converted.append(path)
+            if not matched:
+                unmatched.append((notebook, title))
+    if dedup:
+        store = blobs.BlobStore(dest)
+        with ThreadPoolExecutor() as pool:
+            list(pool.map(store.add_note, converted))
+    return ViaEnexResult(len(converted), unmatched, skipped)
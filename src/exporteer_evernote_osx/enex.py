@@ -0,0 +1,347 @@
+"""Processing of ENEX files produced by exporting from the app.
+
+ENEX exports can be many gigabytes when attachments are inlined as
+base64, so the functions here parse them incrementally with expat and
+never hold more than one chunk of the file, or one note's metadata, in
+memory.
+"""
+
+import binascii
+from datetime import datetime, timezone
+import hashlib
+import html.entities
+import json
+from pathlib import Path
+import re
+from urllib.parse import quote
+from xml.etree import ElementTree
+from xml.parsers import expat
+from xml.sax.saxutils import quoteattr
+from exporteer_evernote_osx import rewrite
+
+
+CHUNK_SIZE = 1 << 16
+
+_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<!DOCTYPE en-export SYSTEM '
+           '"http://xml.evernote.com/pub/evernote-export3.dtd">\n')
+
+_ENML_DOCTYPE = ('<!DOCTYPE en-note SYSTEM '
+                 '"http://xml.evernote.com/pub/enml2.dtd">')
+
+_XML_DECLARATION_RE = re.compile(r'\s*<\?xml[^>]*\?>')
+
+_HTML_ENTITIES = {name: chr(codepoint) for name, codepoint
+                  in html.entities.name2codepoint.items()}
+
+_UNSAFE_NAME_RE = re.compile(r'[/\\:\x00-\x1f]')
+
+_EXPORT_TAGS_RE = re.compile('<en-export[^>]*>|</en-export>')
+
+# The en-export start tag only has a few short attributes, so it should
+# always fit within this many characters (see rewrite.iter_matches).
+_EXPORT_TAGS_OVERLAP = 1024
+
+
+def safe_name(name, max_length=70):
+    """Returns name with characters that can't appear in file names
+    replaced, truncated to max_length."""
+    return _UNSAFE_NAME_RE.sub('_', name).strip()[:max_length] or 'Untitled'
+
+
+def local_iso(date):
+    """Converts an ENEX date (e.g. 20200131T235959Z, in UTC) to an ISO 8601
+    string in local time, as reported by the app (see enapp.NoteMeta)."""
+    if not date:
+        return ''
+    utc = datetime.strptime(date, '%Y%m%dT%H%M%SZ').replace(
+        tzinfo=timezone.utc)
+    return utc.astimezone().strftime('%Y-%m-%dT%H:%M:%S')
+
+
+class _Base64Writer:
+    """Decodes base64 text received in arbitrary pieces into a file."""
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.pending = ''
+        self.md5 = hashlib.md5()
+
+    def _write_bytes(self, data):
+        self.file.write(data)
+        self.md5.update(data)
+
+    def write(self, text):
+        text = self.pending + ''.join(text.split())
+        usable = len(text) - len(text) % 4
+        self._write_bytes(binascii.a2b_base64(text[:usable]))
+        self.pending = text[usable:]
+
+    def close(self):
+        if self.pending:
+            self._write_bytes(binascii.a2b_base64(self.pending))
+        self.file.close()
+
+
+class _Splitter:
+    """Expat handlers for split_enex; see there."""
+
+    _FIELDS = {'title', 'created', 'updated'}
+
+    def __init__(self, src, dest, index_file, resources):
+        self.src = Path(src)
+        self.dest = Path(dest)
+        self.index_file = index_file
+        self.resources = resources
+        self.copy_from = open(self.src, 'rb')
+        self.parser = expat.ParserCreate()
+        self.parser.buffer_text = True
+        self.parser.buffer_size = CHUNK_SIZE
+        self.parser.StartElementHandler = self.start
+        self.parser.EndElementHandler = self.end
+        self.parser.CharacterDataHandler = self.text
+        self.stack = []
+        self.export_attrs = {}
+        self.count = 0
+        self.note = None
+
+    def run(self):
+        try:
+            with open(self.src, 'rb') as file:
+                while True:
+                    chunk = file.read(CHUNK_SIZE)
+                    self.parser.Parse(chunk, not chunk)
+                    if not chunk:
+                        break
+        finally:
+            self.copy_from.close()
+        return self.count
+
+    def start(self, name, attrs):
+        parent = self.stack[-1] if self.stack else None
+        self.stack.append(name)
+        if name == 'en-export':
+            self.export_attrs = attrs
+        elif name == 'note' and parent == 'en-export':
+            self.count += 1
+            self.note = {'offset': self.parser.CurrentByteIndex,
+                         'title': '', 'created': '', 'updated': '',
+                         'resources': [], 'media': {}}
+        elif name == 'resource' and self.note is not None:
+            self.resource = {'file_name': '', 'writer': None}
+        elif (name == 'data' and parent == 'resource' and self.resources
+              and self.note is not None):
+            folder = self._resources_folder()
+            folder.mkdir(parents=True, exist_ok=True)
+            self.resource['tmp'] = folder.joinpath(
+                f'.resource-{len(self.note["resources"])}.tmp')
+            self.resource['writer'] = _Base64Writer(self.resource['tmp'])
+
+    def end(self, name):
+        self.stack.pop()
+        if self.note is None:
+            return
+        if name == 'data' and self.resource.get('writer'):
+            self.resource['writer'].close()
+        elif name == 'resource':
+            self._finish_resource()
+        elif name == 'note' and self.stack == ['en-export']:
+            self._finish_note(self.parser.CurrentByteIndex + len('</note>'))
+
+    def text(self, data):
+        if self.note is None or len(self.stack) < 2:
+            return
+        name, parent = self.stack[-1], self.stack[-2]
+        if parent == 'note' and name in self._FIELDS:
+            self.note[name] += data
+        elif name == 'file-name' and parent == 'resource-attributes':
+            self.resource['file_name'] += data
+        elif name == 'data' and self.resource.get('writer'):
+            self.resource['writer'].write(data)
+
+    def _note_stem(self):
+        return f'{self.count:05d}-{safe_name(self.note["title"])}'
+
+    def _resources_folder(self):
+        return self.dest.joinpath(f'{self._note_stem()}.enex.resources')
+
+    def _finish_resource(self):
+        name = safe_name(self.resource['file_name'], 200)
+        if not self.resource['file_name']:
+            name = f'resource-{len(self.note["resources"]) + 1}'
+        if self.resource.get('tmp'):
+            target = self._resources_folder().joinpath(name)
+            suffix = 2
+            while target.exists():
+                target = target.with_name(f'{suffix}-{name}')
+                suffix += 1
+            self.resource['tmp'].rename(target)
+            name = target.name
+            self.note['media'][self.resource['writer'].md5.hexdigest()] = name
+        self.note['resources'].append(name)
+
+    def _finish_note(self, end):
+        path = self.dest.joinpath(f'{self._note_stem()}.enex')
+        note = self.note
+        self.note = None
+        attrs = ''.join(f' {key}={quoteattr(value)}'
+                        for key, value in self.export_attrs.items())
+        with open(path, 'wb') as out:
+            out.write(f'{_HEADER}<en-export{attrs}>\n'.encode('utf-8'))
+            self.copy_from.seek(note['offset'])
+            remaining = end - note['offset']
+            while remaining > 0:
+                chunk = self.copy_from.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                out.write(chunk)
+                remaining -= len(chunk)
+            out.write(b'\n</en-export>\n')
+        self.index_file.write(json.dumps({
+            'file': str(path),
+            'source': str(self.src),
+            'offset': note['offset'],
+            'length': end - note['offset'],
+            'title': note['title'],
+            'created': note['created'],
+            'updated': note['updated'],
+            'resources': note['resources'],
+            'media': note['media'],
+        }) + '\n')
+
+
+def split_enex(src, dest, index_file, resources=False):
+    """Writes each note in the ENEX file src to a separate ENEX file in
+    the directory dest, and returns the number of notes.
+
+    The files are named after the notes' positions and titles. A line of
+    JSON describing each note (its file, title, created and updated dates,
+    and the byte offset and length of the note within src) is written to
+    the text file object index_file. If resources is True, attachments are
+    also decoded into a "<name>.enex.resources" folder beside each note,
+    and the index line's "media" maps the MD5 hash of each one (which is
+    how the note's content refers to it) to its file name.
+    """
+    dest = Path(dest)
+    dest.mkdir(parents=True, exist_ok=True)
+    return _Splitter(src, dest, index_file, resources).run()
+
+
+def concat_enex(srcs, dest):
+    """Writes the notes from each of the ENEX files srcs, in order, into a
+    single ENEX file at dest, whose header is copied from the first.
+
+    The files are copied as text, so notes are never parsed.
+    """
+    with open(dest, 'w', encoding='utf-8') as outfile:
+        started = False
+        for src in srcs:
+            with open(src, encoding='utf-8') as infile:
+                in_export = False
+                header = ''
+                closing = ''
+                for text, match in rewrite.iter_matches(
+                        infile, _EXPORT_TAGS_RE, _EXPORT_TAGS_OVERLAP,
+                        CHUNK_SIZE):
+                    if not in_export:
+                        header += text
+                        if match and match.group(0) != '</en-export>':
+                            if not started:
+                                outfile.write(header + match.group(0))
+                                started = True
+                            in_export = True
+                        continue
+                    # Only an end tag followed by nothing but whitespace
+                    # closes the export; other matches are inside notes'
+                    # content.
+                    if closing:
+                        closing += text
+                        if closing[len('</en-export>'):].strip():
+                            outfile.write(closing)
+                            closing = ''
+                    else:
+                        outfile.write(text)
+                    if match:
+                        outfile.write(closing)
+                        closing = ''
+                        if match.group(0) == '</en-export>':
+                            closing = match.group(0)
+                        else:
+                            outfile.write(match.group(0))
+        if not started:
+            outfile.write(_HEADER + '<en-export>')
+        outfile.write('</en-export>\n')
+
+
+def _enml_to_html(content, media, resources_name):
+    """Converts a note's ENML content to an HTML body element."""
+    if '<!DOCTYPE' not in content:
+        # The DOCTYPE (which declares the HTML entities ENML allows) has
+        # to come after any XML declaration.
+        declaration = _XML_DECLARATION_RE.match(content)
+        end = declaration.end() if declaration else 0
+        content = content[:end] + _ENML_DOCTYPE + content[end:]
+    parser = ElementTree.XMLParser()
+    parser.entity.update(_HTML_ENTITIES)
+    parser.feed(content)
+    body = parser.close()
+    body.tag = 'body'
+    for elem in body.iter():
+        if elem.tag == 'en-media':
+            attrs = dict(elem.attrib)
+            elem.attrib.clear()
+            name = media.get(attrs.get('hash'))
+            src = f'{quote(resources_name)}/{quote(name)}' if name else ''
+            if attrs.get('type', '').startswith('image/'):
+                elem.tag = 'img'
+                elem.attrib.update({key: value for key, value in attrs.items()
+                                    if key in ('alt', 'height', 'style',
+                                               'width')})
+                elem.set('src', src)
+            else:
+                elem.tag = 'a'
+                elem.set('href', src)
+                elem.text = name or attrs.get('hash', '')
+        elif elem.tag == 'en-todo':
+            checked = elem.get('checked') == 'true'
+            elem.tag = 'input'
+            elem.attrib.clear()
+            elem.set('type', 'checkbox')
+            if checked:
+                elem.set('checked', 'checked')
+        elif elem.tag == 'en-crypt':
+            elem.tag = 'span'
+            elem.attrib.clear()
+            elem.text = '[encrypted]'
+    return body
+
+
+def note_to_html(src, dest, resources_name, media, head=''):
+    """Converts a single-note ENEX file (as written by split_enex) to an
+    HTML file at dest, similar to the app's own HTML export.
+
+    Attachments are referred to within the folder named resources_name
+    (relative to dest) by the names given in media, which maps their MD5
+    hashes to file names. head is inserted at the start of the <head>
+    element. Returns the number of bytes written.
+    """
+    fields = {'title': '', 'content': '', 'created': '', 'updated': ''}
+    for _, elem in ElementTree.iterparse(str(src)):
+        if elem.tag in fields:
+            fields[elem.tag] = elem.text or ''
+        elif elem.tag == 'data':
+            # Attachment data isn't needed, so drop it as soon as possible.
+            elem.clear()
+    body = _enml_to_html(fields['content'], media, resources_name)
+    title = html.escape(fields['title'])
+    text = ('<!DOCTYPE html>\n<html><head>' + head +
+            '<meta http-equiv="Content-Type" '
+            'content="text/html; charset=UTF-8"/>'
+            f'<title>{title}</title>'
+            f'<meta name="created" content="{local_iso(fields["created"])}"/>'
+            f'<meta name="updated" content="{local_iso(fields["updated"])}"/>'
+            '</head>' + ElementTree.tostring(body, encoding='unicode',
+                                             method='html') + '</html>\n')
+    data = text.encode('utf-8')
+    Path(dest).write_bytes(data)
+    return len(data)
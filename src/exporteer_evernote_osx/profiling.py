@@ -0,0 +1,173 @@
+"""Optional tracing of where an export spends its time.
+
+When tracing has been started (see start), span() records how long each
+block of code took, and the trace is written to a file in the Chrome
+trace event format (viewable in chrome://tracing or Perfetto). When it
+hasn't, span() returns a shared no-op object, so instrumented code costs
+little more than a function call.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from exporteer_evernote_osx import rewrite
+
+
+_tracer = None
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('tracer', 'name', 'args', 'start')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.record(self.name, self.start,
+                           time.perf_counter() - self.start, self.args)
+        return False
+
+    def set(self, **args):
+        """Adds arguments to the span's trace event, e.g. byte counts
+        that are only known at the end."""
+        self.args.update(args)
+
+
+class _Summary:
+    __slots__ = ('count', 'seconds', 'bytes_read', 'bytes_written')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+
+class Tracer:
+    """Writes trace events to a file and keeps per-name totals."""
+
+    def __init__(self, path):
+        self.file = open(path, 'w')
+        self.file.write('[\n')
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+        self.first = True
+        self.summaries = {}
+
+    def record(self, name, start, duration, args, pid=None, tid=None):
+        event = {
+            'name': name,
+            'ph': 'X',
+            'ts': round((start - self.origin) * 1e6),
+            'dur': round(duration * 1e6),
+            'pid': pid or os.getpid(),
+            'tid': tid or threading.get_ident(),
+            'args': args,
+        }
+        line = json.dumps(event, default=str)
+        with self.lock:
+            if not self.first:
+                self.file.write(',\n')
+            self.first = False
+            self.file.write(line)
+            summary = self.summaries.setdefault(name, _Summary())
+            summary.count += 1
+            summary.seconds += duration
+            summary.bytes_read += args.get('bytes_read', 0)
+            summary.bytes_written += args.get('bytes_written', 0)
+
+    def close(self, summary_file=sys.stderr):
+        """Finishes the trace file and prints the per-name totals."""
+        self.file.write('\n]\n')
+        self.file.close()
+        print(f'{"span":24} {"count":>8} {"seconds":>10} {"mean ms":>9} '
+              f'{"MiB read":>9} {"MiB written":>11}', file=summary_file)
+        for name, s in sorted(self.summaries.items(),
+                              key=lambda item: -item[1].seconds):
+            print(f'{name:24} {s.count:8d} {s.seconds:10.3f} '
+                  f'{s.seconds / s.count * 1000:9.2f} '
+                  f'{s.bytes_read / 2**20:9.1f} {s.bytes_written / 2**20:11.1f}',
+                  file=summary_file)
+
+
+def start(path):
+    """Starts tracing to the file at path."""
+    global _tracer
+    _tracer = Tracer(path)
+
+
+def stop():
+    """Stops tracing, finishing the file and printing a summary to stderr."""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer:
+        tracer.close()
+
+
+def enabled():
+    return _tracer is not None
+
+
+def span(name, **args):
+    """Returns a context manager that records how long its block takes.
+
+    The keyword arguments are included in the trace event; bytes_read and
+    bytes_written are also totalled in the summary.
+    """
+    if _tracer is None:
+        return _NULL_SPAN
+    return _Span(_tracer, name, args)
+
+
+def stats_args(stats):
+    """Returns span arguments for a rewrite.RewriteStats."""
+    return {'files': stats.files, 'bytes_read': stats.bytes_read,
+            'bytes_written': stats.bytes_written}
+
+
+def traced(func, *args):
+    """Calls func, returning its result along with timing information
+    that record_traced can add to the trace.
+
+    This is for work done in other processes, which can't write to the
+    trace themselves.
+    """
+    start = time.perf_counter()
+    result = func(*args)
+    duration = time.perf_counter() - start
+    return result, (func.__name__.lstrip('_'), start, duration,
+                    os.getpid(), threading.get_ident(), str(args[0]))
+
+
+def record_traced(traced_result):
+    """Records the timing from a result of traced, and returns the
+    original result."""
+    result, (name, start, duration, pid, tid, subject) = traced_result
+    args = {'path': subject}
+    if isinstance(result, rewrite.RewriteStats):
+        args.update(stats_args(result))
+    if _tracer:
+        _tracer.record(name, start, duration, args, pid=pid, tid=tid)
+    return result
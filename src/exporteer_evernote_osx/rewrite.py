@@ -0,0 +1,108 @@
+"""Streaming substitutions in exported HTML files.
+
+The functions here only hold a bounded amount of a file's text in memory
+at once, so notes with large inlined data don't need several full copies
+of their contents.
+"""
+
+from collections import namedtuple
+import os
+from pathlib import Path
+
+
+CHUNK_SIZE = 1 << 16
+
+
+RewriteStats = namedtuple(
+    'RewriteStats', ['files', 'bytes_read', 'bytes_written'],
+    defaults=(0, 0, 0))
+
+
+def total(stats):
+    """Adds up an iterable of RewriteStats."""
+    return RewriteStats(*(sum(values) for values in zip(*stats)))
+
+
+def iter_matches(file, pattern, overlap, chunk_size=CHUNK_SIZE):
+    """Finds matches of pattern in a text file object, reading it in chunks.
+
+    Yields (text, match) pairs, where text is the input between the
+    previous match and this one. The last pair yielded has a match of None
+    and contains the rest of the input.
+
+    A match is only recognized if its first overlap characters are enough
+    to tell it apart (for literal patterns, overlap should be the length
+    of the longest one). Matches may be longer than overlap if they end
+    with a repetition such as [^<]*: a match reaching the end of what has
+    been read so far is held back, and the buffer grows to hold the
+    whole match. A match longer than overlap that must end with some
+    other text (such as [^<]*</title>) may be missed if that text isn't
+    read in the same chunk as the match's start.
+    """
+    buf = ''
+    eof = False
+    while not eof:
+        chunk = file.read(chunk_size)
+        eof = not chunk
+        buf += chunk
+        cut = len(buf) if eof else max(len(buf) - overlap, 0)
+        pos = 0
+        for match in pattern.finditer(buf):
+            if match.start() >= cut:
+                break
+            if match.end() == len(buf) and not eof:
+                # The match might continue into the next chunk.
+                cut = match.start()
+                break
+            yield buf[pos:match.start()], match
+            pos = match.end()
+        cut = max(cut, pos)
+        if cut > pos:
+            yield buf[pos:cut], None
+        buf = buf[cut:]
+
+
+def rewrite(src, dest, pattern, replace, overlap, keep_text=None,
+            chunk_size=CHUNK_SIZE):
+    """Copies src to dest, replacing each match of pattern with the string
+    returned by calling replace with the match.
+
+    If keep_text is given, it is called with each piece of text between
+    matches (after replace has been called for the preceding match), and
+    pieces for which it returns False are left out; this allows removing
+    a section delimited by matches of unbounded length.
+
+    See iter_matches for the meaning of overlap and chunk_size. The output
+    is written to a temporary file alongside dest, which is then renamed
+    over dest. If src and dest are the same file and no replacement
+    changed anything, the file is left untouched.
+
+    Returns a RewriteStats for the file.
+    """
+    src = Path(src)
+    dest = Path(dest)
+    tmp = dest.with_name(f'.{dest.name}.tmp')
+    changed = False
+    try:
+        with open(src) as infile, open(tmp, 'w') as outfile:
+            for text, match in iter_matches(infile, pattern, overlap,
+                                            chunk_size):
+                if keep_text is None or keep_text(text):
+                    outfile.write(text)
+                elif text:
+                    changed = True
+                if match:
+                    replacement = replace(match)
+                    changed = changed or replacement != match.group(0)
+                    outfile.write(replacement)
+        bytes_read = src.stat().st_size
+        if not changed and src == dest:
+            tmp.unlink()
+            return RewriteStats(bytes_read=bytes_read)
+        bytes_written = tmp.stat().st_size
+        os.replace(tmp, dest)
+    except BaseException:
+        if tmp.exists():
+            tmp.unlink()
+        raise
+    return RewriteStats(1, bytes_read, bytes_written)
@@ -0,0 +1,194 @@
+"""Ways of running AppleScript, used by the enapp module.
+
+A script runner is any object with a run(script) method that executes
+the AppleScript source and returns its result as text, formatted like
+the output of `osascript -ss` (so a list of strings looks like
+{"a", "b"}), and raises ScriptError if the script fails. ScriptRunner
+provides a submit method on top of that for running scripts in the
+background. This makes it possible to substitute a fake runner, e.g. for
+exercising the rest of the package without the Evernote app.
+"""
+
+from concurrent.futures import Future
+import subprocess
+import threading
+from exporteer_evernote_osx import profiling
+
+
+class ScriptError(Exception):
+    pass
+
+
+class ScriptRunner:
+    """Base class for script runners."""
+
+    def run(self, script):
+        """Runs the AppleScript source and returns its result as text."""
+        raise NotImplementedError
+
+    def submit(self, script):
+        """Starts running the script in the background, returning a
+        concurrent.futures.Future for the result of run.
+
+        The run is recorded as an "osascript" span by the background
+        thread, so it doesn't include the caller's work in the meantime.
+        """
+        future = Future()
+
+        def target():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                with profiling.span('osascript', script_bytes=len(script)):
+                    result = self.run(script)
+                future.set_result(result)
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=target, daemon=True).start()
+        return future
+
+    def close(self):
+        """Releases any resources held by the runner."""
+
+
+class OsascriptRunner(ScriptRunner):
+    """Runs each script in a new osascript process."""
+
+    def run(self, script):
+        try:
+            out = subprocess.check_output(
+                ['osascript', '-e', script, '-ss'], stderr=subprocess.PIPE)
+        except subprocess.CalledProcessError as e:
+            raise ScriptError(str(e.stderr, 'utf-8').strip()) from e
+        return str(out, 'utf-8').strip()
+
+
+# JavaScript for Automation program that reads scripts from stdin and
+# runs them with NSAppleScript. Each request is the byte length of the
+# script on a line by itself, followed by the UTF-8 script. Each response
+# is "ok" or "error" and the byte length of the payload on one line,
+# followed by the payload.
+_SERVER_JS = r"""
+ObjC.import('Foundation');
+var stdin = $.NSFileHandle.fileHandleWithStandardInput;
+var stdout = $.NSFileHandle.fileHandleWithStandardOutput;
+
+function readLine() {
+    var line = '';
+    while (true) {
+        var data = stdin.readDataOfLength(1);
+        if (data.length == 0) return null;
+        var ch = $.NSString.alloc.initWithDataEncoding(data, $.NSUTF8StringEncoding).js;
+        if (ch == '\n') return line;
+        line += ch;
+    }
+}
+
+function fourCC(s) {
+    return (s.charCodeAt(0) << 24) + (s.charCodeAt(1) << 16) + (s.charCodeAt(2) << 8) + s.charCodeAt(3);
+}
+
+function format(desc) {
+    var type = desc.descriptorType;
+    if (type == fourCC('list')) {
+        var items = [];
+        for (var i = 1; i <= desc.numberOfItems; i++) {
+            items.push(format(desc.descriptorAtIndex(i)));
+        }
+        return '{' + items.join(', ') + '}';
+    }
+    if (type == fourCC('true')) return 'true';
+    if (type == fourCC('fals')) return 'false';
+    if (type == fourCC('bool')) return desc.booleanValue ? 'true' : 'false';
+    if (type == fourCC('null')) return '';
+    if (type == fourCC('utxt') || type == fourCC('TEXT') || type == fourCC('utf8')) {
+        var s = desc.stringValue.js;
+        return '"' + s.replace(/\\/g, '\\\\').replace(/"/g, '\\"') + '"';
+    }
+    var str = desc.stringValue;
+    return str.isNil() ? '' : str.js;
+}
+
+function respond(status, payload) {
+    var body = $.NSString.alloc.initWithString(payload).dataUsingEncoding($.NSUTF8StringEncoding);
+    var head = $.NSString.alloc.initWithString(status + ' ' + body.length + '\n').dataUsingEncoding($.NSUTF8StringEncoding);
+    stdout.writeData(head);
+    stdout.writeData(body);
+}
+
+while (true) {
+    var header = readLine();
+    if (header === null) break;
+    var data = stdin.readDataOfLength(parseInt(header, 10));
+    var source = $.NSString.alloc.initWithDataEncoding(data, $.NSUTF8StringEncoding);
+    var script = $.NSAppleScript.alloc.initWithSource(source);
+    var error = Ref();
+    var result = script.executeAndReturnError(error);
+    if (result.isNil()) {
+        var message = error[0].objectForKey('NSAppleScriptErrorMessage');
+        respond('error', message.isNil() ? 'unknown error' : message.js);
+    } else {
+        respond('ok', format(result));
+    }
+}
+"""
+
+
+class PersistentRunner(ScriptRunner):
+    """Runs scripts in a long-lived osascript process, avoiding the cost
+    of starting a new process and interpreter for every script.
+
+    If scripts are run concurrently, extra processes are started as
+    needed (each runs one script at a time); idle processes are reused.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = []
+        self.procs = []
+
+    def _start(self):
+        proc = subprocess.Popen(
+            ['osascript', '-l', 'JavaScript', '-e', _SERVER_JS],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        with self.lock:
+            self.procs.append(proc)
+        return proc
+
+    def _discard(self, proc):
+        with self.lock:
+            self.procs.remove(proc)
+        proc.kill()
+        proc.wait()
+
+    def run(self, script):
+        with self.lock:
+            proc = self.idle.pop() if self.idle else None
+        if not proc:
+            proc = self._start()
+        try:
+            data = script.encode('utf-8')
+            proc.stdin.write(f'{len(data)}\n'.encode('ascii'))
+            proc.stdin.write(data)
+            proc.stdin.flush()
+            header = proc.stdout.readline()
+            if not header:
+                raise ScriptError('osascript process exited unexpectedly')
+            status, length = str(header, 'ascii').split()
+            payload = str(proc.stdout.read(int(length)), 'utf-8')
+        except BaseException:
+            self._discard(proc)
+            raise
+        with self.lock:
+            self.idle.append(proc)
+        if status != 'ok':
+            raise ScriptError(payload)
+        return payload.strip()
+
+    def close(self):
+        with self.lock:
+            procs, self.procs, self.idle = self.procs, [], []
+        for proc in procs:
+            proc.stdin.close()
+            proc.wait()
@@ -0,0 +1,124 @@
+"""Keeping an enhanced export up to date continuously."""
+
+from datetime import datetime
+import os
+from pathlib import Path
+import sys
+import time
+from exporteer_evernote_osx import enapp, profiling, transport
+
+
+STATE_NAME = '.watch-state.json'
+
+STATUS_NAME = '.watch-status.json'
+
+
+class _Status:
+    """The contents of the status file, which is rewritten (atomically)
+    whenever they change."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.data = {
+            'state': 'starting',
+            'pid': os.getpid(),
+            'cycles': 0,
+            'queue_depth': 0,
+            'last_cycle_started': None,
+            'last_cycle_seconds': None,
+            'last_cycle_notes': None,
+            'notes_per_second': None,
+            'last_error': None,
+            'next_cycle': None,
+        }
+
+    def update(self, **values):
+        self.data.update(values)
+        enapp.write_json_atomic(self.path, self.data)
+
+
+def _now():
+    return datetime.now().isoformat(timespec='seconds')
+
+
+def _cycle(dest, state_file, query, timeout_seconds, sync, jobs, status):
+    """Runs one sync, export, merge and relink, updating status, and
+    returns the number of notes exported."""
+    if sync:
+        status.update(state='syncing')
+        enapp.start_sync()
+        enapp.await_sync(timeout_seconds)
+    state, pending_query = enapp.incremental_query(query, state_file)
+    # The first cycle exports every note, so counting them beforehand
+    # would add a search of the whole account; the depth is left unknown.
+    pending = None
+    if state.get('updated'):
+        pending = enapp.count_notes(pending_query, timeout_seconds)
+    status.update(state='exporting', queue_depth=pending)
+    exported = 0
+
+    def on_note(path, meta):
+        nonlocal exported
+        exported += 1
+        if pending is not None:
+            status.update(queue_depth=max(pending - exported, 0))
+
+    start = time.monotonic()
+    count = enapp.export_incremental(dest, state_file, query,
+                                     timeout_seconds, on_note=on_note)
+    seconds = time.monotonic() - start
+    status.update(queue_depth=0,
+                  notes_per_second=count / seconds if count else None)
+    if count:
+        status.update(state='relinking')
+        enapp.relink(dest, jobs=jobs)
+    return count
+
+
+def watch(dest, query='', interval_seconds=5*60, timeout_seconds=30*60,
+          sync=True, jobs=None, status_file=None, cycles=0):
+    """Keeps dest up to date with the notes matching query, until
+    interrupted (or until cycles cycles have run, if cycles is nonzero).
+
+    Every interval_seconds (measured from the start of the previous
+    cycle), the app is told to sync (unless sync is False) and the notes
+    modified since the previous cycle are exported with extra metadata
+    and merged into dest (see enapp.export_incremental, whose state file
+    is kept in dest; see STATE_NAME), and then dest is relinked (which
+    only scans the changed files; see enapp.relink).
+
+    A failed cycle is recorded in the status and retried at the next
+    interval. The status is written as JSON to status_file (by default,
+    STATUS_NAME within dest), and includes the state ("syncing",
+    "exporting", "relinking" or "idle"), the number of notes still to be
+    exported in the current cycle (None during the first cycle, which
+    exports every note), and the duration, number of notes and
+    export rate of the last cycle.
+    """
+    dest = Path(dest).resolve()
+    dest.mkdir(parents=True, exist_ok=True)
+    state_file = dest.joinpath(STATE_NAME)
+    status = _Status(status_file or dest.joinpath(STATUS_NAME))
+    completed = 0
+    while True:
+        start = time.monotonic()
+        status.update(last_cycle_started=_now())
+        try:
+            with profiling.span('watch_cycle'):
+                count = _cycle(dest, state_file, query, timeout_seconds,
+                               sync, jobs, status)
+            status.update(last_cycle_notes=count, last_error=None)
+        except (transport.ScriptError, enapp.SyncTimeoutException,
+                OSError) as e:
+            print(f'watch cycle failed: {e}', file=sys.stderr)
+            status.update(last_error=str(e), queue_depth=0)
+        seconds = time.monotonic() - start
+        completed += 1
+        status.update(cycles=completed, last_cycle_seconds=seconds)
+        if cycles and completed >= cycles:
+            status.update(state='stopped', next_cycle=None)
+            return
+        delay = max(interval_seconds - seconds, 0)
+        status.update(state='idle', next_cycle=datetime.fromtimestamp(
+            time.time() + delay).isoformat(timespec='seconds'))
+        time.sleep(delay)
@@ -0,0 +1,185 @@
+from collections import namedtuple
+from datetime import datetime, timezone
+import re
+from pathlib import Path
+import pytest
+from exporteer_evernote_osx import enapp, transport
+
+
+FakeNote = namedtuple(
+    'FakeNote', ['notebook', 'link', 'title', 'created', 'updated', 'body',
+                 'resources'])
+
+
+class FakeApp(transport.ScriptRunner):
+    """Stands in for the Evernote app, answering the scripts the enapp
+    module sends for notes held in memory.
+
+    Queries may only contain notebook:, created: and updated: terms
+    (optionally negated), which is enough for the scripts enapp builds.
+    If fail_after is set, the next export script fails once that many
+    notes have been exported by it.
+    """
+
+    def __init__(self):
+        self.notes = []
+        self.added = 0
+        self.fail_after = None
+        self.exported = []
+
+    def add(self, title, notebook='Notes', created='2020-01-01T00:00:00',
+            updated=None, body='', resources=None):
+        """Adds a note, with resources mapping file names to bytes, and
+        returns it."""
+        self.added += 1
+        link = f'evernote:///view/1/s1/n{self.added}/n{self.added}/'
+        note = FakeNote(notebook, link, title, created, updated or created,
+                        body, resources or {})
+        self.notes.append(note)
+        return note
+
+    def edit(self, note, **changes):
+        index = self.notes.index(note)
+        self.notes[index] = note._replace(**changes)
+        return self.notes[index]
+
+    def remove(self, note):
+        self.notes.remove(note)
+
+    def matches(self, query):
+        found = []
+        terms = re.findall(r'(-?)(\w+):("[^"]*"|\S+)', query)
+        for note in self.notes:
+            ok = True
+            for negated, key, value in terms:
+                if key == 'notebook':
+                    result = note.notebook == value.strip('"')
+                else:
+                    date = re.sub('[-:]', '', getattr(note, key))
+                    result = date[:len(value)] >= value
+                ok = ok and result != bool(negated)
+            if ok:
+                found.append(note)
+        return found
+
+    def run(self, script):
+        queries = [query.replace('\\"', '"') for query in re.findall(
+            r'find notes (?:\(?)"((?:[^"\\]|\\.)*)"', script)]
+        files = re.findall(r'POSIX file "((?:[^"\\]|\\.)*)"', script)
+        if 'isSynchronizing' in script:
+            return 'false'
+        if 'synchronize' in script:
+            return ''
+        if 'name of notebooks' in script:
+            names = sorted({note.notebook for note in self.notes})
+            return '{' + ', '.join(f'"{name}"' for name in names) + '}'
+        if 'theCount' in script:
+            with open(files[0], 'a') as out:
+                for name in sorted({note.notebook for note in self.notes}):
+                    count = len(self.matches(f'notebook:"{name}"'))
+                    out.write(f'{name}\x1f{count}\n')
+            return ''
+        if 'count of (find notes' in script:
+            with open(files[0], 'a') as out:
+                for query in queries:
+                    out.write(f'{len(self.matches(query))}\n')
+            return ''
+        if 'count of attachments' in script:
+            with open(files[0], 'a') as out:
+                for index, note in enumerate(self.matches(queries[0]), 1):
+                    out.write(self._meta_line(index, note)
+                              + f'\x1f{len(note.resources)}\n')
+            return ''
+        if 'theNoteIndex from' in script:
+            return self._export_by_note(script, queries[0], files)
+        results = []
+        for query, dest in zip(queries[len(queries) - len(files):], files):
+            notes = self.matches(query)
+            results.append(bool(notes))
+            if notes or 'set results' not in script:
+                self._export(notes, Path(dest), 'format ENEX' in script)
+        return 'true' if all(results) else 'false'
+
+    def _meta_line(self, index, note):
+        return '\x1f'.join([str(index), note.notebook, note.link,
+                            note.title, note.created, note.updated])
+
+    def _count_export(self, note):
+        if self.fail_after is not None and self.fail_after <= 0:
+            self.fail_after = None
+            raise transport.ScriptError('the app failed')
+        self.exported.append(note.link)
+        if self.fail_after is not None:
+            self.fail_after -= 1
+
+    def _export_by_note(self, script, query, files):
+        meta_path = files[0]
+        dest = re.search(r'POSIX file \("((?:[^"\\]|\\.)*)/" & folderIndex',
+                         script).group(1)
+        start = int(re.search(r'from (\d+) to lastIndex', script).group(1))
+        limit = int(re.search(r'if (\d+) > 0 and', script).group(1))
+        notes = self.matches(query)[start - 1:]
+        if limit:
+            notes = notes[:limit]
+        with open(meta_path, 'a', encoding='utf-8') as meta:
+            for index, note in enumerate(notes, 1):
+                meta.write(self._meta_line(index, note) + '\n')
+                meta.flush()
+                self._count_export(note)
+                self._write_html(note, Path(f'{dest}/{index}'))
+        return ''
+
+    def _write_html(self, note, folder):
+        folder.mkdir(parents=True)
+        name = _file_name(note.title)
+        images = ''.join(f'<img src="{name}.resources/{file}">'
+                         for file in note.resources)
+        folder.joinpath(f'{name}.html').write_text(
+            f'<html><head><title>{note.title}</title></head>'
+            f'<body>{note.body}{images}</body></html>')
+        if note.resources:
+            resources = folder.joinpath(f'{name}.resources')
+            resources.mkdir()
+            for file, data in note.resources.items():
+                resources.joinpath(file).write_bytes(data)
+
+    def _enex_note(self, note):
+        def utc(local):
+            return datetime.fromisoformat(local).astimezone(
+                timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+        return (f'<note><title>{note.title}</title><content><![CDATA['
+                '<?xml version="1.0" encoding="UTF-8"?>'
+                f'<en-note>{note.body}</en-note>]]></content>'
+                f'<created>{utc(note.created)}</created>'
+                f'<updated>{utc(note.updated)}</updated></note>\n')
+
+    def _export(self, notes, dest, enex):
+        if enex:
+            dest.write_text(
+                '<?xml version="1.0" encoding="UTF-8"?>\n<en-export>\n'
+                + ''.join(self._enex_note(note) for note in notes)
+                + '</en-export>\n')
+            for note in notes:
+                self._count_export(note)
+            return
+        dest.mkdir(parents=True, exist_ok=True)
+        for note in notes:
+            self._count_export(note)
+            self._write_html(note, dest.joinpath('.tmp'))
+            for path in dest.joinpath('.tmp').iterdir():
+                path.rename(dest.joinpath(path.name))
+            dest.joinpath('.tmp').rmdir()
+
+
+def _file_name(title):
+    return title.replace('/', '_').replace(':', '_')
+
+
+@pytest.fixture
+def app(monkeypatch):
+    """Returns a FakeApp that enapp sends its scripts to."""
+    fake = FakeApp()
+    monkeypatch.setattr(enapp, '_runner', fake)
+    monkeypatch.setattr(enapp, '_EXPORT_POLL_SECONDS', 0.001)
+    return fake
@@ -0,0 +1,35 @@
+import asyncio
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import pytest
+from exporteer_evernote_osx import aio
+
+
+@pytest.fixture
+def async_app(app, monkeypatch):
+    monkeypatch.setattr(aio, '_runner', aio.ThreadedRunner(app))
+    return app
+
+
+def test_export_enhanced(async_app):
+    async_app.add('One', notebook='Work')
+    async_app.add('Two', notebook='Home')
+    seen = []
+
+    async def main():
+        with TemporaryDirectory() as rawpath:
+            path = Path(rawpath).joinpath('out')
+            assert await aio.export_enhanced(
+                path, on_note=lambda path, meta: seen.append(path.name))
+            return sorted(p.name for p in path.iterdir())
+
+    assert asyncio.run(main()) == ['One.html', 'Two.html']
+    assert seen == ['One.html', 'Two.html']
+
+
+def test_runner_works_across_loops(async_app):
+    async_app.add('One', notebook='Work')
+    # Each asyncio.run call has a new loop, whose semaphore is separate.
+    for _ in range(2):
+        assert asyncio.run(aio.list_notebooks()) == ['Work']
+        assert asyncio.run(aio.count_notes_by_notebook()) == {'Work': 1}
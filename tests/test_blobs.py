@@ -0,0 +1,84 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from urllib.parse import quote
+from exporteer_evernote_osx import blobs
+
+
+def _note(folder, name, resources):
+    path = folder.joinpath(f'{name}.html')
+    respath = folder.joinpath(f'{name}.html.resources')
+    respath.mkdir(parents=True)
+    images = ''
+    for file, data in resources.items():
+        respath.joinpath(file).write_bytes(data)
+        images += f'<img src="{quote(respath.name)}/{quote(file)}">'
+    path.write_text(f'<html><body>{images}</body></html>')
+    return path
+
+
+def _blob(data, suffix='.png'):
+    name = hashlib.sha256(data).hexdigest() + suffix
+    return f'{blobs.BLOBS_DIR_NAME}/{name}'
+
+
+def test_dedup_resources_hard_links():
+    with TemporaryDirectory() as rawpath:
+        folder = Path(rawpath)
+        one = _note(folder, 'One', {'logo.PNG': b'logo', 'a.txt': b'a'})
+        two = _note(folder, 'Two two', {'logo.png': b'logo'})
+        html = two.read_text()
+        assert blobs.dedup_resources(folder, jobs=2) == len(b'logo')
+        blob = folder.joinpath(_blob(b'logo'))
+        assert os.path.samefile(
+            folder.joinpath('One.html.resources', 'logo.PNG'), blob)
+        assert os.path.samefile(
+            folder.joinpath('Two two.html.resources', 'logo.png'), blob)
+        assert folder.joinpath(_blob(b'a', '.txt')).read_bytes() == b'a'
+        assert one.with_name('One.html.resources').is_dir()
+        assert two.read_text() == html
+        # Running again finds nothing more to free.
+        assert blobs.dedup_resources(folder) == 0
+
+
+def test_dedup_resources_without_hard_links(monkeypatch):
+    def link(src, dest):
+        raise PermissionError('hard links are not supported')
+
+    monkeypatch.setattr(os, 'link', link)
+    with TemporaryDirectory() as rawpath:
+        folder = Path(rawpath)
+        one = _note(folder, 'One', {'logo.png': b'logo'})
+        two = _note(folder, 'Two two', {'logo.png': b'logo', 'b.png': b'b'})
+        assert blobs.dedup_resources(folder, jobs=1) == len(b'logo')
+        assert folder.joinpath(_blob(b'logo')).read_bytes() == b'logo'
+        assert folder.joinpath(_blob(b'b')).read_bytes() == b'b'
+        # The attachments are moved out, and the notes link to the copies
+        # in the store instead.
+        assert not folder.joinpath('One.html.resources').exists()
+        assert not folder.joinpath('Two two.html.resources').exists()
+        assert one.read_text() == (
+            f'<html><body><img src="{_blob(b"logo")}"></body></html>')
+        assert two.read_text() == (
+            f'<html><body><img src="{_blob(b"logo")}">'
+            f'<img src="{_blob(b"b")}"></body></html>')
+
+
+def test_blob_store_concurrent_notes():
+    with TemporaryDirectory() as rawpath:
+        folder = Path(rawpath)
+        data = b'x' * 100000
+        paths = [_note(folder, f'Note {i}', {'big.png': data})
+                 for i in range(20)]
+        store = blobs.BlobStore(folder)
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            freed = sum(pool.map(store.add_note, paths))
+        assert freed == 19 * len(data)
+        blob = folder.joinpath(_blob(data))
+        for path in paths:
+            assert os.path.samefile(
+                path.with_name(f'{path.name}.resources').joinpath('big.png'),
+                blob)
+        assert os.stat(blob).st_nlink == 21
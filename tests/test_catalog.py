@@ -0,0 +1,44 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from exporteer_evernote_osx import catalog, enapp
+
+
+def _meta(title):
+    return enapp.NoteMeta('Notes', f'evernote:///view/{title}/', title,
+                          '2020-01-01T00:00:00', '2020-01-02T00:00:00', 1)
+
+
+def test_catalog_get_put(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(catalog.time, 'time', lambda: now[0])
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath).joinpath('cache', 'catalog.sqlite')
+        with catalog.Catalog(path, ttl_seconds=60) as cat:
+            assert cat.get('') is None
+            cat.put('', [_meta('a'), _meta('b')])
+            cat.put('tag:x', [_meta('c')])
+            assert cat.get('') == [tuple(_meta('a')), tuple(_meta('b'))]
+            # Putting a query's results again replaces them.
+            cat.put('', [_meta('d')])
+            assert cat.get('') == [tuple(_meta('d'))]
+            assert cat.get('tag:x') == [tuple(_meta('c'))]
+            assert cat.get('tag:y') is None
+
+        now[0] += 61
+        with catalog.Catalog(path, ttl_seconds=120) as cat:
+            assert cat.get('') == [tuple(_meta('d'))]
+        with catalog.Catalog(path, ttl_seconds=0) as cat:
+            assert cat.get('') is None
+
+
+def test_list_notes_uses_catalog(app):
+    app.add('One')
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath).joinpath('catalog.sqlite')
+        with catalog.Catalog(path) as cat:
+            first = enapp.list_notes(catalog=cat)
+            app.add('Two')
+            assert enapp.list_notes(catalog=cat) == first
+        with catalog.Catalog(path, ttl_seconds=0) as cat:
+            assert [note.title for note in enapp.list_notes(catalog=cat)] \
+                == ['One', 'Two']
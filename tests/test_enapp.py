@@ -0,0 +1,131 @@
+from datetime import date
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import time
+import pytest
+from exporteer_evernote_osx import enapp
+
+
+def test_name_allocator():
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath)
+        path.joinpath('Note.html').touch()
+        path.joinpath('2-Note.html').touch()
+        allocator = enapp._NameAllocator(path)
+        # Names are compared case- and normalization-insensitively.
+        assert allocator.allocate('note.html').name == '3-note.html'
+        assert allocator.allocate('NOTE.html').name == '4-NOTE.html'
+        assert allocator.allocate('Café.html').name == 'Café.html'
+        assert allocator.allocate('Café.html').name == '2-Café.html'
+        assert allocator.allocate('x' * 100 + '.html').name == (
+            'x' * 70 + '.html')
+        assert allocator.allocate('other.html') == path.joinpath('other.html')
+
+
+def test_name_allocator_missing_folder():
+    with TemporaryDirectory() as rawpath:
+        allocator = enapp._NameAllocator(Path(rawpath).joinpath('new'))
+        assert allocator.allocate('a.html').name == 'a.html'
+        assert allocator.allocate('a.html').name == '2-a.html'
+
+
+@pytest.fixture
+def counting_app(app):
+    notes = ([('Work', '1999-05-05')] * 3 + [('Work', '2015-01-01')] * 40
+             + [('Home', '2020-03-15')] * 30 + [('Home', '2020-03-16')] * 5
+             + [('Misc', f'{date.today().year}-01-01')])
+    for notebook, created in notes:
+        app.add('Note', notebook=notebook, created=f'{created}T12:00:00')
+    return app
+
+
+def _covers(app, shards):
+    # Every note matches exactly one shard's queries.
+    queries = [query for shard in shards for query in shard['queries']]
+    for note in app.notes:
+        assert sum(note in app.matches(query) for query in queries) == 1
+
+
+def test_shard_plan_by_date(counting_app):
+    shards = enapp._shard_plan('created', '', 20, 60)
+    _covers(counting_app, shards)
+    assert [shard['notes'] for shard in shards] == [3, 40, 30, 6]
+    assert shards[2]['queries'] == ['created:20200315 -created:20200316']
+    assert len(counting_app.matches(shards[1]['queries'][0])) == 40
+
+
+def test_shard_plan_by_date_keeps_query(counting_app):
+    shards = enapp._shard_plan('created', 'notebook:"Home"', 100, 60)
+    assert shards == [{'queries': ['notebook:"Home"'], 'notes': 35}]
+
+
+def test_shard_plan_by_notebook(counting_app):
+    shards = enapp._shard_plan('notebook', '', 40, 60)
+    _covers(counting_app, shards)
+    assert shards == [
+        {'queries': ['notebook:"Work"'], 'notes': 43},
+        {'queries': ['notebook:"Home"', 'notebook:"Misc"'], 'notes': 36},
+    ]
+
+
+def test_shard_plan_rejects_queries(counting_app):
+    with pytest.raises(Exception):
+        enapp._shard_plan('notebook', 'notebook:x', 10, 60)
+    with pytest.raises(ValueError):
+        enapp._shard_plan('created', 'any: tag:a tag:b', 10, 60)
+    with pytest.raises(ValueError):
+        enapp._shard_plan('title', '', 10, 60)
+
+
+def test_date_ranges_halve_large_ranges(counting_app):
+    ranges = enapp._date_ranges('created', '', 20, 60)
+    assert sum(count for _, _, count in ranges) == len(counting_app.notes)
+    for (_, end, _), (start, _, _) in zip(ranges, ranges[1:]):
+        assert end == start
+    assert ranges[0][0] is None and ranges[-1][1] is None
+    big = [r for r in ranges if r[2] > 20]
+    assert big == [[date(2015, 1, 1), date(2015, 1, 2), 40],
+                   [date(2020, 3, 15), date(2020, 3, 16), 30]]
+
+
+def test_await_sync_deadline_includes_first_check(monkeypatch):
+    checks = []
+
+    def check_sync():
+        checks.append(True)
+        time.sleep(0.05)
+        return True
+
+    monkeypatch.setattr(enapp, 'check_sync', check_sync)
+    with pytest.raises(enapp.SyncTimeoutException):
+        enapp.await_sync(timeout_seconds=0.01)
+    # The first check used up the timeout, so there's no second one.
+    assert len(checks) == 1
+
+
+def test_notebook_batches_caps_small_groups():
+    counts = {'Big': 50, 'Empty': 0, 'A': 8, 'B': 7, 'C': 6, 'D': 5}
+    assert enapp._notebook_batches(counts, 10, 15) == [
+        ['Big'], ['A', 'B'], ['C', 'D']]
+    assert enapp._notebook_batches(counts, 10, 100) == [
+        ['Big'], ['A', 'B', 'C', 'D']]
+
+
+def test_sidecar_tail_waits_for_whole_characters():
+    line = '\x1f'.join(['1', 'Notes', 'evernote:///view/1/s1/n1/n1/',
+                        'Café', '2020-01-01T00:00:00',
+                        '2020-01-01T00:00:00']) + '\n'
+    data = (line + line.replace('1', '2', 1)).encode('utf-8')
+    cut = data.index('é'.encode('utf-8')) + 1
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath).joinpath('notes.meta')
+        path.write_bytes(data[:cut])
+        with open(path, 'rb') as meta_file:
+            tail = enapp._SidecarTail(Path(rawpath), meta_file)
+            assert tail.poll() == []
+            with open(path, 'ab') as out:
+                out.write(data[cut:])
+            done = tail.poll()
+            assert [(folder.name, meta.title) for folder, meta in done] == [
+                ('1', 'Café')]
+            assert tail.last()[0].name == '2'
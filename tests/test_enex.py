@@ -0,0 +1,105 @@
+import base64
+import hashlib
+import io
+import json
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import pytest
+from exporteer_evernote_osx import enex
+
+
+PNG = b'\x89PNG' + bytes(range(256)) * 4
+
+HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+          '<!DOCTYPE en-export SYSTEM '
+          '"http://xml.evernote.com/pub/evernote-export3.dtd">\n'
+          '<en-export export-date="20200102T030405Z" application="Evernote">\n')
+
+
+def _note(title, created, text='hi', resource=False):
+    content = (f'<en-note><div>{text}</div>'
+               f'<en-media hash="{hashlib.md5(PNG).hexdigest()}" '
+               'type="image/png"/></en-note>')
+    note = (f'<note><title>{title}</title><content><![CDATA['
+            f'<?xml version="1.0" encoding="UTF-8"?>{content}]]></content>'
+            f'<created>{created}</created><updated>{created}</updated>')
+    if resource:
+        note += ('<resource><data encoding="base64">'
+                 f'{base64.encodebytes(PNG).decode()}</data>'
+                 '<mime>image/png</mime><resource-attributes>'
+                 '<file-name>pic.png</file-name></resource-attributes>'
+                 '</resource>')
+    return note + '</note>\n'
+
+
+def _enex(*notes):
+    return HEADER + ''.join(notes) + '</en-export>\n'
+
+
+@pytest.fixture(params=[1, 7, enex.CHUNK_SIZE])
+def chunk_size(request, monkeypatch):
+    monkeypatch.setattr(enex, 'CHUNK_SIZE', request.param)
+    return request.param
+
+
+def test_split_enex(chunk_size):
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath)
+        notes = [_note('One / two', '20200101T120000Z', resource=True),
+                 _note('Three', '20210101T000000Z',
+                       text='CDATA with </en-export> inside')]
+        src = path.joinpath('all.enex')
+        src.write_text(_enex(*notes))
+        index = io.StringIO()
+        assert enex.split_enex(src, path.joinpath('split'), index,
+                               resources=True) == 2
+        entries = [json.loads(line) for line in index.getvalue().splitlines()]
+        assert [entry['title'] for entry in entries] == ['One / two', 'Three']
+        assert entries[0]['created'] == '20200101T120000Z'
+        assert entries[0]['media'] == {hashlib.md5(PNG).hexdigest():
+                                       'pic.png'}
+        assert entries[1]['media'] == {}
+        for entry, note in zip(entries, notes):
+            assert Path(entry['file']).name.startswith(
+                f'0000{entries.index(entry) + 1}-')
+            assert Path(entry['file']).read_text() == (
+                HEADER + note.rstrip('\n') + '\n</en-export>\n')
+        resource = Path(f'{entries[0]["file"]}.resources').joinpath('pic.png')
+        assert resource.read_bytes() == PNG
+
+
+def test_concat_enex(chunk_size):
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath)
+        one = _note('One', '20200101T120000Z', text='has </en-export> in it')
+        two = _note('Two', '20200101T120000Z', text='<en-export a="b">')
+        three = _note('Three', '20200101T120000Z')
+        srcs = [path.joinpath(f'{i}.enex') for i in range(3)]
+        srcs[0].write_text(_enex(one))
+        srcs[1].write_text(_enex(two, three))
+        srcs[2].write_text(_enex())
+        dest = path.joinpath('all.enex')
+        enex.concat_enex(srcs, dest)
+        # Each file's whitespace between notes is kept.
+        text = dest.read_text()
+        while '\n\n' in text:
+            text = text.replace('\n\n', '\n')
+        assert text == _enex(one, two, three)
+
+        # The result can be split again.
+        assert enex.split_enex(dest, path.joinpath('split'),
+                               io.StringIO()) == 3
+
+
+def test_concat_enex_nothing():
+    with TemporaryDirectory() as rawpath:
+        dest = Path(rawpath).joinpath('all.enex')
+        enex.concat_enex([], dest)
+        assert enex.split_enex(dest, Path(rawpath).joinpath('split'),
+                               io.StringIO()) == 0
+
+
+def test_safe_name():
+    assert enex.safe_name(' a/b:c\x01 ') == 'a_b_c_'
+    assert enex.safe_name('') == 'Untitled'
+    assert enex.safe_name('x' * 100) == 'x' * 70
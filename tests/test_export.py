@@ -0,0 +1,274 @@
+import json
+from pathlib import Path
+import tarfile
+from tempfile import TemporaryDirectory
+import time
+import zipfile
+import pytest
+from exporteer_evernote_osx import enapp, profiling, transport
+
+
+def _notes(folder):
+    """Returns a dict mapping the evernote-url of each HTML file in folder
+    to its name."""
+    return {enapp._read_note_url(path): path.name
+            for path in Path(folder).glob('*.html')}
+
+
+def test_export_enhanced(app):
+    one = app.add('Same', notebook='Work', resources={'a.png': b'png'})
+    two = app.add('Same', notebook='Home')
+    app.add('Other')
+    seen = []
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath).joinpath('out')
+        assert enapp.export_enhanced(
+            path, on_note=lambda path, meta: seen.append(meta.link))
+        assert seen == [note.link for note in app.notes]
+        notes = _notes(path)
+        assert notes == {one.link: 'Same.html', two.link: '2-Same.html',
+                         app.notes[2].link: 'Other.html'}
+        text = path.joinpath('Same.html').read_text()
+        assert '<meta name="evernote-notebook" content="Work"/>' in text
+        assert '<img src="Same.html.resources/a.png">' in text
+        assert path.joinpath('Same.html.resources', 'a.png').read_bytes() \
+            == b'png'
+        assert sorted(p.name for p in path.iterdir()) == [
+            '2-Same.html', 'Other.html', 'Same.html', 'Same.html.resources']
+
+
+def test_export_enhanced_no_matches(app):
+    app.add('Note', notebook='Work')
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath).joinpath('out')
+        assert not enapp.export_enhanced(path, query='notebook:"Home"')
+        assert list(path.iterdir()) == []
+
+
+def test_export_enhanced_failure_keeps_finished_notes(app):
+    for i in range(3):
+        app.add(f'Note {i}')
+    app.fail_after = 2
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath).joinpath('out')
+        with pytest.raises(transport.ScriptError):
+            enapp.export_enhanced(path)
+        assert set(_notes(path)) == {note.link for note in app.notes[:2]}
+
+
+def test_export_enhanced_after_failure(app):
+    for i in range(3):
+        app.add(f'Note {i}')
+    app.fail_after = 2
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath).joinpath('out')
+        with pytest.raises(transport.ScriptError):
+            enapp.export_enhanced(path)
+        # The failed export's sidecar isn't read again.
+        assert enapp.export_enhanced(path)
+        assert sorted(p.name for p in path.iterdir()) == [
+            '2-Note 0.html', '2-Note 1.html', 'Note 0.html', 'Note 1.html',
+            'Note 2.html']
+
+
+@pytest.mark.parametrize('sync_first', [False, True])
+def test_export_incremental(app, sync_first):
+    old = app.add('Old', updated='2020-01-01T00:00:00')
+    changing = app.add('Changing', updated='2020-01-02T00:00:00',
+                       resources={'a.png': b'1'})
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath).joinpath('out')
+        state = Path(rawpath).joinpath('state.json')
+
+        def export():
+            return enapp.export_incremental(path, state,
+                                            sync_first=sync_first)
+
+        assert export() == 2
+        assert json.loads(state.read_text()) == {
+            'updated': '2020-01-02T00:00:00'}
+
+        app.edit(changing, title='Renamed', updated='2020-02-01T00:00:00',
+                 resources={'b.png': b'2'})
+        new = app.add('New', updated='2020-02-02T00:00:00')
+        app.exported.clear()
+        assert export() == 2
+        assert set(app.exported) == {changing.link, new.link}
+        # The changed note keeps its file name, and its old resources
+        # are replaced.
+        assert _notes(path) == {old.link: 'Old.html',
+                                changing.link: 'Changing.html',
+                                new.link: 'New.html'}
+        assert '<title>Renamed</title>' in \
+            path.joinpath('Changing.html').read_text()
+        assert [p.name for p in path.joinpath(
+            'Changing.html.resources').iterdir()] == ['b.png']
+        assert not path.joinpath('.incremental').exists()
+
+        # Nothing has changed since, including the last note exported.
+        app.exported.clear()
+        assert export() == 0
+        assert app.exported == []
+
+
+@pytest.mark.parametrize('sync_first', [False, True])
+def test_export_mirror(app, sync_first):
+    kept = app.add('Kept', resources={'a.png': b'a'})
+    changed = app.add('Changed')
+    removed = app.add('Removed')
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath).joinpath('mirror')
+        stats = enapp.export_mirror(path, sync_first=sync_first)
+        assert stats == enapp.MirrorStats(3, 0, 4, 0)
+        kept_inode = path.joinpath('Kept.html').stat().st_ino
+        res_inode = path.joinpath('Kept.html.resources', 'a.png').stat().st_ino
+
+        app.edit(changed, title='Kept', body='new text')
+        app.remove(removed)
+        added = app.add('Added')
+        stats = enapp.export_mirror(path, sync_first=sync_first)
+        assert stats == enapp.MirrorStats(3, 2, 2, 1)
+        assert _notes(path) == {kept.link: 'Kept.html',
+                                changed.link: 'Changed.html',
+                                added.link: 'Added.html'}
+        assert path.joinpath('Kept.html').stat().st_ino == kept_inode
+        assert path.joinpath('Kept.html.resources', 'a.png').stat().st_ino \
+            == res_inode
+        assert 'new text' in path.joinpath('Changed.html').read_text()
+        assert sorted(p.name for p in Path(rawpath).iterdir()) == ['mirror']
+
+
+def test_export_mirror_refuses_other_folders(app):
+    app.add('Note')
+    with TemporaryDirectory() as rawpath:
+        Path(rawpath).joinpath('file').touch()
+        with pytest.raises(ValueError):
+            enapp.export_mirror(rawpath)
+
+
+def test_export_enhanced_batched_resumes(app):
+    for i in range(5):
+        app.add(f'Note {i}')
+    app.fail_after = 3
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath).joinpath('out')
+        with pytest.raises(transport.ScriptError):
+            enapp.export_enhanced_batched(path, batch_size=2)
+        journal = json.loads(
+            path.joinpath(enapp.EXPORT_JOURNAL_NAME).read_text())
+        assert journal['completed'] == [1]
+        with pytest.raises(ValueError):
+            enapp.export_enhanced_batched(path, batch_size=3)
+
+        app.exported.clear()
+        assert enapp.export_enhanced_batched(path, batch_size=2)
+        assert app.exported == [note.link for note in app.notes[2:]]
+        assert set(_notes(path)) == {note.link for note in app.notes}
+        assert len(list(path.glob('*.html'))) == 5
+        assert sorted(p.name for p in path.iterdir() if p.name[0] == '.') \
+            == []
+
+
+def test_export_sharded_resumes(app):
+    for year in range(2015, 2021):
+        app.add(f'Note {year}', created=f'{year}-06-01T00:00:00')
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath).joinpath('all.enex')
+        app.fail_after = 0
+        with pytest.raises(transport.ScriptError):
+            enapp.export_sharded(path, 'ENEX', shard_notes=2, retries=0)
+        assert not path.exists()
+
+        # Only the failed shard is exported again.
+        app.exported.clear()
+        timings = enapp.export_sharded(path, 'ENEX', shard_notes=2)
+        assert len(timings) == 1
+        assert app.exported == [note.link for note in app.notes[:2]]
+        assert path.read_text().count('<note>') == 6
+        assert sorted(p.name for p in Path(rawpath).iterdir()) == ['all.enex']
+
+
+def test_export_sharded_retries_html(app):
+    for i, notebook in enumerate(['A', 'B', 'B', 'C']):
+        app.add(f'Note {i}', notebook=notebook)
+    app.fail_after = 1
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath).joinpath('out')
+        timings = enapp.export_sharded(path, shard_by='notebook',
+                                       shard_notes=1)
+        assert len(timings) == 3
+        assert sorted(p.name for p in path.iterdir()) == [
+            f'Note {i}.html' for i in range(4)]
+        assert enapp.export_sharded(path, query='notebook:"D"') is None
+
+
+def test_export_enhanced_profiles_script_separately(app):
+    for i in range(3):
+        app.add(f'Note {i}')
+    with TemporaryDirectory() as rawpath:
+        profiling.start(Path(rawpath).joinpath('trace.json'))
+        tracer = profiling._tracer
+        try:
+            enapp.export_enhanced(Path(rawpath).joinpath('out'),
+                                  on_note=lambda path, meta: time.sleep(0.1))
+        finally:
+            profiling.stop()
+        # The notes are finished after the (fast) fake script exits, and
+        # that time isn't charged to it.
+        assert tracer.summaries['osascript'].count == 1
+        assert tracer.summaries['osascript'].seconds < 0.1
+        assert tracer.summaries['finish_note'].count == 3
+
+
+def test_export_enhanced_via_enex(app):
+    one = app.add('One', notebook='Work', body='<div>caf&eacute;</div>')
+    app.add('Broken', notebook='Work', body='<div>unclosed')
+    two = app.add('Two', notebook='Home', body='<en-todo checked="true"/>')
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath).joinpath('out')
+        result = enapp.export_enhanced_via_enex(path, jobs=1, convert_jobs=1)
+        assert result.notes == 2
+        assert result.unmatched == []
+        assert [note[:2] for note in result.skipped] == [('Work', 'Broken')]
+        assert _notes(path) == {one.link: 'One.html', two.link: 'Two.html'}
+        assert '<div>café</div>' in path.joinpath('One.html').read_text()
+        assert not list(path.glob('.via-enex-*'))
+
+
+def test_export_enhanced_via_enex_reports_unmatched_notes(app, monkeypatch):
+    app.add('One', notebook='Work')
+    monkeypatch.setattr(enapp, 'list_notes', lambda *args: [])
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath).joinpath('out')
+        assert enapp.export_enhanced_via_enex(path, convert_jobs=1) == (
+            enapp.ViaEnexResult(1, [('Work', 'One')], []))
+
+
+@pytest.mark.parametrize('name', ['backup.zip', 'backup.tar.gz'])
+def test_export_enhanced_archive(app, name):
+    app.add('One', resources={'a.png': b'a'})
+    app.add('Two')
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath).joinpath(name)
+        assert enapp.export_enhanced_archive(path)
+        if name.endswith('.zip'):
+            names = zipfile.ZipFile(path).namelist()
+        else:
+            names = tarfile.open(path).getnames()
+        assert sorted(name.rstrip('/') for name in names) == [
+            'One.html', 'One.html.resources', 'One.html.resources/a.png',
+            'Two.html']
+        assert sorted(p.name for p in Path(rawpath).iterdir()) == [name]
+
+
+def test_export_enhanced_archive_failure_leaves_no_archive(app):
+    for i in range(3):
+        app.add(f'Note {i}')
+    app.fail_after = 2
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath).joinpath('backup.zip')
+        with pytest.raises(transport.ScriptError):
+            enapp.export_enhanced_archive(path)
+        assert list(Path(rawpath).iterdir()) == []
+        assert not enapp.export_enhanced_archive(path, 'notebook:"None"')
+        assert list(Path(rawpath).iterdir()) == []
@@ -0,0 +1,93 @@
+import errno
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from urllib.parse import quote
+from exporteer_evernote_osx import enapp
+
+
+def _note(folder, name, resource=None):
+    folder.mkdir(parents=True, exist_ok=True)
+    path = folder.joinpath(name)
+    body = f'{folder.name}/{name}'
+    if resource:
+        respath = path.with_name(f'{name}.resources')
+        respath.mkdir()
+        respath.joinpath('a.png').write_bytes(resource)
+        body += f'<img src="{quote(respath.name)}/a.png">'
+    path.write_text(f'<html><head></head><body>{body}</body></html>')
+    return path
+
+
+def _tree(folder):
+    return {str(p.relative_to(folder)): p.read_bytes()
+            for p in sorted(folder.rglob('*')) if p.is_file()}
+
+
+def _sources(rawpath):
+    root = Path(rawpath)
+    dest = root.joinpath('dest')
+    _note(dest, 'Note.html')
+    for i in range(3):
+        src = root.joinpath(f'src{i}')
+        _note(src, 'Note.html', resource=f'note {i}'.encode())
+        _note(src, f'Other {i}.html')
+    return dest, [root.joinpath(f'src{i}') for i in range(3)]
+
+
+def test_merge_follows_plan():
+    with TemporaryDirectory() as rawpath:
+        dest, srcdirs = _sources(rawpath)
+        plan = enapp.plan_merge(srcdirs, dest)
+        assert [(src.parent.name, target.name) for src, target in plan
+                if src.name == 'Note.html'] == [
+            ('src0', '2-Note.html'), ('src1', '3-Note.html'),
+            ('src2', '4-Note.html')]
+        contents = {target.name: src.read_text() for src, target in plan}
+        # Nothing is changed by planning.
+        assert not dest.joinpath('2-Note.html').exists()
+
+        stats = enapp.merge(srcdirs, dest, jobs=4)
+        assert stats.files == 3
+        for src, target in plan:
+            assert not src.exists()
+            text = target.read_text()
+            assert text.replace(quote(f'{target.name}.resources'),
+                                quote(f'{src.name}.resources')) \
+                == contents[target.name]
+        assert dest.joinpath('3-Note.html.resources', 'a.png').read_bytes() \
+            == b'note 1'
+        assert 'src="3-Note.html.resources/a.png"' in \
+            dest.joinpath('3-Note.html').read_text()
+        assert all(not any(srcdir.iterdir()) for srcdir in srcdirs)
+
+
+def test_merge_copies_across_filesystems(monkeypatch):
+    with TemporaryDirectory() as rawpath:
+        dest, srcdirs = _sources(rawpath)
+        with TemporaryDirectory() as otherpath:
+            expected_dest, expected_srcdirs = _sources(otherpath)
+            enapp.merge(expected_srcdirs, expected_dest, jobs=1)
+            expected = _tree(expected_dest)
+
+        rename = os.rename
+        synced = []
+
+        def cross_device_rename(src, dest):
+            if Path(dest).parent.name == 'dest':
+                raise OSError(errno.EXDEV, 'Invalid cross-device link')
+            rename(src, dest)
+
+        fsync = os.fsync
+
+        def record_fsync(fd):
+            synced.append(fd)
+            fsync(fd)
+
+        monkeypatch.setattr(os, 'rename', cross_device_rename)
+        monkeypatch.setattr(os, 'fsync', record_fsync)
+        enapp.merge(srcdirs, dest, jobs=2)
+        assert _tree(dest) == expected
+        assert all(not any(srcdir.iterdir()) for srcdir in srcdirs)
+        # Each note and attachment copied was synced to disk.
+        assert len(synced) == 6 + 3
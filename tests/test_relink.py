@@ -0,0 +1,84 @@
+import io
+import json
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import pytest
+from exporteer_evernote_osx import enapp, rewrite
+
+
+def _note(path, url, body):
+    path.write_text(
+        f'<html><head><meta name="evernote-url" content="{url}">'
+        f'<a href="{url}">self</a></head><body>{body}</body></html>')
+
+
+A = 'evernote:///view/1/s1/aaa/aaa/'
+B = 'evernote:///view/1/s1/bbb/bbb/'
+C = 'evernote:///view/1/s1/ccc/ccc/'
+MISSING = 'evernote:///view/1/s1/zzz/zzz/'
+
+
+def test_relink_links_followed_by_other_characters():
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath)
+        _note(path.joinpath('a.html'), A,
+              f'see {B}). or <a href="{B}&amp;x">b</a> {B}{A} {MISSING}.')
+        _note(path.joinpath('b b.html'), B, f'{A}')
+        enapp.relink(path, jobs=1)
+        assert path.joinpath('a.html').read_text() == (
+            f'<html><head><meta name="evernote-url" content="{A}">'
+            f'<a href="{A}">self</a></head><body>see b b.html). or '
+            f'<a href="b b.html&amp;x">b</a> b b.htmla.html {MISSING}.'
+            '</body></html>')
+        assert 'a.html' in path.joinpath('b b.html').read_text()
+
+        # A known URL after an unknown one is replaced, as the original
+        # relink did, and counted as a link.
+        _note(path.joinpath('c.html'), C, f'{MISSING},{B} ({MISSING}){A}')
+        enapp.relink(path, jobs=1)
+        assert path.joinpath('c.html').read_text().endswith(
+            f'<body>{MISSING},b b.html ({MISSING})a.html</body></html>')
+        graph = json.loads(path.joinpath(enapp.LINK_GRAPH_NAME).read_text())
+        assert graph['links'][C] == [A, B]
+
+        # The unresolved link is picked up once its note appears.
+        _note(path.joinpath('z.html'), MISSING, '')
+        enapp.relink(path, jobs=1)
+        assert path.joinpath('a.html').read_text().endswith(
+            ' z.html.</body></html>')
+
+
+def test_relink_rebuilds_graph_and_backlinks_of_relinked_folder():
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath)
+        _note(path.joinpath('a.html'), A, f'<a href="{B}">b</a>')
+        _note(path.joinpath('b b.html'), B, '')
+        enapp.relink(path, jobs=1, backlinks=True)
+        graph = json.loads(path.joinpath(enapp.LINK_GRAPH_NAME).read_text())
+        assert graph['links'] == {A: [B], B: []}
+        relinked = path.joinpath('b b.html').read_text()
+        assert 'href="a.html"' in relinked
+
+        # The links relink replaced are found again, and the backlinks
+        # section isn't mistaken for links from b to a.
+        enapp.relink(path, jobs=1, rebuild=True, backlinks=True)
+        rebuilt = json.loads(path.joinpath(enapp.LINK_GRAPH_NAME).read_text())
+        assert rebuilt == graph
+        assert path.joinpath('b b.html').read_text() == relinked
+
+        # A section that's no longer wanted is removed, even though the
+        # new index doesn't know what it listed.
+        _note(path.joinpath('a.html'), A, '')
+        enapp.relink(path, jobs=1, rebuild=True, backlinks=True)
+        assert 'Backlinks' not in path.joinpath('b b.html').read_text()
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 64, 100, rewrite.CHUNK_SIZE])
+def test_relink_scan_finds_titles_spanning_chunks(chunk_size):
+    title = 'A long title ' * 20
+    text = f'<html><head><title>{title}</title></head><body></body></html>'
+    titles = [match.group(2) for _, match in rewrite.iter_matches(
+                  io.StringIO(text), enapp._RELINK_SCAN_RE,
+                  enapp._RELINK_SCAN_OVERLAP, chunk_size)
+              if match and match.group(2) is not None]
+    assert titles == [title]
@@ -0,0 +1,126 @@
+import io
+import os
+from pathlib import Path
+import random
+import re
+from tempfile import TemporaryDirectory
+import pytest
+from exporteer_evernote_osx import rewrite
+
+
+CHUNK_SIZES = [1, 2, 3, 5, 8, 13, 64, rewrite.CHUNK_SIZE]
+
+LINK_RE = re.compile('evernote://[^\\s"\'<>]+')
+
+
+def _random_text(rng, pieces):
+    return ''.join(rng.choice(pieces) for _ in range(rng.randint(0, 200)))
+
+
+def _check_iter_matches(text, pattern, overlap, chunk_size):
+    pairs = list(rewrite.iter_matches(io.StringIO(text), pattern, overlap,
+                                      chunk_size))
+    assert ''.join(piece + (match.group(0) if match else '')
+                   for piece, match in pairs) == text
+    assert ([match.group(0) for _, match in pairs if match]
+            == [match.group(0) for match in pattern.finditer(text)])
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_iter_matches_literals(chunk_size):
+    rng = random.Random(chunk_size)
+    pattern = re.compile('</head>|<head>|ab')
+    for _ in range(200):
+        text = _random_text(rng, ['</head>', '<head>', 'a', 'b', '<', 'x'])
+        _check_iter_matches(text, pattern, len('</head>'), chunk_size)
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_iter_matches_grows_buffer_for_long_matches(chunk_size):
+    rng = random.Random(chunk_size)
+    pieces = ['evernote://', 'view/', 'x' * 30, ' ', '"', '</head>']
+    pattern = re.compile(f'</head>|{LINK_RE.pattern}')
+    for _ in range(200):
+        text = _random_text(rng, pieces)
+        _check_iter_matches(text, pattern, len('evernote://'), chunk_size)
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_iter_matches_long_matches_spanning_chunks(chunk_size):
+    rng = random.Random(chunk_size)
+    pieces = ['<title>', 'x' * 30, '</title>', '<', ' ']
+    pattern = re.compile('<title>([^<]*)|</head>')
+    for _ in range(200):
+        text = _random_text(rng, pieces)
+        _check_iter_matches(text, pattern, len('<title>'), chunk_size)
+
+
+def test_iter_matches_empty():
+    pairs = list(rewrite.iter_matches(io.StringIO(''), LINK_RE, 11))
+    assert all(not piece and not match for piece, match in pairs)
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_rewrite(chunk_size):
+    with TemporaryDirectory() as rawpath:
+        src = Path(rawpath).joinpath('src.html')
+        dest = Path(rawpath).joinpath('dest.html')
+        src.write_text('a evernote://one/ b evernote://two/ c')
+        stats = rewrite.rewrite(
+            src, dest, LINK_RE, lambda match: match.group(0).upper(), 11,
+            chunk_size=chunk_size)
+        assert dest.read_text() == 'a EVERNOTE://ONE/ b EVERNOTE://TWO/ c'
+        assert stats == rewrite.RewriteStats(1, 37, 37)
+        assert not list(Path(rawpath).glob('.*.tmp'))
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_rewrite_unchanged_in_place(chunk_size):
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath).joinpath('note.html')
+        path.write_text('a evernote://one/ b')
+        os.utime(path, ns=(0, 0))
+        stats = rewrite.rewrite(path, path, LINK_RE, lambda m: m.group(0),
+                                11, chunk_size=chunk_size)
+        assert stats == rewrite.RewriteStats(0, 19, 0)
+        assert path.stat().st_mtime_ns == 0
+        assert not list(Path(rawpath).glob('.*.tmp'))
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_rewrite_keep_text_removes_sections(chunk_size):
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath).joinpath('note.html')
+        path.write_text('keep<!--s-->drop this<!--e--> and <!--s-->'
+                        + 'more' * 50 + '<!--e-->this')
+        dropping = False
+
+        def replace(match):
+            nonlocal dropping
+            dropping = match.group(0) == '<!--s-->'
+            return ''
+
+        rewrite.rewrite(path, path, re.compile('<!--s-->|<!--e-->'),
+                        replace, 8, keep_text=lambda text: not dropping,
+                        chunk_size=chunk_size)
+        assert path.read_text() == 'keep and this'
+
+
+def test_rewrite_removes_temporary_file_on_error():
+    with TemporaryDirectory() as rawpath:
+        path = Path(rawpath).joinpath('note.html')
+        path.write_text('a evernote://one/ b')
+
+        def replace(match):
+            raise ValueError('boom')
+
+        with pytest.raises(ValueError):
+            rewrite.rewrite(path, path, LINK_RE, replace, 11)
+        assert path.read_text() == 'a evernote://one/ b'
+        assert not list(Path(rawpath).glob('.*.tmp'))
+
+
+def test_total():
+    assert rewrite.total([rewrite.RewriteStats(1, 2, 3),
+                          rewrite.RewriteStats(0, 5, 0)]) == (
+        rewrite.RewriteStats(1, 7, 3))
@@ -0,0 +1,25 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from exporteer_evernote_osx import watch
+
+
+def test_watch_reports_queue_depth(app, monkeypatch):
+    app.add('One', updated='2020-01-01T00:00:00')
+    depths = []
+    update = watch._Status.update
+
+    def record(self, **values):
+        if values.get('state') == 'syncing' and depths:
+            app.add('Two', updated='2020-02-01T00:00:00')
+        if values.get('state') == 'exporting':
+            depths.append(values['queue_depth'])
+        update(self, **values)
+
+    monkeypatch.setattr(watch._Status, 'update', record)
+    with TemporaryDirectory() as rawpath:
+        watch.watch(rawpath, interval_seconds=0, cycles=2)
+        # Nothing is counted before the first cycle, and the second one
+        # only counts the new note.
+        assert depths == [None, 1]
+        assert sorted(p.name for p in Path(rawpath).glob('*.html')) == [
+            'One.html', 'Two.html']